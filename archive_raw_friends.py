@@ -0,0 +1,51 @@
+from datetime import timedelta
+import os
+import sys
+from pymongo import MongoClient
+
+from uma_friends.indexes import ensure_indexes
+from uma_friends.raw_archiver import RawArchiver
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+
+# Raw friend data is deleted once archived here, so it must be storage that
+# outlives the process, not the ephemeral filesystem of a dyno
+RAW_ARCHIVE_DIR = os.environ['RAW_ARCHIVE_DIR']
+# Raw friend data posted within this many days is kept in database
+RAW_RETENTION_DAYS = int(os.environ.get('RAW_RETENTION_DAYS', 90))
+
+
+def run_archiver(restore_paths=()):
+    '''Archives old raw friend data, or restores archive files if given.'''
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+    raw_collection = uma_friends_db[RAW_GAMEWITH_FRIENDS_NS]
+    ensure_indexes(raw_collection, 'raw')
+
+    raw_archiver = RawArchiver(
+        raw_collection=raw_collection,
+        clean_collection=uma_friends_db[UMA_FRIENDS_NS],
+        archive_dir=RAW_ARCHIVE_DIR,
+        retention=timedelta(days=RAW_RETENTION_DAYS)
+    )
+    if restore_paths:
+        for path in restore_paths:
+            raw_archiver.restore(path)
+    else:
+        raw_archiver.run()
+
+
+if __name__ == '__main__':
+    # python archive_raw_friends.py [--restore <archive file>...]
+    # Restored friend data is archived again by the next run, so pause
+    # archiving until backfill_friends.py --restart has normalized it
+    args = sys.argv[1:]
+    run_archiver(restore_paths=args[1:] if args[:1] == ['--restore'] else ())
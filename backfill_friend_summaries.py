@@ -0,0 +1,63 @@
+import json
+import os
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+from uma_friends.indexes import ensure_indexes
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+
+BATCH_SIZE = 1000
+
+
+def _write_summaries(clean_collection, batch):
+    clean_collection.bulk_write(
+        [UpdateOne({'_id': friend['_id']},
+                   {'$set': {'summary': GamewithNormalizer.summarize(friend)}})
+         for friend in batch],
+        ordered=False
+    )
+
+
+def backfill_summaries():
+    '''Adds summary fields to clean documents normalized before they existed.
+
+    Summaries derive from fields already in clean documents, so nothing is
+    normalized again. Safe to interrupt and rerun: only documents without
+    summary are visited.
+    '''
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    clean_collection = mongo_client[UMAFRIENDS_DB][UMA_FRIENDS_NS]
+    ensure_indexes(clean_collection, 'clean')
+
+    query = {'summary': {'$exists': False}}
+    logger.info('Started backfilling friend summaries. %s',
+                json.dumps({'collection': clean_collection.full_name,
+                            'n_remaining': clean_collection.count_documents(query)}))
+    n_done = 0
+    batch = []
+    cursor = (clean_collection.find(query, {'factors': 1, 'parents': 1})
+                              .sort('_id', ASCENDING)
+                              .batch_size(BATCH_SIZE))
+    for friend in cursor:
+        batch.append(friend)
+        if len(batch) == BATCH_SIZE:
+            _write_summaries(clean_collection, batch)
+            n_done += len(batch)
+            batch = []
+    if batch:
+        _write_summaries(clean_collection, batch)
+        n_done += len(batch)
+    logger.info('Finished backfilling friend summaries. %s',
+                json.dumps({'collection': clean_collection.full_name, 'n_done': n_done}))
+
+
+if __name__ == '__main__':
+    backfill_summaries()
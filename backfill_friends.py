@@ -0,0 +1,44 @@
+import os
+import sys
+from pymongo import MongoClient
+
+from uma_friends.friends_backfiller import FriendsBackfiller
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
+GAME_DATA_DB = os.environ['GAME_DATA_DB']
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
+
+BACKFILL_CHECKPOINT_NS = os.environ.get('BACKFILL_CHECKPOINT_NS', 'backfill_checkpoints')
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 1000))
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 0)) or None
+
+
+def run_backfill(restart=False):
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+
+    friends_backfiller = FriendsBackfiller(
+        db_uri=UMAFRIENDS_DB_URI,
+        raw_collection=uma_friends_db[RAW_GAMEWITH_FRIENDS_NS],
+        clean_collection=uma_friends_db[UMA_FRIENDS_NS],
+        failed_collection=uma_friends_db[FAILED_BUFFER_NS],
+        checkpoint_collection=uma_friends_db[BACKFILL_CHECKPOINT_NS],
+        game_data_db=GAME_DATA_DB,
+        batch_size=BACKFILL_BATCH_SIZE,
+        max_workers=BACKFILL_WORKERS,
+        stats_collection=uma_friends_db[FRIEND_STATS_NS] if FRIEND_STATS_NS else None
+    )
+    friends_backfiller.run(restart=restart)
+
+
+if __name__ == '__main__':
+    run_backfill(restart='--restart' in sys.argv[1:])
@@ -0,0 +1,70 @@
+'''Micro-benchmark of GamewithNormalizer.normalize, per friend.
+
+Game data is served from an in-memory snapshot, so no database is needed and
+only the pure-Python cost of normalizing is measured, as in a backfill.
+
+Usage:
+    python -m benchmarks.normalize_friends [n_friends]
+'''
+from datetime import datetime, timezone
+import sys
+import timeit
+
+from uma_friends.game_data_snapshot import GameDataSnapshot
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+
+
+FRIEND_DATA = {
+    'friend_code': '248605600',
+    'support_id': '262813',
+    'support_limit': '4凸',
+    'character_image_url': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png',
+    'factors': [
+        'パワー3(代表3)',
+        'スタミナ6',
+        '差し2(代表2)',
+        'マイル4',
+        'Pride of KING1(代表1)',
+        '紅焔ギア/LP1211-M1',
+        'Shadow Break1',
+        '集中力1(代表1)',
+        '末脚3',
+        'URAシナリオ6(代表3)'
+    ],
+    'comment': '',
+    'post_date': datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc)
+}
+
+
+def build_normalizer():
+    supports = [{'id': 'support_a', 'gwId': '262813'}]
+    players = [
+        {'id': 'uma_a', 'gwImgUrl': FRIEND_DATA['character_image_url'],
+         'uniqueSkillList': ['unique_a']},
+        {'id': 'uma_b', 'gwImgUrl': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_26.png',
+         'uniqueSkillList': ['unique_b']},
+        {'id': 'uma_c', 'gwImgUrl': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_27.png',
+         'uniqueSkillList': ['unique_c']}
+    ]
+    skills = [
+        {'id': 'unique_a', 'name': 'Pride of KING', 'rare': '固有'},
+        {'id': 'unique_b', 'name': 'Shadow Break', 'rare': '固有'},
+        {'id': 'unique_c', 'name': '紅焔ギア/LP1211-M', 'rare': '固有'},
+        {'id': 'common_a', 'name': '集中力', 'rare': '普通'},
+        {'id': 'common_b', 'name': '末脚', 'rare': '普通'}
+    ]
+    races = []
+    snapshot = GameDataSnapshot.from_documents(supports, players, skills, races)
+    return GamewithNormalizer(None, snapshot=snapshot)
+
+
+def main(n_friends=100000):
+    normalizer = build_normalizer()
+    seconds = min(timeit.repeat(lambda: normalizer.normalize(FRIEND_DATA),
+                                number=n_friends, repeat=5))
+    print(f'normalize: {seconds / n_friends * 1e6:.2f} us per friend '
+          f'({n_friends} friends, best of 5)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+'''Micro-benchmark of post date parsing, strptime against PostDateResolver.
+
+Post dates are drawn from the last three days at minute resolution, as
+a run of the scraper would see them.
+
+Usage:
+    python -m benchmarks.parse_post_dates [n_strings]
+'''
+from datetime import datetime, timedelta, timezone
+import random
+import sys
+import time
+
+from uma_friends.post_date_resolver import PostDateResolver
+
+
+def get_utc_datetime(date_string, format):
+    '''Returns datetime (in utc timezone) based on date_string and format.
+
+    How post dates were parsed before PostDateResolver, kept as the baseline.
+
+    This function assumes that the given date_string does not
+    contain year info. It assigns a year so that the resulting datetime
+    is the latest datetime that's earlier than NOW.
+
+    Args:
+        The same as datetime.strptime() function. Example usage:
+        get_utc_datetime('07/16 13:22', '%m/%d %H:%M')
+    '''
+    now_date_local = datetime.now()
+    now_year_local = now_date_local.year
+
+    post_date_local = datetime.strptime(date_string, format)
+    # Add year info
+    post_date_local = post_date_local.replace(year=now_year_local)
+    if post_date_local > now_date_local:
+        # Year has changed since post date
+        post_date_local = post_date_local.replace(year=now_year_local - 1)
+
+    post_date_utc = post_date_local.astimezone(tz=timezone.utc)
+    return post_date_utc
+
+
+def make_date_strings(n_strings):
+    now = datetime.now()
+    random.seed(0)
+    return [(now - timedelta(minutes=random.randrange(3 * 24 * 60))).strftime('%m/%d %H:%M')
+            for _ in range(n_strings)]
+
+
+def measure(name, function, n_strings):
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print(f'{name}: {seconds * 1e3:.1f} ms ({seconds / n_strings * 1e9:.0f} ns per string)')
+
+
+def main(n_strings=100000):
+    date_strings = make_date_strings(n_strings)
+    print(f'{n_strings} strings, {len(set(date_strings))} distinct')
+    measure('get_utc_datetime (strptime)',
+            lambda: [get_utc_datetime(date_string, '%m/%d %H:%M') for date_string in date_strings],
+            n_strings)
+    resolver = PostDateResolver()
+    measure('PostDateResolver.resolve',
+            lambda: [resolver.resolve(date_string) for date_string in date_strings],
+            n_strings)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
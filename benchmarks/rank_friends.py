@@ -0,0 +1,74 @@
+'''Benchmark of top-K by blue stars, summary index against aggregation.
+
+Needs a MongoDB server, since what is measured is the query plan. Friends
+are written to a scratch database, which is dropped first.
+
+Usage:
+    python -m benchmarks.rank_friends [mongodb_uri] [n_friends]
+'''
+from datetime import datetime, timedelta, timezone
+import random
+import sys
+import timeit
+
+from pymongo import MongoClient
+
+from uma_friends.friend_search import FriendSearch
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+from uma_friends.indexes import INDEXES
+
+
+TOP_K = 20
+
+# What ranking by blue stars costs without summary: every friend's factors
+# are unwound and summed before sorting
+PIPELINE = [
+    {'$unwind': '$factors'},
+    {'$match': {'factors.type': 'blue'}},
+    {'$group': {'_id': '$_id', 'stars': {'$sum': '$factors.level'},
+                'post_date': {'$first': '$post_date'}}},
+    {'$sort': {'stars': -1, 'post_date': -1}},
+    {'$limit': TOP_K}
+]
+
+FACTORS = [('スピード', 'blue'), ('スタミナ', 'blue'), ('パワー', 'blue'), ('マイル', 'distance'),
+           ('差し', 'strategy'), ('末脚', 'common_skill'), ('URAシナリオ', 'ura')]
+
+
+def build_friends(n_friends):
+    rng = random.Random(0)
+    post_date = datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc)
+    friends = []
+    for i in range(n_friends):
+        friend = {
+            'friend_code': str(i),
+            'post_date': post_date - timedelta(minutes=i),
+            'factors': [{'name': name, 'type': factor_type, 'level': rng.randint(1, 9)}
+                        for name, factor_type in rng.sample(FACTORS, 4)],
+            'parents': []
+        }
+        friend['summary'] = GamewithNormalizer.summarize(friend)
+        friends.append(friend)
+    return friends
+
+
+def main(mongodb_uri='localhost:27017', n_friends=100000):
+    collection = MongoClient(mongodb_uri, tz_aware=True)['benchmark_uma_friends']['rank_friends']
+    collection.drop()
+    collection.create_indexes(INDEXES['clean'])
+    collection.insert_many(build_friends(int(n_friends)))
+
+    search = FriendSearch()
+    ranked = min(timeit.repeat(lambda: search.rank_by_stars(collection, limit=TOP_K),
+                               number=10, repeat=5)) / 10
+    aggregated = min(timeit.repeat(lambda: list(collection.aggregate(PIPELINE)),
+                                   number=1, repeat=5))
+    explain = collection.find({}).sort([('summary.stars.blue', -1), ('post_date', -1)]).limit(TOP_K).explain()
+    stats = explain['executionStats']
+    print(f'rank_by_stars: {ranked * 1e3:.2f} ms '
+          f'({stats["totalKeysExamined"]} keys, {stats["totalDocsExamined"]} documents examined)')
+    print(f'aggregation: {aggregated * 1e3:.2f} ms ({n_friends} friends, top {TOP_K}, best of 5)')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,37 @@
+import os
+from pymongo import MongoClient
+
+from uma_friends.indexes import report_indexes
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
+GAME_DATA_DB = os.environ['GAME_DATA_DB']
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
+
+GAME_DATA_COLLECTION_NAMES = ['players', 'supports', 'skills', 'races', 'buffs', 'effects', 'events']
+
+
+def check_indexes():
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+    game_data_db = mongo_client[GAME_DATA_DB]
+
+    report_indexes(uma_friends_db[RAW_GAMEWITH_FRIENDS_NS], 'raw')
+    report_indexes(uma_friends_db[UMA_FRIENDS_NS], 'clean')
+    report_indexes(uma_friends_db[FAILED_BUFFER_NS], 'failed')
+    if FRIEND_STATS_NS:
+        report_indexes(uma_friends_db[FRIEND_STATS_NS], 'stats')
+    for collection_name in GAME_DATA_COLLECTION_NAMES:
+        report_indexes(game_data_db[collection_name], collection_name)
+
+
+if __name__ == '__main__':
+    check_indexes()
@@ -1,6 +1,9 @@
 import os
 from pymongo import MongoClient, ASCENDING
+from uma_friends.bulk_writer import BulkWriter
+from uma_friends.friend_stats import FriendStats
 from uma_friends.gamewith_normalizer import GamewithNormalizer, OutdatedError
+from uma_friends.indexes import ensure_indexes
 
 
 UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
@@ -9,6 +12,15 @@ RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
 UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
 FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
 GAME_DATA_DB = os.environ['GAME_DATA_DB']
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
+
+BATCH_SIZE = 1000
+
+
+def _clean_batch(gamewith_normalizer, batch, clean_writer, failed_writer):
+    cleaned_data_list, failed_data_list = gamewith_normalizer.normalize_many(batch)
+    clean_writer.write(cleaned_data_list)
+    failed_writer.write(failed_data_list)
 
 
 def clean():
@@ -20,26 +32,30 @@ def clean():
 
     game_data_db = mongo_client[GAME_DATA_DB]
     gamewith_normalizer = GamewithNormalizer(game_data_db)
+    gamewith_normalizer.load_snapshot()
+
+    ensure_indexes(uma_friends, 'clean')
+    ensure_indexes(failed_collection, 'failed')
+    on_clean_insert = None
+    if FRIEND_STATS_NS:
+        on_clean_insert = FriendStats(uma_friends_db[FRIEND_STATS_NS]).add
+    clean_writer = BulkWriter(uma_friends, batch_size=BATCH_SIZE, on_insert=on_clean_insert)
+    failed_writer = BulkWriter(failed_collection, batch_size=BATCH_SIZE)
 
     total = raw_friends.count_documents({})
     i = 0
-    for document in list(raw_friends.find().sort('post_date', ASCENDING)):
-        try:
-            friend_data = gamewith_normalizer.normalize(document)
-            uma_friends.insert_one(friend_data)
-        except OutdatedError:
-            failed_collection.insert_one(document)
-        i += 1
-        print(f'{i}/{total}', end='\r')
+    batch = []
+    for document in raw_friends.find().sort('post_date', ASCENDING):
+        batch.append(document)
+        if len(batch) == BATCH_SIZE:
+            _clean_batch(gamewith_normalizer, batch, clean_writer, failed_writer)
+            i += len(batch)
+            batch = []
+            print(f'{i}/{total}', end='\r')
+    if batch:
+        _clean_batch(gamewith_normalizer, batch, clean_writer, failed_writer)
+        i += len(batch)
     print(f'{i}/{total}')
-    uma_friends.create_index(
-        [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-        unique=True
-    )
-    failed_collection.create_index(
-        [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-        unique=True
-    )
     print('Finished.')
 
 
@@ -58,14 +74,6 @@ def limit_to_int():
         i += 1
         print(f'{i}/{total}', end='\r')
     print(f'{i}/{total}')
-    uma_friends.create_index(
-        [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-        unique=True
-    )
-    failed_collection.create_index(
-        [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-        unique=True
-    )
     print('Finished.')
 
 
@@ -0,0 +1,26 @@
+import os
+from pymongo import MongoClient
+
+from uma_friends.friend_stats import FriendStats
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+FRIEND_STATS_NS = os.environ['FRIEND_STATS_NS']
+
+
+def rebuild_stats():
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+
+    friend_stats = FriendStats(uma_friends_db[FRIEND_STATS_NS])
+    friend_stats.rebuild(uma_friends_db[UMA_FRIENDS_NS])
+
+
+if __name__ == '__main__':
+    rebuild_stats()
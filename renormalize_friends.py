@@ -0,0 +1,38 @@
+import os
+from pymongo import MongoClient
+
+from uma_friends.friends_renormalizer import FriendsRenormalizer
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
+GAME_DATA_DB = os.environ['GAME_DATA_DB']
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
+
+
+def run_renormalizer():
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+    game_data_db = mongo_client[GAME_DATA_DB]
+
+    friends_renormalizer = FriendsRenormalizer(
+        raw_collection=uma_friends_db[RAW_GAMEWITH_FRIENDS_NS],
+        clean_collection=uma_friends_db[UMA_FRIENDS_NS],
+        failed_collection=uma_friends_db[FAILED_BUFFER_NS],
+        changes_collection=game_data_db['changes'],
+        gamewith_normalizer=GamewithNormalizer(game_data_db),
+        stats_collection=uma_friends_db[FRIEND_STATS_NS] if FRIEND_STATS_NS else None
+    )
+    friends_renormalizer.run()
+
+
+if __name__ == '__main__':
+    run_renormalizer()
@@ -10,10 +10,18 @@ from uma_friends.utils import get_logger
 logger = get_logger()
 
 
-GOOGLE_CHROME_BIN = os.environ['GOOGLE_CHROME_BIN']
-CHROMEDRIVER_PATH = os.environ['CHROMEDRIVER_PATH']
+GOOGLE_CHROME_BIN = os.environ.get('GOOGLE_CHROME_BIN')
+CHROMEDRIVER_PATH = os.environ.get('CHROMEDRIVER_PATH')
 
 BUTTON_LIMIT = int(os.environ['BUTTON_LIMIT'])
+# If set to 1, friends are removed from page once harvested. The page's own
+# scripts own those nodes, so a page update may break rendering of friends
+# loaded later; watch for "Friends did not load after click" warnings.
+PRUNE_HARVESTED_FRIENDS = os.environ.get('PRUNE_HARVESTED_FRIENDS') == '1'
+# How many friends are normalized and written at once while scraping
+PIPELINE_BATCH_SIZE = int(os.environ.get('PIPELINE_BATCH_SIZE', 200))
+# How many documents are sent to database in one bulk write
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 500))
 
 UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
 UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
@@ -21,26 +29,34 @@ RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
 UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
 FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
 GAME_DATA_DB = os.environ['GAME_DATA_DB']
+# If set, per-day counters of friends are kept in this collection
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
 
 GAMEWITH_FRIENDS_URL = os.environ['GAMEWITH_FRIENDS_URL']
 
 
-def run_scraper():
+def start_driver():
     chrome_option = webdriver.ChromeOptions()
     chrome_option.binary_location = GOOGLE_CHROME_BIN
     chrome_option.add_argument('--headless')
     chrome_option.add_argument('--no-sandbox')
     chrome_option.add_argument('--disable-dev-shm-usage')
-    driver = webdriver.Chrome(executable_path=CHROMEDRIVER_PATH, options=chrome_option)
+    return webdriver.Chrome(executable_path=CHROMEDRIVER_PATH, options=chrome_option)
+
+
+def run_scraper():
+    driver = start_driver()
 
     mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
     uma_friends_db = mongo_client[UMAFRIENDS_DB]
     raw_collection = uma_friends_db[RAW_GAMEWITH_FRIENDS_NS]
     clean_collection = uma_friends_db[UMA_FRIENDS_NS]
     failed_collection = uma_friends_db[FAILED_BUFFER_NS]
+    stats_collection = uma_friends_db[FRIEND_STATS_NS] if FRIEND_STATS_NS else None
     game_data_db = mongo_client[GAME_DATA_DB]
 
     gamewith_normalizer = GamewithNormalizer(game_data_db)
+    gamewith_normalizer.load_snapshot()
 
     gamewith_scraper = GamewithScraper(driver=driver,
                                        url=GAMEWITH_FRIENDS_URL,
@@ -49,7 +65,11 @@ def run_scraper():
                                        raw_collection=raw_collection,
                                        clean_collection=clean_collection,
                                        failed_collection=failed_collection,
-                                       gamewith_normalizer=gamewith_normalizer)
+                                       gamewith_normalizer=gamewith_normalizer,
+                                       prune_harvested=PRUNE_HARVESTED_FRIENDS,
+                                       batch_size=PIPELINE_BATCH_SIZE,
+                                       write_batch_size=WRITE_BATCH_SIZE,
+                                       stats_collection=stats_collection)
     gamewith_scraper.run()
 
 
@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+import json
+import os
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from uma_friends.bulk_writer import DUPLICATE_KEY_ERROR_CODE
+from uma_friends.friend_stats import FriendStats
+from uma_friends.utils import get_logger
+
+
+logger = get_logger()
+
+
+UMAFRIENDS_DB_URI = os.environ['UMAFRIENDS_DB_URI']
+UMAFRIENDS_DB = os.environ['UMAFRIENDS_DB']
+RAW_GAMEWITH_FRIENDS_NS = os.environ['RAW_GAMEWITH_FRIENDS_NS']
+UMA_FRIENDS_NS = os.environ['UMA_FRIENDS_NS']
+FAILED_BUFFER_NS = os.environ['FAILED_BUFFER_NS']
+FRIEND_STATS_NS = os.environ.get('FRIEND_STATS_NS')
+
+# Post dates were read in the timezone of the host, UTC, instead of Japan time
+SHIFT = timedelta(hours=9)
+# Stamped on every shifted document, holding the post date it was shifted
+# from. Kept for good: documents without it are the ones left to shift, and
+# clean and failed documents derived from a shifted raw one are found by it.
+SHIFTED_FIELD = 'post_date_shifted_from'
+BATCH_SIZE = 1000
+
+
+# Fields that may differ between two stores of the same post
+_BOOKKEEPING_FIELDS = {'_id', 'post_date', SHIFTED_FIELD, 'retry'}
+
+
+def _is_same_post(friend, other):
+    '''Returns whether two documents hold the same friend data, apart from post date.'''
+    return ({k: v for k, v in friend.items() if k not in _BOOKKEEPING_FIELDS} ==
+            {k: v for k, v in other.items() if k not in _BOOKKEEPING_FIELDS})
+
+
+def _shift_batch(collection, batch):
+    '''Shifts post dates of batch, in order, stamping each shifted document.
+
+    A document whose shifted key is already taken by the same post, scraped
+    again or shifted before, is deleted. Otherwise it is left unshifted and
+    logged, so that no post is lost.
+
+    Returns:
+        (n_deleted, skipped_ids)
+        n_deleted: number of documents deleted.
+        skipped_ids: list of _id of documents left unshifted.
+    '''
+    n_deleted = 0
+    skipped_ids = []
+    start = 0
+    while start < len(batch):
+        try:
+            # Ordered, so a document only moves onto keys already vacated
+            collection.bulk_write(
+                [UpdateOne({'_id': friend['_id']},
+                           {'$set': {'post_date': friend['post_date'] - SHIFT,
+                                     SHIFTED_FIELD: friend['post_date']}})
+                 for friend in batch[start:]],
+                ordered=True
+            )
+            break
+        except BulkWriteError as e:
+            # An ordered bulk write stops at its first error
+            error = e.details['writeErrors'][0]
+            if error['code'] != DUPLICATE_KEY_ERROR_CODE:
+                raise
+            friend = batch[start + error['index']]
+            existing = collection.find_one({'friend_code': friend.get('friend_code'),
+                                            'post_date': friend['post_date'] - SHIFT})
+            if existing is not None and _is_same_post(friend, existing):
+                collection.delete_one({'_id': friend['_id']})
+                n_deleted += 1
+            else:
+                logger.warning('Skipped shifting post date onto another post. %s',
+                               json.dumps({'collection': collection.full_name,
+                                           '_id': str(friend['_id'])}))
+                skipped_ids.append(friend['_id'])
+            start += error['index'] + 1
+    return n_deleted, skipped_ids
+
+
+def _shift_inserted_before(collection, before_id):
+    '''Shifts documents inserted before before_id and not shifted yet.
+
+    Documents are shifted in ascending post date order, so one never moves
+    onto the key of another still waiting to be shifted.
+
+    Returns:
+        A dict of counts: n_shifted, n_deleted, n_skipped.
+    '''
+    skipped_ids = []
+    query = {'_id': {'$lt': before_id, '$nin': skipped_ids}, 'post_date': {'$ne': None},
+             SHIFTED_FIELD: {'$exists': False}}
+    counts = {'n_shifted': 0, 'n_deleted': 0, 'n_skipped': 0}
+    while True:
+        batch = list(collection.find(query)
+                               .sort('post_date', ASCENDING)
+                               .limit(BATCH_SIZE))
+        if not batch:
+            break
+        n_deleted, batch_skipped_ids = _shift_batch(collection, batch)
+        # Left at their post date, skip them too
+        skipped_ids.extend(batch_skipped_ids)
+        counts['n_shifted'] += len(batch) - n_deleted - len(batch_skipped_ids)
+        counts['n_deleted'] += n_deleted
+        counts['n_skipped'] += len(batch_skipped_ids)
+    return counts
+
+
+def _shift_derived(collection, raw_collection):
+    '''Shifts documents derived from shifted raw documents, whenever inserted.
+
+    Clean and failed documents take friend_code and post_date from raw
+    friend data, so one still at the post date a raw document was shifted
+    from is late too. These are inserted after deploying from friend data
+    stored before, e.g. by FailedDataRetrier, or by backfill_friends.py
+    from raw friend data restored by RawArchiver.
+
+    Returns:
+        A dict of counts: n_shifted, n_deleted, n_skipped.
+    '''
+    counts = {'n_shifted': 0, 'n_deleted': 0, 'n_skipped': 0}
+    cursor = (raw_collection.find({SHIFTED_FIELD: {'$exists': True}, 'friend_code': {'$ne': None}},
+                                  {'_id': 0, 'friend_code': 1, SHIFTED_FIELD: 1})
+                            .batch_size(BATCH_SIZE))
+    keys = []
+    for raw in cursor:
+        keys.append({'friend_code': raw['friend_code'], 'post_date': raw[SHIFTED_FIELD]})
+        if len(keys) == BATCH_SIZE:
+            _add_counts(counts, _shift_matching(collection, raw_collection, keys))
+            keys = []
+    if keys:
+        _add_counts(counts, _shift_matching(collection, raw_collection, keys))
+    return counts
+
+
+def _shift_matching(collection, raw_collection, keys):
+    '''Shifts documents not shifted yet at any of keys. See _shift_derived.'''
+    # Exact keys, each served by the friend_code and post_date index
+    query = {'$or': keys}
+    # A raw document still at the key is a post of its own, at the right time
+    raw_keys = {(raw['friend_code'], raw['post_date'])
+                for raw in raw_collection.find(query, {'_id': 0, 'friend_code': 1, 'post_date': 1})}
+    batch = sorted((friend for friend in collection.find(dict(query, **{SHIFTED_FIELD: {'$exists': False}}))
+                    if (friend['friend_code'], friend['post_date']) not in raw_keys),
+                   key=lambda friend: friend['post_date'])
+    n_deleted, skipped_ids = _shift_batch(collection, batch)
+    return {'n_shifted': len(batch) - n_deleted - len(skipped_ids),
+            'n_deleted': n_deleted, 'n_skipped': len(skipped_ids)}
+
+
+def _add_counts(counts, more_counts):
+    for key, count in more_counts.items():
+        counts[key] += count
+
+
+def shift_post_dates(deployed_at):
+    '''Moves post dates stored before they were read in Japan time back by SHIFT.
+
+    Friend data inserted before deployed_at has post dates 9 hours later than
+    the Japan time shown on gamewith. Left as is, they would be later than any
+    friend scraped since, and look already scraped. So do clean and failed
+    documents derived from it later, which _shift_derived finds through the
+    raw documents shifted.
+
+    Safe to interrupt and rerun, as shifted documents are stamped. Rerun it
+    after restoring raw archives written before it ran, then run
+    backfill_friends.py --restart. Counters of FriendStats are rebuilt
+    afterwards, as days change.
+
+    Args:
+        deployed_at:
+            An aware datetime, when post dates started to be read in Japan time.
+    '''
+    mongo_client = MongoClient(UMAFRIENDS_DB_URI, tz_aware=True)
+    uma_friends_db = mongo_client[UMAFRIENDS_DB]
+    raw_collection = uma_friends_db[RAW_GAMEWITH_FRIENDS_NS]
+    before_id = ObjectId.from_datetime(deployed_at)
+    # Raw first, as the others are matched against it
+    for ns in (RAW_GAMEWITH_FRIENDS_NS, UMA_FRIENDS_NS, FAILED_BUFFER_NS):
+        collection = uma_friends_db[ns]
+        logger.info('Started shifting post dates. %s',
+                    json.dumps({'collection': collection.full_name, 'before_id': str(before_id)}))
+        counts = _shift_inserted_before(collection, before_id)
+        if ns != RAW_GAMEWITH_FRIENDS_NS:
+            _add_counts(counts, _shift_derived(collection, raw_collection))
+        logger.info('Finished shifting post dates. %s',
+                    json.dumps(dict(counts, collection=collection.full_name)))
+    if FRIEND_STATS_NS:
+        FriendStats(uma_friends_db[FRIEND_STATS_NS]).rebuild(uma_friends_db[UMA_FRIENDS_NS])
+
+
+if __name__ == '__main__':
+    # python shift_post_dates.py <deployed at, e.g. 2026-10-17T03:00:00+00:00>
+    shift_post_dates(datetime.fromisoformat(sys.argv[1]))
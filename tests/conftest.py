@@ -0,0 +1,25 @@
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'mongod: needs a MongoDB server at localhost:27017, '
+                                       'e.g. to explain query plans, rather than a stand-in')
+
+
+def _has_mongod():
+    try:
+        MongoClient("localhost:27017", serverSelectionTimeoutMS=2000).admin.command('buildInfo')
+    except (PyMongoError, NotImplementedError):
+        return False
+    return True
+
+
+def pytest_collection_modifyitems(config, items):
+    marked = [item for item in items if item.get_closest_marker('mongod')]
+    if not marked or _has_mongod():
+        return
+    skip = pytest.mark.skip(reason='No MongoDB server at localhost:27017')
+    for item in marked:
+        item.add_marker(skip)
@@ -0,0 +1,50 @@
+'''Local HTTP stand-in for the websites we fetch from.'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+
+class StandInServer:
+    '''Serves responses from a handler function on a local port.
+
+    Usage:
+        def handle(path, query, headers):
+            return 200, {'Content-Type': 'application/json'}, b'{}'
+
+        with StandInServer(handle) as server:
+            requests.get(server.url + '/path')
+
+    Every request is recorded in server.requests as (path, query, headers).
+    '''
+    def __init__(self, handle):
+        self._handle = handle
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                headers = dict(self.headers)
+                stand_in.requests.append((url.path, query, headers))
+                status, response_headers, body = stand_in._handle(url.path, query, headers)
+                self.send_response(status)
+                for k, v in response_headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,110 @@
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+import pytest
+
+from uma_friends.bulk_writer import BulkWriter
+
+
+class CountingCollection:
+    '''Counts bulk_write calls of a pymongo Collection, passing everything through.'''
+    def __init__(self, collection):
+        self._collection = collection
+        self.n_bulk_writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, operations, ordered=True):
+        self.n_bulk_writes += 1
+        return self._collection.bulk_write(operations, ordered=ordered)
+
+
+@pytest.fixture
+def database():
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    database = mongo_client['test_uma_friends']
+    database.drop_collection('bulk_writer')
+    return database
+
+
+@pytest.fixture
+def collection(database):
+    return CountingCollection(database['bulk_writer'])
+
+
+@pytest.fixture
+def validated_collection(database):
+    # The server rejects friends marked bad, with an error other than a
+    # duplicate key
+    return database.create_collection('bulk_writer', validator={'bad': {'$exists': False}})
+
+
+def friend(friend_code, **kwargs):
+    return dict(friend_code=friend_code, post_date='2021-07-01', **kwargs)
+
+
+def friend_codes(collection):
+    return sorted(document['friend_code'] for document in collection.find({}))
+
+
+def test_write_counts_inserted_and_matched_in_chunks(collection):
+    writer = BulkWriter(collection, batch_size=2)
+
+    assert writer.write([friend(1), friend(2), friend(3)]) == \
+        {'n_inserted': 3, 'n_matched': 0, 'n_errored': 0}
+    assert writer.write([friend(2), friend(3), friend(4)]) == \
+        {'n_inserted': 1, 'n_matched': 2, 'n_errored': 0}
+    assert collection.n_bulk_writes == 4
+    assert friend_codes(collection) == [1, 2, 3, 4]
+
+
+def test_write_nothing(collection):
+    assert BulkWriter(collection).write([]) == {'n_inserted': 0, 'n_matched': 0, 'n_errored': 0}
+    assert collection.n_bulk_writes == 0
+
+
+@pytest.mark.mongod
+def test_write_raises_after_all_chunks(validated_collection):
+    writer = BulkWriter(validated_collection, batch_size=1)
+
+    with pytest.raises(BulkWriteError):
+        writer.write([friend(1, bad=True), friend(2)])
+    assert friend_codes(validated_collection) == [2]
+
+
+@pytest.mark.mongod
+def test_write_calls_back_with_inserted_only(validated_collection):
+    inserted = []
+    writer = BulkWriter(validated_collection, batch_size=2, on_insert=inserted.extend)
+    writer.write([friend(1)])
+
+    with pytest.raises(BulkWriteError):
+        writer.write([friend(1), friend(2), friend(3, bad=True)])
+    assert [document['friend_code'] for document in inserted] == [1, 2]
+
+
+@pytest.mark.mongod
+def test_replace_writes_over_existing(collection):
+    # Stand-ins report the upserted index of a replace wrong
+    inserted = []
+    writer = BulkWriter(collection, on_insert=inserted.extend)
+    writer.write([friend(1, comment='old')])
+
+    assert writer.replace([friend(1, comment='new'), friend(2)]) == \
+        {'n_inserted': 1, 'n_matched': 1, 'n_errored': 0}
+    assert collection.find_one({'friend_code': 1})['comment'] == 'new'
+    assert friend_codes(collection) == [1, 2]
+    assert [document['friend_code'] for document in inserted] == [1, 2]
+
+
+@pytest.mark.mongod
+def test_replace_calls_back_with_old_and_new(validated_collection):
+    replaced = []
+    writer = BulkWriter(validated_collection, batch_size=2,
+                        on_replace=lambda old, new: replaced.extend(zip(old, new)))
+    writer.write([friend(1, comment='old'), friend(2, comment='old')])
+
+    with pytest.raises(BulkWriteError):
+        writer.replace([friend(1, comment='new'), friend(2, bad=True), friend(3)])
+    assert [(old['comment'], new['comment']) for old, new in replaced] == [('old', 'new')]
+    assert validated_collection.find_one({'friend_code': 2})['comment'] == 'old'
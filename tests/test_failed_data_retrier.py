@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends.failed_data_retrier import FailedDataRetrier
+from uma_friends.game_data_snapshot import GameDataSnapshot
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+
+
+IMAGE_URL = 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png'
+
+
+@pytest.fixture
+def mongo_client():
+    return MongoClient("localhost:27017", tz_aware=True)
+
+
+@pytest.fixture
+def collections(mongo_client):
+    database = mongo_client['test_uma_friends']
+    database.drop_collection('failed')
+    database.drop_collection('clean')
+    return database['failed'], database['clean']
+
+
+@pytest.fixture
+def game_data_database(mongo_client):
+    database = mongo_client['test_uma_friends_game']
+    database.drop_collection('imports')
+    database['imports'].insert_one({'_id': 'url', 'sha256': 'v1',
+                                    'imported_at': datetime.now(timezone.utc)})
+    return database
+
+
+def normalizer_knowing(game_data_database, image_urls):
+    snapshot = GameDataSnapshot.from_documents(
+        [], [{'id': url, 'gwImgUrl': url} for url in image_urls], [], [])
+    return GamewithNormalizer(game_data_database, snapshot=snapshot)
+
+
+def friend(friend_code):
+    return {
+        'friend_code': friend_code,
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': IMAGE_URL,
+        'factors': None,
+        'comment': '',
+        'post_date': datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc)
+    }
+
+
+def test_retry_only_when_game_data_changed(collections, game_data_database):
+    failed_collection, clean_collection = collections
+    failed_collection.insert_one(friend('1'))
+
+    retrier = FailedDataRetrier(failed_collection, clean_collection,
+                                normalizer_knowing(game_data_database, []))
+    assert retrier.run() == {'n_fixed': 0, 'n_failed': 1}
+    retry = failed_collection.find_one()['retry']
+    assert retry['attempts'] == 1
+    assert retry['game_data_version'] == 'v1'
+    assert 'OutdatedError' in retry['last_error']
+
+    # Same game data, nothing is retried
+    assert retrier.run() == {'n_fixed': 0, 'n_failed': 0}
+
+    game_data_database['imports'].update_one({'_id': 'url'}, {'$set': {'sha256': 'v2'}})
+    retrier = FailedDataRetrier(failed_collection, clean_collection,
+                                normalizer_knowing(game_data_database, [IMAGE_URL]))
+    assert retrier.run() == {'n_fixed': 1, 'n_failed': 0}
+    assert failed_collection.count_documents({}) == 0
+    assert clean_collection.find_one()['main_uma'] == {'id': IMAGE_URL}
@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient, UpdateOne
+import pytest
+
+from uma_friends.friend_search import FriendSearch
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+from uma_friends.indexes import INDEXES
+
+
+POST_DATE = datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc)
+
+SORT_INDEX = 'post_date_-1__id_-1'
+FACTORS_INDEX = 'factors.name_1_factors.type_1_factors.level_1_main_uma.id_1_support.id_1'
+MAIN_UMA_FACTORS_INDEX = ('main_uma.factors.name_1_main_uma.factors.type_1_main_uma.factors.level_1'
+                          '_main_uma.id_1_support.id_1')
+
+# Each search with the only index its winning plan should scan
+SEARCHES = [
+    (FriendSearch(), SORT_INDEX),
+    (FriendSearch(main_uma_id='uma_a'), 'main_uma.id_1_support.id_1'),
+    (FriendSearch(support_id='support_a', support_limit=4), 'support.id_1_support.limit_1'),
+    # No index leads with support.limit, so it is filtered along the sort
+    (FriendSearch(support_limit=4), SORT_INDEX),
+    (FriendSearch(factors=[('スピード', 3)]), FACTORS_INDEX),
+    (FriendSearch(main_uma_factors=[('パワー', 2)], main_uma_id='uma_a'), MAIN_UMA_FACTORS_INDEX),
+    (FriendSearch(factors=[('スピード', 3), ('Pride of KING', 1)], support_id='support_a'), FACTORS_INDEX),
+    (FriendSearch(parent_ids=['uma_b']), 'parents.id_1'),
+    (FriendSearch(post_date_from=POST_DATE - timedelta(days=1), post_date_to=POST_DATE), SORT_INDEX)
+]
+
+
+def test_to_query():
+    search = FriendSearch(main_uma_id='uma_a', support_limit=4, factors=[('スピード', 3)],
+                          parent_ids=['uma_b'], post_date_from=POST_DATE)
+
+    assert search.to_query() == {'$and': [
+        {'main_uma.id': 'uma_a'},
+        {'support.limit': {'$gte': 4}},
+        {'factors': {'$elemMatch': {'name': 'スピード', 'level': {'$gte': 3}}}},
+        {'parents.id': {'$all': ['uma_b']}},
+        {'post_date': {'$gte': POST_DATE}}
+    ]}
+    assert FriendSearch().to_query() == {}
+    assert FriendSearch(main_uma_id='uma_a').to_query() == {'main_uma.id': 'uma_a'}
+
+
+def test_to_query_after():
+    assert FriendSearch().to_query(after=(POST_DATE, 'id_a')) == {'$or': [
+        {'post_date': {'$lt': POST_DATE}},
+        {'post_date': POST_DATE, '_id': {'$lt': 'id_a'}},
+        {'post_date': None}
+    ]}
+    # Past the last dated friend
+    assert FriendSearch().to_query(after=(None, 'id_a')) == {'post_date': None, '_id': {'$lt': 'id_a'}}
+
+
+N_FRIENDS = 200
+
+
+@pytest.fixture
+def collection():
+    # Conditions of SEARCHES match a few friends each, so that an index
+    # serving them beats scanning along the sort index
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    collection = mongo_client['test_uma_friends']['friend_search']
+    collection.drop()
+    collection.create_indexes(INDEXES['clean'])
+    collection.insert_many([{
+        'friend_code': str(i),
+        'post_date': POST_DATE - timedelta(minutes=i // 2),
+        'main_uma': {'id': 'uma_a' if i % 20 == 0 else 'uma_z',
+                     'factors': [{'name': 'パワー', 'type': 'blue', 'level': 2 if i % 40 == 0 else 1}]},
+        'support': {'id': 'support_a' if i % 25 == 0 else 'support_z', 'limit': 4 if i % 2 == 0 else 2},
+        'factors': ([{'name': 'スピード', 'type': 'blue', 'level': 3 if i % 30 == 0 else 1}]
+                    + ([{'name': 'Pride of KING', 'type': 'unique_skill', 'level': 1}] if i % 60 == 0 else [])),
+        'parents': [{'id': 'uma_b' if i % 50 == 0 else 'uma_y', 'factors': None}]
+    } for i in range(N_FRIENDS)])
+    collection.bulk_write([UpdateOne({'_id': friend['_id']},
+                                     {'$set': {'summary': GamewithNormalizer.summarize(friend)}})
+                           for friend in collection.find()])
+    # Without post date, sorted after every dated friend
+    collection.insert_many([{
+        'friend_code': str(i),
+        'post_date': None,
+        'main_uma': {'id': 'uma_a', 'factors': []},
+        'support': None,
+        'factors': [],
+        'parents': []
+    } for i in range(N_FRIENDS, N_FRIENDS + 3)])
+    return collection
+
+
+def stages(plan):
+    yield plan['stage']
+    for key in ('inputStage', 'inputStages'):
+        children = plan.get(key, [])
+        for child in children if isinstance(children, list) else [children]:
+            yield from stages(child)
+
+
+def index_names(plan):
+    yield plan.get('indexName')
+    for key in ('inputStage', 'inputStages'):
+        children = plan.get(key, [])
+        for child in children if isinstance(children, list) else [children]:
+            yield from index_names(child)
+
+
+# Query plans are only meaningful from a real server
+@pytest.mark.mongod
+@pytest.mark.parametrize('search, index_name', SEARCHES)
+def test_search_uses_index(collection, search, index_name):
+    for after in (None, (POST_DATE, collection.find_one()['_id'])):
+        explain = collection.find(search.to_query(after)).sort(FriendSearch.SORT).limit(20).explain()
+        winning_plan = explain['queryPlanner']['winningPlan']
+        # Servers with the slot based engine nest the plan one level deeper
+        winning_plan = winning_plan.get('queryPlan', winning_plan)
+        assert 'COLLSCAN' not in set(stages(winning_plan))
+        assert set(index_names(winning_plan)) - {None} == {index_name}
+
+
+def test_find_pages(collection):
+    search = FriendSearch(main_uma_id='uma_a')
+    friends, after = search.find(collection, page_size=3)
+    seen = [friend['_id'] for friend in friends]
+    while after is not None:
+        friends, after = search.find(collection, page_size=3, after=after)
+        seen.extend(friend['_id'] for friend in friends)
+
+    # 10 dated friends of uma_a, then 3 without post date
+    assert len(seen) == len(set(seen)) == 13
+
+
+def test_rank_by_stars(collection):
+    friends = FriendSearch().rank_by_stars(collection, limit=5)
+    # Friends with speed 3 rank first, newest first
+    assert [friend['friend_code'] for friend in friends] == ['0', '30', '60', '90', '120']
+
+    friends = FriendSearch(main_uma_id='uma_a').rank_by_stars(collection, limit=3)
+    assert [friend['friend_code'] for friend in friends] == ['0', '60', '120']
+
+
+@pytest.mark.mongod
+def test_rank_by_stars_uses_index(collection):
+    explain = (collection.find({}).sort([('summary.stars.blue', -1), ('post_date', -1)])
+                         .limit(20).explain())
+    winning_plan = explain['queryPlanner']['winningPlan']
+    winning_plan = winning_plan.get('queryPlan', winning_plan)
+    assert 'SORT' not in set(stages(winning_plan))
+    assert set(index_names(winning_plan)) - {None} == {'summary.stars.blue_-1_post_date_-1'}
@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends.friend_stats import FriendStats
+
+
+@pytest.fixture
+def stats_collection():
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    stats_collection = mongo_client['test_uma_friends']['friend_stats']
+    stats_collection.drop()
+    return stats_collection
+
+
+def test_count():
+    friend = {
+        # 07/16 00:30 in Japan
+        'post_date': datetime(2021, 7, 15, 15, 30, tzinfo=timezone.utc),
+        'main_uma': {'id': 'uma_a'},
+        'support': {'id': 'support_a', 'limit': 4},
+        'factors': [{'name': 'スピード', 'type': 'blue', 'level': 3}]
+    }
+    no_main_uma = dict(friend, main_uma=None, support=None, factors=None)
+
+    counts = FriendStats._count([friend, friend, no_main_uma])
+
+    assert counts == {
+        ('2021-07-16', 'main_uma', (('id', 'uma_a'),)): 2,
+        ('2021-07-16', 'support', (('id', 'support_a'), ('limit', 4))): 2,
+        ('2021-07-16', 'factor', (('name', 'スピード'), ('level', 3))): 2
+    }
+
+
+def test_replace_moves_counts_of_changed_friends(stats_collection):
+    friend_stats = FriendStats(stats_collection)
+    old_friend = {
+        'post_date': datetime(2021, 7, 15, 3, 0, tzinfo=timezone.utc),
+        'main_uma': {'id': 'uma_a'},
+        'support': None,
+        'factors': [{'name': 'スピード', 'type': 'blue', 'level': 3}]
+    }
+    new_friend = dict(old_friend, factors=[{'name': 'スピード', 'type': 'blue', 'level': 4}])
+    friend_stats.add([old_friend])
+
+    friend_stats.replace([old_friend], [new_friend])
+
+    day = ('day', '2021-07-15')
+    counts = {tuple(counter['_id'].items()): counter['count'] for counter in stats_collection.find({})}
+    assert counts == {
+        (day, ('kind', 'main_uma'), ('id', 'uma_a')): 1,
+        (day, ('kind', 'factor'), ('name', 'スピード'), ('level', 3)): 0,
+        (day, ('kind', 'factor'), ('name', 'スピード'), ('level', 4)): 1
+    }
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends import friends_backfiller
+from uma_friends.friends_backfiller import FriendsBackfiller
+
+
+DB_URI = 'localhost:27017'
+GAME_DATA_DB = 'test_uma_friends_backfill_game'
+IMAGE_URL = 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png'
+UNKNOWN_IMAGE_URL = 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_999.png'
+
+
+class InProcessExecutor:
+    '''Stands in for ProcessPoolExecutor, running batches in this process.
+
+    A batch runs when its result is asked for, so batches submitted but not
+    committed yet are counted in flight.
+    '''
+    instances = []
+
+    def __init__(self, max_workers, mp_context, initializer, initargs):
+        initializer(*initargs)
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+        self.result_order = []
+        InProcessExecutor.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, function, batch):
+        self.n_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        return InProcessFuture(self, len(self.result_order) + self.n_in_flight - 1, function, batch)
+
+
+class InProcessFuture:
+    def __init__(self, executor, index, function, batch):
+        self._executor = executor
+        self._index = index
+        self._function = function
+        self._batch = batch
+
+    def result(self):
+        self._executor.n_in_flight -= 1
+        self._executor.result_order.append(self._index)
+        return self._function(self._batch)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    monkeypatch.setattr(friends_backfiller, 'ProcessPoolExecutor', InProcessExecutor)
+    InProcessExecutor.instances = []
+    mongo_client = MongoClient(DB_URI, tz_aware=True)
+    mongo_client.drop_database(GAME_DATA_DB)
+    game_data_database = mongo_client[GAME_DATA_DB]
+    game_data_database['players'].insert_one({'id': 'U25', 'gwImgUrl': IMAGE_URL})
+    game_data_database['imports'].insert_one({'_id': 'url', 'sha256': 'v1',
+                                              'imported_at': datetime.now(timezone.utc)})
+    mongo_client.drop_database('test_uma_friends_backfill')
+    return mongo_client['test_uma_friends_backfill']
+
+
+def make_backfiller(database, batch_size=2):
+    return FriendsBackfiller(DB_URI, database['raw'], database['clean'], database['failed'],
+                             database['checkpoints'], GAME_DATA_DB,
+                             batch_size=batch_size, max_workers=1)
+
+
+def friend(friend_code, image_url=IMAGE_URL, comment=''):
+    return {
+        'friend_code': friend_code,
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': image_url,
+        'factors': None,
+        'comment': comment,
+        'post_date': datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc) + timedelta(minutes=int(friend_code))
+    }
+
+
+def test_run(database):
+    raw_friends = [friend(str(i)) for i in range(7)]
+    raw_friends[4] = friend('4', image_url=UNKNOWN_IMAGE_URL)
+    database['raw'].insert_many([dict(raw_friend) for raw_friend in raw_friends])
+    # Normalized by an older normalizer
+    database['clean'].insert_one(dict(friend('1'), main_uma={'id': None}))
+    # Failed with older game data
+    database['failed'].insert_one(dict(friend('2'), retry={'attempts': 1, 'game_data_version': 'v0'}))
+
+    make_backfiller(database).run()
+
+    assert sorted(clean['friend_code'] for clean in database['clean'].find()) == ['0', '1', '2', '3', '5', '6']
+    assert database['clean'].find_one({'friend_code': '1'})['main_uma'] == {'id': 'U25'}
+    failed = list(database['failed'].find())
+    assert [document['friend_code'] for document in failed] == ['4']
+    assert failed[0]['retry']['attempts'] == 1
+    assert failed[0]['retry']['game_data_version'] == 'v1'
+    assert 'OutdatedError' in failed[0]['retry']['last_error']
+
+    last_raw_id = database['raw'].find_one(sort=[('_id', -1)])['_id']
+    assert database['checkpoints'].find_one({'_id': 'backfill'})['last_id'] == last_raw_id
+    executor, = InProcessExecutor.instances
+    # 4 batches, committed in order, at most _MAX_PENDING = 2 in flight
+    assert executor.result_order == [0, 1, 2, 3]
+    assert executor.max_in_flight == 2
+
+
+def test_run_resumes_from_checkpoint(database):
+    database['raw'].insert_many([friend(str(i)) for i in range(5)])
+    raw_ids = [raw['_id'] for raw in database['raw'].find().sort('_id', 1)]
+    database['checkpoints'].insert_one({'_id': 'backfill', 'last_id': raw_ids[2]})
+
+    make_backfiller(database).run()
+
+    assert sorted(clean['friend_code'] for clean in database['clean'].find()) == ['3', '4']
+    assert database['checkpoints'].find_one({'_id': 'backfill'})['last_id'] == raw_ids[-1]
+
+    make_backfiller(database).run(restart=True)
+
+    assert database['clean'].count_documents({}) == 5
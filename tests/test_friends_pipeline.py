@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from uma_friends.friends_pipeline import FriendsPipeline, PipelineError
+
+
+def clean(batch):
+    return [x for x in batch if x % 2 == 0], [x for x in batch if x % 2 == 1]
+
+
+def test_pipeline_writes_everything_in_batches():
+    written = []
+
+    def write(friends_data, cleaned_data_list, failed_data_list):
+        written.append((friends_data, cleaned_data_list, failed_data_list))
+
+    with FriendsPipeline(clean, write, batch_size=4, queue_size=1) as pipeline:
+        for i in range(0, 10, 3):
+            pipeline.put(list(range(i, min(i + 3, 10))))
+
+    assert [friends_data for friends_data, _, _ in written] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert written[0][1:] == ([0, 2], [1, 3])
+
+
+def test_pipeline_flushes_partial_batch_after_interval():
+    written = []
+
+    def write(friends_data, cleaned_data_list, failed_data_list):
+        written.append(friends_data)
+
+    with FriendsPipeline(clean, write, batch_size=100, flush_interval=0.01) as pipeline:
+        pipeline.put([1, 2])
+        while not written:
+            time.sleep(0.01)
+        pipeline.put([3])
+
+    assert written == [[1, 2], [3]]
+
+
+def test_pipeline_stage_failure():
+    def write(friends_data, cleaned_data_list, failed_data_list):
+        raise RuntimeError('database is down')
+
+    with pytest.raises(PipelineError):
+        with FriendsPipeline(clean, write, batch_size=1, queue_size=1) as pipeline:
+            for i in range(100):
+                pipeline.put([i])
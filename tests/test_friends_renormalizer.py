@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends.friends_renormalizer import FriendsRenormalizer
+from uma_friends.gamewith_normalizer import GamewithNormalizer
+
+
+IMAGE_URL = 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png'
+
+
+@pytest.fixture
+def mongo_client():
+    return MongoClient("localhost:27017", tz_aware=True)
+
+
+@pytest.fixture
+def database(mongo_client):
+    mongo_client.drop_database('test_uma_friends_renormalize')
+    return mongo_client['test_uma_friends_renormalize']
+
+
+@pytest.fixture
+def game_data_database(mongo_client):
+    mongo_client.drop_database('test_uma_friends_renormalize_game')
+    database = mongo_client['test_uma_friends_renormalize_game']
+    database['supports'].insert_many([{'id': 'S1', 'gwId': '262813'}, {'id': 'S2', 'gwId': '262814'}])
+    database['players'].insert_one({'id': 'U25', 'gwImgUrl': IMAGE_URL})
+    database['skills'].insert_many([{'id': 'K1', 'name': '末脚'}, {'id': 'K2', 'name': '末脚の極み'}])
+    database['races'].insert_one({'id': 'R1', 'name': '東京優駿'})
+    return database
+
+
+def friend(friend_code, support_id=None, factors=None):
+    return {
+        'friend_code': friend_code,
+        'support_id': support_id,
+        'support_limit': None,
+        'character_image_url': IMAGE_URL,
+        'factors': factors,
+        'comment': '',
+        'post_date': datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc) + timedelta(minutes=int(friend_code))
+    }
+
+
+RAW_FRIENDS = [
+    friend('1', support_id='262814'),
+    friend('2', factors=['東京優駿1']),
+    friend('3', factors=['末脚3(代表2)']),
+    # Starts with a changed name, but is another skill
+    friend('4', factors=['末脚の極み1', '東京優駿ステークス1']),
+    friend('5', support_id='262813', factors=['スピード3(代表3)'])
+]
+
+CHANGES = [
+    # A new support
+    {'support_gw_ids': ['262814'], 'image_urls': [], 'factor_names': []},
+    # A renamed race
+    {'support_gw_ids': [], 'image_urls': [], 'factor_names': ['東京優駿']},
+    # A new skill
+    {'support_gw_ids': [], 'image_urls': [], 'factor_names': ['末脚']}
+]
+
+
+@pytest.fixture
+def renormalizer(database, game_data_database):
+    database['raw'].insert_many([dict(raw_friend) for raw_friend in RAW_FRIENDS])
+    return FriendsRenormalizer(database['raw'], database['clean'], database['failed'],
+                               game_data_database['changes'], GamewithNormalizer(game_data_database))
+
+
+@pytest.mark.parametrize('changes, friend_codes', list(zip(CHANGES, [['1'], ['2'], ['3']])))
+def test_build_query(database, renormalizer, changes, friend_codes):
+    query = renormalizer._build_query(changes)
+    assert sorted(raw['friend_code'] for raw in database['raw'].find(query)) == friend_codes
+
+
+def test_build_query_no_changes(database, renormalizer):
+    query = renormalizer._build_query({'support_gw_ids': [], 'image_urls': [], 'factor_names': []})
+    assert database['raw'].count_documents(query) == 0
+
+
+def test_run(database, game_data_database, renormalizer):
+    # Failed before its support was added
+    database['failed'].insert_one(dict(RAW_FRIENDS[0]))
+    # Normalized before the race was renamed
+    database['clean'].insert_one(dict(friend('2'), factors=None))
+    game_data_database['changes'].insert_many(
+        [dict(changes, created_at=datetime(2021, 7, 16, i, tzinfo=timezone.utc), renormalized=False)
+         for i, changes in enumerate(CHANGES)])
+
+    renormalizer.run()
+
+    assert sorted(clean['friend_code'] for clean in database['clean'].find()) == ['1', '2', '3']
+    assert database['clean'].find_one({'friend_code': '1'})['support'] == {'id': 'S2'}
+    assert database['clean'].find_one({'friend_code': '2'})['factors'] == \
+        [{'name': '東京優駿', 'type': 'race', 'level': 1}]
+    assert database['failed'].count_documents({}) == 0
+    for changes in game_data_database['changes'].find():
+        assert changes['renormalized']
+        assert changes['counts'] == {'n_cleaned': 1, 'n_failed': 0}
+
+    # Nothing pending
+    database['clean'].delete_many({})
+    renormalizer.run()
+    assert database['clean'].count_documents({}) == 0
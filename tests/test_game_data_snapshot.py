@@ -0,0 +1,98 @@
+import pytest
+
+from uma_friends.game_data_snapshot import GameDataSnapshot
+from uma_friends.gamewith_normalizer import GamewithNormalizer, OutdatedError
+
+
+SUPPORTS = [{'id': 'support_a', 'gwId': '262813'}]
+PLAYERS = [
+    {
+        'id': 'uma_a',
+        'gwImgUrl': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png',
+        'uniqueSkillList': ['unique_a']
+    },
+    {
+        'id': 'uma_b',
+        'gwImgUrl': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_26.png',
+        'uniqueSkillList': ['unique_b']
+    }
+]
+SKILLS = [
+    {'id': 'unique_a', 'name': 'Pride of KING', 'rare': '固有'},
+    {'id': 'unique_b', 'name': 'Shadow Break', 'rare': '固有'},
+    {'id': 'common_a', 'name': '集中力', 'rare': '普通'}
+]
+RACES = [{'id': 'race_a', 'name': '有馬記念'}]
+
+
+@pytest.fixture
+def snapshot():
+    return GameDataSnapshot.from_documents(SUPPORTS, PLAYERS, SKILLS, RACES)
+
+
+@pytest.fixture
+def normalizer(snapshot):
+    # No database: every lookup must be served by the snapshot
+    return GamewithNormalizer(None, snapshot=snapshot)
+
+
+def test_snapshot_lookups(normalizer):
+    assert normalizer._find_support_id_by_gamewith_id('262813') == 'support_a'
+    assert normalizer._find_skill_id_and_uniqueness_by_name('集中力') == ('common_a', False)
+    assert normalizer._find_skill_id_and_uniqueness_by_name('FAKE SKILL') == (None, False)
+    assert normalizer._find_uma_id_by_unique_skill('unique_b') == 'uma_b'
+    assert normalizer._find_race_id_by_name('有馬記念') == 'race_a'
+    assert normalizer._find_race_id_by_name('FAKE RACE') is None
+
+
+def test_snapshot_lookup_not_exist(normalizer):
+    with pytest.raises(OutdatedError):
+        normalizer._find_support_id_by_gamewith_id('000000')
+    with pytest.raises(OutdatedError):
+        normalizer._find_uma_id_by_image_url('https://img.gamewith.jp/fake.png')
+
+
+def test_normalize_with_snapshot(normalizer):
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': '262813',
+        'support_limit': '4凸',
+        'character_image_url': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png',
+        'factors': [
+            'パワー3(代表3)',
+            'Pride of KING1(代表1)',
+            'Shadow Break1',
+            '有馬記念1'
+        ],
+        'comment': '',
+        'post_date': None
+    }
+
+    friend = normalizer.normalize(friend_data)
+
+    assert friend['support'] == {'id': 'support_a', 'limit': 4}
+    assert friend['main_uma']['id'] == 'uma_a'
+    assert [factor['name'] for factor in friend['main_uma']['factors']] == ['パワー', 'Pride of KING']
+    assert [factor['type'] for factor in friend['factors']] == ['blue', 'unique_skill', 'unique_skill', 'race']
+    assert friend['parents'] == [{
+        'id': 'uma_b',
+        'factors': {'name': 'Shadow Break', 'type': 'unique_skill', 'level': 1}
+    }]
+
+
+def test_normalize_many_with_snapshot(normalizer):
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': '262813',
+        'support_limit': '4凸',
+        'character_image_url': None,
+        'factors': None,
+        'comment': '',
+        'post_date': None
+    }
+    outdated_friend_data = dict(friend_data, support_id='000000')
+
+    cleaned_data_list, failed_data_list = normalizer.normalize_many([friend_data, outdated_friend_data])
+
+    assert [friend['support'] for friend in cleaned_data_list] == [{'id': 'support_a', 'limit': 4}]
+    assert failed_data_list == [outdated_friend_data]
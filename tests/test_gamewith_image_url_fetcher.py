@@ -0,0 +1,102 @@
+from datetime import datetime, timezone
+
+from pymongo import MongoClient
+import pytest
+import requests
+
+from uma_friends.gamewith_image_url_fetcher import GamewithImageUrlFetcher, ImageUrlError
+from tests.stand_in_server import StandInServer
+
+
+ARTICLE_HTML = '''
+<html><body>
+<div class="uma_joubu">
+  <a href="{url}"><img src="lazy.png"
+    data-original="https://img.gamewith.jp/article_tools/uma-musume/gacha/i_{gw_id}.png"></a>
+  <a href="{url}/other"><img data-original="other.png"></a>
+</div>
+</body></html>
+'''
+
+
+def test_fetch_all():
+    failed_once = set()
+
+    def handle(path, query, headers):
+        gw_id = path.split('/')[-1]
+        # Every page fails once before succeeding
+        if gw_id not in failed_once:
+            failed_once.add(gw_id)
+            return 503, {}, b''
+        page = ARTICLE_HTML.format(url=server.url + path, gw_id=gw_id)
+        return 200, {'Content-Type': 'text/html'}, page.encode('utf-8')
+
+    with StandInServer(handle) as server:
+        fetcher = GamewithImageUrlFetcher(server.url + '/article/show', max_workers=4,
+                                          backoff_factor=0, requests_per_second=1000)
+        image_urls = fetcher.fetch_all(['264389', '264390', '264391'])
+
+    assert image_urls == {
+        gw_id: f'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_{gw_id}.png'
+        for gw_id in ['264389', '264390', '264391']
+    }
+    assert len(server.requests) == 6
+
+
+@pytest.fixture
+def cache_collection():
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    cache_collection = mongo_client['test_uma_friends']['image_url_cache']
+    cache_collection.drop()
+    return cache_collection
+
+
+def test_fetch_all_caches_successes_of_failed_run(cache_collection):
+    def handle(path, query, headers):
+        gw_id = path.split('/')[-1]
+        if gw_id == '264390':
+            return 404, {}, b''
+        page = ARTICLE_HTML.format(url=server.url + path, gw_id=gw_id)
+        return 200, {'Content-Type': 'text/html', 'ETag': f'"{gw_id}"'}, page.encode('utf-8')
+
+    with StandInServer(handle) as server:
+        fetcher = GamewithImageUrlFetcher(server.url + '/article/show', max_workers=4,
+                                          requests_per_second=1000,
+                                          cache_collection=cache_collection)
+        with pytest.raises(requests.HTTPError):
+            fetcher.fetch_all(['264389', '264390', '264391'])
+
+    assert sorted(entry['_id'] for entry in cache_collection.find({})) == ['264389', '264391']
+    assert cache_collection.find_one({'_id': '264391'})['etag'] == '"264391"'
+
+
+def test_fetch_not_found():
+    def handle(path, query, headers):
+        return 200, {'Content-Type': 'text/html'}, b'<html><body><div class="uma_joubu"></div></body></html>'
+
+    with StandInServer(handle) as server:
+        fetcher = GamewithImageUrlFetcher(server.url + '/article/show/')
+        with pytest.raises(ImageUrlError):
+            fetcher.fetch('264389')
+
+
+def test_fetch_entry_revalidate():
+    def handle(path, query, headers):
+        if headers.get('If-None-Match') == '"v1"':
+            return 304, {'ETag': '"v1"'}, b''
+        page = ARTICLE_HTML.format(url=server.url + path, gw_id='264389')
+        return 200, {'Content-Type': 'text/html', 'ETag': '"v1"'}, page.encode('utf-8')
+
+    with StandInServer(handle) as server:
+        fetcher = GamewithImageUrlFetcher(server.url + '/article/show')
+        entry, not_modified = fetcher.fetch_entry('264389')
+        assert not not_modified
+        assert entry['etag'] == '"v1"'
+
+        cached_entry = dict(entry, checked_at=datetime(2021, 7, 1, tzinfo=timezone.utc))
+        revalidated_entry, not_modified = fetcher.fetch_entry('264389', cached_entry)
+
+    assert not_modified
+    assert revalidated_entry['gwImgUrl'] == entry['gwImgUrl']
+    assert revalidated_entry['checked_at'] > cached_entry['checked_at']
+    assert server.requests[1][2]['If-None-Match'] == '"v1"'
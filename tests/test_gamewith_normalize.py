@@ -1,7 +1,11 @@
+from datetime import datetime
+
 from pymongo import MongoClient
 import pytest
 
+from uma_friends.game_data_snapshot import GameDataSnapshot
 from uma_friends.gamewith_normalizer import GamewithNormalizer
+from tests.test_game_data_snapshot import PLAYERS, RACES, SKILLS, SUPPORTS
 
 
 @pytest.fixture
@@ -17,6 +21,38 @@ def normalizer(database):
     return GamewithNormalizer(database)
 
 
+@pytest.fixture
+def snapshot_normalizer():
+    # No database: every lookup must be served by the snapshot
+    return GamewithNormalizer(None, snapshot=GameDataSnapshot.from_documents(SUPPORTS, PLAYERS, SKILLS, RACES))
+
+
+@pytest.fixture
+def seeded_database():
+    mongo_client = MongoClient("localhost:27017")
+    mongo_client.drop_database('test_uma_friends_normalize')
+    database = mongo_client['test_uma_friends_normalize']
+    database['supports'].insert_many([dict(support) for support in SUPPORTS])
+    database['players'].insert_many([dict(player) for player in PLAYERS])
+    database['skills'].insert_many([dict(skill) for skill in SKILLS])
+    database['races'].insert_many([dict(race) for race in RACES])
+    return database
+
+
+class InMemoryCollection:
+    '''Serves the {field: {'$in': values}} finds of GameDataSnapshot.load_subset.'''
+    def __init__(self, documents):
+        self._documents = documents
+
+    def find(self, query, projection=None):
+        (field, condition), = query.items()
+        values = set(condition['$in'])
+        for document in self._documents:
+            value = document.get(field)
+            if set(value if isinstance(value, list) else [value]) & values:
+                yield document
+
+
 def test_find_skill_id_and_uniqueness_by_name_common(normalizer):
     skill_name = 'ギアシフト'
     skill_id = 'kjP0LurWRte'
@@ -97,7 +133,7 @@ def test_find_race_id_by_name_not_exist(normalizer):
     assert normalizer._cache['find_race_by_name'][race_name] is None
 
 
-def test_parse_factors(normalizer):
+def test_split_factors(normalizer):
     factor_string_list = [
         'パワー3(代表3)',
         'スタミナ6',
@@ -180,7 +216,157 @@ def test_parse_factors(normalizer):
         }
     ]
 
-    result_factors = normalizer._parse_factors(factor_string_list)
+    main_uma_factors, total_factors = normalizer._split_factors(factor_string_list)
 
     assert len(factors) == 12
-    assert result_factors == factors
+    assert total_factors == [{'name': factor['name'], 'type': factor['type'], 'level': factor['total_level']}
+                             for factor in factors]
+    assert main_uma_factors == [{'name': factor['name'], 'type': factor['type'], 'level': factor['main_level']}
+                                for factor in factors if 'main_level' in factor]
+
+
+def test_normalize_many(normalizer):
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': None,
+        'factors': None,
+        'comment': '',
+        'post_date': None
+    }
+    outdated_friend_data = dict(friend_data, character_image_url='https://img.gamewith.jp/fake.png')
+
+    cleaned_data_list, failed_data_list = normalizer.normalize_many([friend_data, outdated_friend_data])
+
+    assert len(cleaned_data_list) == 1
+    assert failed_data_list == [outdated_friend_data]
+    # Snapshot only lives during the batch
+    assert normalizer._snapshot is None
+
+
+def test_normalize_many_isolates_malformed_factor():
+    game_data_database = {'supports': InMemoryCollection(SUPPORTS),
+                          'players': InMemoryCollection(PLAYERS),
+                          'skills': InMemoryCollection(SKILLS),
+                          'races': InMemoryCollection(RACES)}
+    normalizer = GamewithNormalizer(game_data_database)
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': '262813',
+        'support_limit': '4凸',
+        'character_image_url': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png',
+        'factors': ['パワー3(代表3)', 'Shadow Break1'],
+        'comment': '',
+        'post_date': None
+    }
+    malformed_friend_data = dict(friend_data, friend_code='000000000', factors=['スピード', '集中力1'])
+    errors = []
+
+    cleaned_data_list, failed_data_list = normalizer.normalize_many(
+        [friend_data, malformed_friend_data, dict(friend_data, friend_code='111111111')], errors)
+
+    assert [friend['friend_code'] for friend in cleaned_data_list] == ['248605600', '111111111']
+    assert cleaned_data_list[0]['parents'][0]['id'] == 'uma_b'
+    assert failed_data_list == [malformed_friend_data]
+    assert errors == ['ValueError("Malformed factor: \'スピード\'")']
+
+
+def test_normalize_many_leaves_normalizer_as_is():
+    game_data_database = {'supports': InMemoryCollection(SUPPORTS),
+                          'players': InMemoryCollection(PLAYERS),
+                          'skills': InMemoryCollection(SKILLS),
+                          'races': InMemoryCollection(RACES)}
+    normalizer = GamewithNormalizer(game_data_database)
+    # What a caller sharing the normalizer would see while a batch is normalized
+    snapshots_seen = []
+
+    def find_uma_id_by_image_url(image_url):
+        snapshots_seen.append(normalizer._snapshot)
+        return 'uma_a'
+
+    normalizer._find_uma_id_by_image_url = find_uma_id_by_image_url
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png',
+        'factors': None,
+        'comment': '',
+        'post_date': None
+    }
+
+    cleaned_data_list, _ = normalizer.normalize_many([friend_data])
+
+    assert cleaned_data_list[0]['main_uma'] == {'id': 'uma_a'}
+    assert snapshots_seen == [None]
+
+
+def test_parse_factor_fields(snapshot_normalizer):
+    assert snapshot_normalizer._parse_factor_fields('URAシナリオ6(代表3)') == ('URAシナリオ', 'ura', 6, 3)
+    # Names may end with digits
+    assert snapshot_normalizer._parse_factor_fields('紅焔ギア/LP1211-M1') == ('紅焔ギア/LP1211-M', 'race', 1, None)
+    assert snapshot_normalizer._parse_factor_fields('集中力2')[1] == 'common_skill'
+    with pytest.raises(ValueError):
+        snapshot_normalizer._parse_factor_fields('パワー')
+
+
+def test_summarize():
+    friend = {
+        'factors': [
+            {'name': 'スピード', 'type': 'blue', 'level': 2},
+            {'name': 'パワー', 'type': 'blue', 'level': 3},
+            {'name': 'マイル', 'type': 'distance', 'level': 3},
+            {'name': 'Shadow Break', 'type': 'unique_skill', 'level': 1}
+        ],
+        'parents': [{'id': 'uma_b', 'factors': None}, {'id': None, 'factors': None}]
+    }
+
+    summary = GamewithNormalizer.summarize(friend)
+
+    assert summary['stars'] == {'blue': 5, 'field_type': 0, 'distance': 3, 'strategy': 0, 'ura': 0,
+                                'unique_skill': 1, 'common_skill': 0, 'race': 0}
+    assert summary['factor_levels'] == ['Shadow Break:1', 'スピード:2', 'パワー:3', 'マイル:3']
+    assert summary['parent_ids'] == ['uma_b']
+    assert GamewithNormalizer.summarize({'factors': None, 'parents': None}) == \
+        {'stars': GamewithNormalizer._NO_STARS, 'factor_levels': [], 'parent_ids': []}
+
+
+def test_lookup_cache_is_bounded(seeded_database):
+    normalizer = GamewithNormalizer(seeded_database, cache_size=2)
+
+    for skill_name in ['Pride of KING', 'Shadow Break', 'Pride of KING', 'FAKE SKILL']:
+        normalizer._find_skill_id_and_uniqueness_by_name(skill_name)
+
+    cache = normalizer._cache['find_skill_by_name']
+    # Shadow Break was least recently used
+    assert set(cache) == {'Pride of KING', 'FAKE SKILL'}
+    assert normalizer.cache_stats()['find_skill_by_name'] == \
+        {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2}
+    assert normalizer.cache_stats()['find_race_by_name'] == \
+        {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
+
+
+def test_normalize_picks_up_game_data_changes(seeded_database, monkeypatch):
+    seeded_database['imports'].insert_one({'_id': 'url', 'sha256': 'v1', 'imported_at': datetime(2021, 7, 15)})
+    normalizer = GamewithNormalizer(seeded_database)
+    friend_data = {
+        'friend_code': '248605600',
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': PLAYERS[0]['gwImgUrl'],
+        'factors': ['末脚2', 'Shadow Break1'],
+        'comment': '',
+        'post_date': None
+    }
+    assert [factor['type'] for factor in normalizer.normalize(friend_data)['factors']] == \
+        ['race', 'unique_skill']
+
+    seeded_database['skills'].insert_one({'id': 'common_b', 'name': '末脚', 'rare': '普通'})
+    seeded_database['imports'].replace_one({'_id': 'url'}, {'sha256': 'v2', 'imported_at': datetime(2021, 7, 16)})
+    # Not checked again until _VERSION_CHECK_INTERVAL passes
+    assert normalizer.normalize(friend_data)['factors'][0]['type'] == 'race'
+
+    monkeypatch.setattr(GamewithNormalizer, '_VERSION_CHECK_INTERVAL', 0)
+    assert normalizer.normalize(friend_data)['factors'][0]['type'] == 'common_skill'
+    assert normalizer.cache_stats()['find_skill_by_name']['evictions'] == 0
@@ -0,0 +1,304 @@
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+
+import pytest
+
+from uma_friends import gamewith_scraper
+from uma_friends.gamewith_scraper import FRIEND_CLASS, GamewithScraper
+from uma_friends.post_date_resolver import PostDateResolver
+
+
+FRIEND_HTML = '''
+<li class="-r-uma-musume-friends-list-item">
+  <div class="-r-uma-musume-friends-list-item__trainerId">
+    <span class="-r-uma-musume-friends-list-item__trainerId__text"> 248605600 </span>
+  </div>
+  <div class="-r-uma-musume-friends-list-item__support-wrap">
+    <a href="https://gamewith.jp/uma-musume/article/show/262813"><img src="support.png"></a>
+    <span class="-r-uma-musume-friends-list-item__limitNumber">4凸</span>
+  </div>
+  <div class="-r-uma-musume-friends-list-item__mainUmaMusume-wrap">
+    <img src="https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png">
+  </div>
+  <ul class="-r-uma-musume-friends-list-item__factor-list">
+    <li class="-r-uma-musume-friends-list-item__factor-list__item">パワー3(代表3)</li>
+    <li class="-r-uma-musume-friends-list-item__factor-list__item">スタミナ6</li>
+  </ul>
+  <p class="-r-uma-musume-friends-list-item__comment">スタミナ6
+パワー3</p>
+  <span class="-r-uma-musume-friends-list-item__postDate">07/15 19:09</span>
+</li>
+'''
+
+EMPTY_FRIEND_HTML = '''
+<li class="-r-uma-musume-friends-list-item">
+  <div class="-r-uma-musume-friends-list-item__trainerId">
+    <span class="-r-uma-musume-friends-list-item__trainerId__text">123456789</span>
+  </div>
+  <div class="-r-uma-musume-friends-list-item__mainUmaMusume-wrap">
+    <img src="https://img.gamewith.jp/article_tools/uma-musume/gacha/i_undefined.png">
+  </div>
+</li>
+'''
+
+
+class InMemoryRawCollection:
+    '''Serves the post_date queries of GamewithScraper._load_known_friends.'''
+    def __init__(self, documents):
+        self._documents = documents
+
+    def find_one(self, query, projection, sort):
+        return max(self._documents, key=lambda document: document['post_date'])
+
+    def find(self, query, projection):
+        return [document for document in self._documents
+                if document['post_date'] >= query['post_date']['$gte']]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeDriver:
+    '''Stands in for a selenium webdriver on the friends page.
+
+    Args:
+        clock: A FakeClock, advanced by each latency while friends load.
+        pages: List of lists of friend HTML, returned by successive harvests.
+        latencies: List of seconds new friends take to show up after each
+            click. None stands for friends never showing up.
+        n_buttons: How many times the "もっと見る" button shows up.
+    '''
+    def __init__(self, clock, pages, latencies=(), n_buttons=0):
+        self._clock = clock
+        self._pages = list(pages)
+        self._latencies = list(latencies)
+        self._n_buttons = n_buttons
+        self.async_script_args = []
+        self.prune_args = []
+        self.n_clicks = 0
+
+    def execute_async_script(self, script, root, selector, min_count, timeout_ms):
+        assert script == gamewith_scraper._WAIT_FOR_ELEMENTS_SCRIPT
+        self.async_script_args.append((root, selector, min_count, timeout_ms))
+        if selector == '.-r-uma-musume-friends__next':
+            return 1 if self.n_clicks < self._n_buttons else None
+        if selector == gamewith_scraper._NEW_FRIEND_SELECTOR:
+            latency = self._latencies.pop(0)
+            if latency is None:
+                self._clock.now += timeout_ms / 1000
+                return None
+            self._clock.now += latency
+            return len(self._pages[0])
+        return 1
+
+    def execute_script(self, script, *args):
+        if script == gamewith_scraper._HARVEST_FRIENDS_SCRIPT:
+            self.prune_args.append(args[1])
+            return self._pages.pop(0) if self._pages else []
+        assert script == 'arguments[0].click();'
+        self.n_clicks += 1
+
+
+class FakeResults:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeFriendsSection:
+    def __init__(self, results_text=''):
+        self._results_text = results_text
+
+    def find_element_by_class_name(self, class_name):
+        assert class_name == '-r-uma-musume-friends__next'
+        return 'button'
+
+    def find_elements_by_class_name(self, class_name):
+        assert class_name == '-r-uma-musume-friends__results'
+        return [FakeResults(self._results_text)]
+
+
+@pytest.fixture
+def scraper():
+    return GamewithScraper(driver=None, url=None, timeout=0, button_limit=0,
+                           raw_collection=None, clean_collection=None,
+                           failed_collection=None, gamewith_normalizer=None)
+
+
+def test_get_friends_data(scraper):
+    raw_friends_html = ('<div class="-r-uma-musume-friends__search-wrap"></div><ul>'
+                        + FRIEND_HTML + EMPTY_FRIEND_HTML + '</ul>')
+
+    friend_html_list = scraper._parse_friend_html_list(raw_friends_html)
+    friends_data = list(scraper._get_friends_data(friend_html_list))
+
+    assert len(friends_data) == 2
+    friend_data = friends_data[0]
+    assert friend_data['friend_code'] == '248605600'
+    assert friend_data['support_id'] == '262813'
+    assert friend_data['support_limit'] == '4凸'
+    assert friend_data['character_image_url'] == 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_25.png'
+    assert friend_data['factors'] == ['パワー3(代表3)', 'スタミナ6']
+    assert friend_data['comment'] == 'スタミナ6\nパワー3'
+    assert (friend_data['post_date'].month, friend_data['post_date'].day) in [(7, 15), (7, 16)]
+
+    assert friends_data[1] == {
+        'friend_code': '123456789',
+        'support_id': None,
+        'support_limit': None,
+        'character_image_url': None,
+        'factors': None,
+        'comment': None,
+        'post_date': None
+    }
+
+
+def test_reaches_known_friends(scraper):
+    window_start = datetime(2021, 7, 15, 9, 0, tzinfo=timezone.utc)
+    known_keys = {('248605600', datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc))}
+
+    newer = ('123456789', datetime(2021, 7, 15, 10, 30, tzinfo=timezone.utc))
+    known = ('248605600', datetime(2021, 7, 15, 10, 9, tzinfo=timezone.utc))
+    older = ('123456789', datetime(2021, 7, 15, 8, 0, tzinfo=timezone.utc))
+
+    assert not scraper._reaches_known_friends([newer, ('123456789', None)], known_keys, window_start)
+    assert scraper._reaches_known_friends([newer, known], known_keys, window_start)
+    assert scraper._reaches_known_friends([older], known_keys, window_start)
+    # Empty database
+    assert not scraper._reaches_known_friends([known], None, None)
+
+
+def test_load_known_friends_ignores_future_post_dates(scraper):
+    now = datetime(2021, 7, 15, 12, 0, tzinfo=timezone.utc)
+    recent = {'friend_code': '248605600', 'post_date': now - timedelta(minutes=30)}
+    # Stored 9 hours late, before post dates were read in Japan time
+    future = {'friend_code': '123456789', 'post_date': now + timedelta(hours=9)}
+    scraper._raw_collection = InMemoryRawCollection([recent, future])
+    scraper._post_date_resolver = PostDateResolver(now=now)
+
+    known_keys, window_start = scraper._load_known_friends()
+
+    assert window_start == now - timedelta(hours=1)
+    assert (recent['friend_code'], recent['post_date']) in known_keys
+    assert not scraper._reaches_known_friends([('111111111', now - timedelta(minutes=10))],
+                                              known_keys, window_start)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(gamewith_scraper, 'time', clock)
+    return clock
+
+
+def make_page_scraper(scraper, driver, button_limit=10, prune_harvested=False):
+    scraper._driver = driver
+    scraper._friends_section = FakeFriendsSection()
+    scraper._TIMEOUT = 5
+    scraper._BUTTON_LIMIT = button_limit
+    scraper._PRUNE_HARVESTED = prune_harvested
+    scraper._load_known_friends = lambda: (None, None)
+    scraper.stored = []
+    scraper._store_friends_data = scraper.stored.append
+    return scraper
+
+
+def test_wait_for_elements(scraper, clock):
+    driver = FakeDriver(clock, pages=[])
+    make_page_scraper(scraper, driver)
+
+    assert scraper._wait_for_elements('.' + FRIEND_CLASS, min_count=3) == 1
+    assert scraper._wait_for_elements('.-r-uma-musume-friends__next', root='root') is None
+
+    assert driver.async_script_args == [
+        (scraper._friends_section, '.' + FRIEND_CLASS, 3, 5000),
+        ('root', '.-r-uma-musume-friends__next', 0, 5000)
+    ]
+
+
+@pytest.mark.parametrize('prune_harvested', [False, True])
+def test_harvest_friends_data(scraper, clock, prune_harvested):
+    driver = FakeDriver(clock, pages=[[FRIEND_HTML, EMPTY_FRIEND_HTML]])
+    make_page_scraper(scraper, driver, prune_harvested=prune_harvested)
+
+    friends_data = scraper._harvest_friends_data()
+
+    assert [friend_data['friend_code'] for friend_data in friends_data] == ['248605600', '123456789']
+    assert driver.prune_args == [prune_harvested]
+    # Nothing loaded since last harvest
+    assert scraper._harvest_friends_data() == []
+
+
+def click_log(caplog, message):
+    return [json.loads(record.getMessage().split('. ', 1)[1])
+            for record in caplog.records if record.getMessage().startswith(message)]
+
+
+def test_load_more_friends(scraper, clock, caplog):
+    pages = [[FRIEND_HTML], [EMPTY_FRIEND_HTML], [FRIEND_HTML, EMPTY_FRIEND_HTML]]
+    driver = FakeDriver(clock, pages, latencies=[0.5, 1.5], n_buttons=10)
+    make_page_scraper(scraper, driver, button_limit=2)
+
+    with caplog.at_level(logging.INFO, logger=gamewith_scraper.__name__):
+        scraper._load_more_friends()
+
+    # Condition (1): harvested after each click, and stopped at the limit
+    assert driver.n_clicks == 2
+    assert [len(friends_data) for friends_data in scraper.stored] == [1, 1, 2]
+    assert [log['latency'] for log in click_log(caplog, 'Clicked button')] == [0.5, 1.5]
+    assert click_log(caplog, 'Click latency') == [{'mean': 1.0, 'max': 1.5}]
+    assert click_log(caplog, 'Finished clicking button')[0]['n_harvested'] == 4
+    assert scraper._n_harvested == 4
+
+
+def test_load_more_friends_no_button(scraper, clock, caplog):
+    driver = FakeDriver(clock, [[FRIEND_HTML]], n_buttons=0)
+    make_page_scraper(scraper, driver)
+
+    with caplog.at_level(logging.INFO, logger=gamewith_scraper.__name__):
+        scraper._load_more_friends()
+
+    # Condition (3)
+    assert driver.n_clicks == 0
+    assert click_log(caplog, 'Click latency') == []
+
+
+def test_load_more_friends_not_loaded(scraper, clock, caplog):
+    driver = FakeDriver(clock, [[FRIEND_HTML], []], latencies=[None], n_buttons=10)
+    make_page_scraper(scraper, driver, prune_harvested=True)
+
+    with caplog.at_level(logging.INFO, logger=gamewith_scraper.__name__):
+        scraper._load_more_friends()
+
+    assert driver.n_clicks == 1
+    assert driver.prune_args == [True]
+    assert click_log(caplog, 'Clicked button')[0]['n_new_friends'] is None
+    assert click_log(caplog, 'Friends did not load after click') == \
+        [{'button': 'もっと見る', 'timeout': 5, 'prune_harvested': True}]
+    assert click_log(caplog, 'Click latency') == [{'mean': 5.0, 'max': 5.0}]
+
+
+@pytest.mark.parametrize('prune_harvested, n_harvested, mismatched', [
+    (False, 3, True),
+    # Pruned friends are gone from page, but were harvested
+    (True, 800, False),
+    (True, 3, True)
+])
+def test_wait_load_friends_section(scraper, clock, caplog, prune_harvested, n_harvested, mismatched):
+    driver = FakeDriver(clock, pages=[])
+    make_page_scraper(scraper, driver, prune_harvested=prune_harvested)
+    # Friends left on page after pruning
+    scraper._friends_section = FakeFriendsSection('直近800件について検索した結果は3件でした')
+    scraper._n_harvested = n_harvested
+
+    with caplog.at_level(logging.INFO, logger=gamewith_scraper.__name__):
+        scraper._wait_load_friends_section()
+
+    log = click_log(caplog, 'Finished loading friends section')[0]
+    assert (log['n_searched'], log['n_loaded'], log['n_harvested']) == (800, 3, n_harvested)
+    assert bool(click_log(caplog, 'Number of searched results does not match')) == mismatched
@@ -0,0 +1,69 @@
+from pymongo import ASCENDING, MongoClient
+import pytest
+
+from uma_friends import indexes
+from uma_friends.indexes import INDEX_SCHEMA_VERSION, INDEXES, ensure_indexes, report_indexes
+
+
+@pytest.fixture
+def database(monkeypatch):
+    # Every test starts as a new process would
+    monkeypatch.setattr(indexes, '_ensured', set())
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    mongo_client.drop_database('test_uma_friends_indexes')
+    return mongo_client['test_uma_friends_indexes']
+
+
+def index_names(collection):
+    return set(collection.index_information()) - {'_id_'}
+
+
+def test_ensure_indexes(database):
+    ensure_indexes(database['failed'], 'failed')
+
+    assert index_names(database['failed']) == {index.document['name'] for index in INDEXES['failed']}
+    assert database['index_versions'].find_one({'_id': 'failed'}) == \
+        {'_id': 'failed', 'role': 'failed', 'version': INDEX_SCHEMA_VERSION}
+
+    # Ensured once per process, without even reading index_versions again
+    database['index_versions'].delete_many({})
+    ensure_indexes(database['failed'], 'failed')
+    assert database['index_versions'].count_documents({}) == 0
+
+
+def test_ensure_indexes_up_to_date(database):
+    ensure_indexes(database['failed'], 'failed')
+    database['failed'].drop_index('retry.game_data_version_1')
+
+    # Another process finds the indexes up to date in the database
+    indexes._ensured.clear()
+    ensure_indexes(database['failed'], 'failed')
+    assert 'retry.game_data_version_1' not in index_names(database['failed'])
+
+
+def test_ensure_indexes_schema_version_bumped(database, monkeypatch):
+    ensure_indexes(database['failed'], 'failed')
+    database['failed'].drop_index('retry.game_data_version_1')
+
+    indexes._ensured.clear()
+    monkeypatch.setattr(indexes, 'INDEX_SCHEMA_VERSION', INDEX_SCHEMA_VERSION + 1)
+    ensure_indexes(database['failed'], 'failed')
+
+    assert 'retry.game_data_version_1' in index_names(database['failed'])
+    assert database['index_versions'].find_one({'_id': 'failed'})['version'] == INDEX_SCHEMA_VERSION + 1
+
+
+# $indexStats needs a real server
+@pytest.mark.mongod
+def test_report_indexes(database):
+    collection = database['supports']
+    collection.create_index([('id', ASCENDING)], name='id_1')
+    collection.create_index([('name', ASCENDING)], name='name_1')
+    collection.insert_one({'id': 'S1', 'gwId': '262813', 'name': 'キタサンブラック'})
+    collection.find_one({'id': 'S1'})
+
+    assert report_indexes(collection, 'supports') == {
+        'missing': ['gwId_1'],
+        'unused': ['name_1'],
+        'undeclared': ['name_1']
+    }
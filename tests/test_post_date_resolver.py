@@ -0,0 +1,31 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from uma_friends.post_date_resolver import PostDateResolver
+
+
+NOW = datetime(2021, 7, 16, 4, 0, tzinfo=timezone.utc)  # 07/16 13:00 in Japan
+
+
+def test_resolve_in_jst():
+    resolver = PostDateResolver(now=NOW)
+    assert resolver.resolve('07/16 12:59') == datetime(2021, 7, 16, 3, 59, tzinfo=timezone.utc)
+    assert resolver.resolve('7/1 0:05') == datetime(2021, 6, 30, 15, 5, tzinfo=timezone.utc)
+
+
+def test_resolve_later_than_now_is_last_year():
+    resolver = PostDateResolver(now=NOW)
+    assert resolver.resolve('07/16 13:01') == datetime(2020, 7, 16, 4, 1, tzinfo=timezone.utc)
+    assert resolver.resolve('12/31 23:59').year == 2020
+
+
+@pytest.mark.parametrize('date_string', ['07/16', '07-16 12:00', '13/01 00:00', '02/30 00:00'])
+def test_resolve_malformed(date_string):
+    with pytest.raises(ValueError):
+        PostDateResolver(now=NOW).resolve(date_string)
+
+
+def test_resolve_leap_day_of_last_year():
+    assert PostDateResolver(now=NOW).resolve('02/29 09:00') == \
+        datetime(2020, 2, 29, 0, 0, tzinfo=timezone.utc)
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+import gzip
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends.raw_archiver import RawArchiver
+
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+@pytest.fixture
+def collections():
+    database = MongoClient("localhost:27017", tz_aware=True)['test_uma_friends']
+    database.drop_collection('raw_archiver_raw')
+    database.drop_collection('raw_archiver_clean')
+    return database['raw_archiver_raw'], database['raw_archiver_clean']
+
+
+def friend(friend_code, days_ago):
+    return {'friend_code': friend_code, 'post_date': NOW - timedelta(days=days_ago)}
+
+
+def test_archive_and_restore(collections, tmp_path):
+    raw_collection, clean_collection = collections
+    raw_collection.insert_many([friend('old', 10), friend('old', 12), friend('old_failed', 10),
+                                friend('new', 1), {'post_date': NOW - timedelta(days=10)}])
+    clean_collection.insert_many([friend('old', 10), friend('new', 1)])
+    archiver = RawArchiver(raw_collection, clean_collection, str(tmp_path),
+                           retention=timedelta(days=7), batch_size=1)
+
+    archive_path = archiver.run()
+
+    # Without a clean counterpart of the same post date, or within
+    # retention, raw data is kept
+    assert sorted((document.get('friend_code') or '', document['post_date'])
+                  for document in raw_collection.find()) == [
+        ('', NOW - timedelta(days=10)),
+        ('new', NOW - timedelta(days=1)),
+        ('old', NOW - timedelta(days=12)),
+        ('old_failed', NOW - timedelta(days=10))
+    ]
+    with gzip.open(archive_path, 'rt', encoding='utf-8') as archive_file:
+        assert len(archive_file.readlines()) == 1
+
+    assert archiver.restore(archive_path)['n_inserted'] == 1
+    assert raw_collection.count_documents({'friend_code': 'old', 'post_date': NOW - timedelta(days=10)}) == 1
+    # Restored data is still past retention, so it is archived again unless
+    # archiving is paused until it is normalized again
+    assert archiver.run() is not None
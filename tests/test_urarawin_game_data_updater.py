@@ -0,0 +1,179 @@
+import json
+
+from pymongo import MongoClient
+import pytest
+
+from uma_friends.urarawin_game_data_updater import DataError, UrarawinGameDataUpdater
+from tests.stand_in_server import StandInServer
+
+
+GAME_DATA = {
+    'players': [{'id': 'BJTPrfuBw_U', 'name': 'スペシャルウィーク', 'gwId': '264389'}],
+    'supports': [{'id': 'S1', 'name': 'キタサンブラック', 'gwId': '262813'}],
+    'skills': [{'id': 'kjP0LurWRte', 'name': 'ギアシフト'}],
+    'races': [{'id': 'AbhqdP7Nkof', 'name': '日本ダービー'}],
+    'buffs': [{'id': 'B1'}],
+    'effects': {'1': {'name': 'スピード'}},
+    'events': [{'id': 'E1'}]
+}
+
+
+class StaticImageUrlFetcher:
+    def fetch_all(self, gamewith_ids):
+        return {gamewith_id: f'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_{gamewith_id}.png'
+                for gamewith_id in gamewith_ids}
+
+
+@pytest.fixture
+def database():
+    mongo_client = MongoClient("localhost:27017", tz_aware=True)
+    mongo_client.drop_database('test_uma_friends_game_updater')
+    return mongo_client['test_uma_friends_game_updater']
+
+
+def serve(body):
+    def handle(path, query, headers):
+        return 200, {'Content-Type': 'application/json'}, body
+    return StandInServer(handle)
+
+
+def make_updater(server, database):
+    return UrarawinGameDataUpdater(server.url + '/db.json', 'https://gamewith.jp/uma-musume/article/show/',
+                                   database, image_url_fetcher=StaticImageUrlFetcher())
+
+
+@pytest.mark.parametrize('body', [
+    # events, the last collection, is missing
+    json.dumps({k: v for k, v in GAME_DATA.items() if k != 'events'}).encode('utf-8'),
+    # Truncated download
+    json.dumps(GAME_DATA).encode('utf-8')[:-20]
+], ids=['missing_collection', 'truncated'])
+def test_run_bad_game_data_writes_nothing(database, body):
+    with serve(body) as server:
+        with pytest.raises(DataError):
+            make_updater(server, database).run()
+
+    assert database['players'].count_documents({}) == 0
+    assert database['changes'].count_documents({}) == 0
+    assert database['imports'].count_documents({}) == 0
+
+
+def test_run_records_changes(database):
+    with serve(json.dumps(GAME_DATA).encode('utf-8')) as server:
+        make_updater(server, database).run()
+    database['changes'].update_many({}, {'$set': {'renormalized': True}})
+
+    game_data = json.loads(json.dumps(GAME_DATA))
+    game_data['supports'].append({'id': 'S2', 'name': 'サトノダイヤモンド', 'gwId': '262814'})
+    game_data['races'][0]['name'] = '東京優駿'
+    game_data['skills'].append({'id': 'K2', 'name': '末脚'})
+    with serve(json.dumps(game_data).encode('utf-8')) as server:
+        make_updater(server, database).run()
+
+    changes = list(database['changes'].find({'renormalized': False}, {'_id': 0, 'created_at': 0}))
+    assert sorted(changes, key=lambda document: document['factor_names']) == [
+        {'support_gw_ids': ['262814'], 'image_urls': [], 'factor_names': [], 'renormalized': False},
+        {'support_gw_ids': [], 'image_urls': [], 'factor_names': ['末脚'], 'renormalized': False},
+        {'support_gw_ids': [], 'image_urls': [], 'factor_names': ['東京優駿'], 'renormalized': False}
+    ]
+
+
+def test_run_records_changes_of_races_without_id(database):
+    with serve(json.dumps(GAME_DATA).encode('utf-8')) as server:
+        make_updater(server, database).run()
+    database['changes'].update_many({}, {'$set': {'renormalized': True}})
+
+    game_data = json.loads(json.dumps(GAME_DATA))
+    game_data['races'].append({'name': '天皇賞（秋）'})
+    game_data['skills'].append({'id': 'K2'})
+    with serve(json.dumps(game_data).encode('utf-8')) as server:
+        make_updater(server, database).run()
+
+    changes = list(database['changes'].find({'renormalized': False}, {'_id': 0, 'created_at': 0}))
+    assert changes == [
+        {'support_gw_ids': [], 'image_urls': [], 'factor_names': ['天皇賞（秋）'], 'renormalized': False}
+    ]
+
+
+def test_write_to_database(database):
+    updater = UrarawinGameDataUpdater('https://example.com/db.json', 'https://gamewith.jp/uma-musume/article/show/',
+                                      database, image_url_fetcher=StaticImageUrlFetcher())
+    skills = [{'id': 'A', 'name': 'ギアシフト'}, {'id': 'B', 'name': '集中力'}, {'id': 'C', 'name': '末脚'}]
+    assert updater._write_to_database('skills', [dict(skill) for skill in skills]) == \
+        {'n_inserted': 3, 'n_updated': 0, 'n_deleted': 0}
+    ids_before = {skill['id']: skill['_id'] for skill in database['skills'].find()}
+
+    # Unchanged documents are not written, whatever their key order
+    unchanged = [dict(reversed(list(skill.items()))) for skill in skills]
+    assert updater._write_to_database('skills', unchanged) == \
+        {'n_inserted': 0, 'n_updated': 0, 'n_deleted': 0}
+    assert {skill['id']: skill['_id'] for skill in database['skills'].find()} == ids_before
+
+    changed = [{'id': 'A', 'name': 'ギアシフト'}, {'id': 'B', 'name': 'コンセントレーション'},
+               {'id': 'D', 'name': '直線巧者'}]
+    assert updater._write_to_database('skills', changed) == \
+        {'n_inserted': 1, 'n_updated': 1, 'n_deleted': 1}
+    assert sorted((skill['id'], skill['name']) for skill in database['skills'].find()) == \
+        [('A', 'ギアシフト'), ('B', 'コンセントレーション'), ('D', '直線巧者')]
+
+
+def test_write_to_database_without_unique_id(database):
+    updater = UrarawinGameDataUpdater('https://example.com/db.json', 'https://gamewith.jp/uma-musume/article/show/',
+                                      database, image_url_fetcher=StaticImageUrlFetcher())
+    database['races'].insert_one({'id': 'OLD', 'name': '有馬記念'})
+    races = [{'id': 'R1', 'name': '日本ダービー'}, {'name': '天皇賞（秋）'}]
+
+    assert updater._write_to_database('races', races) is None
+
+    assert sorted(race['name'] for race in database['races'].find()) == ['天皇賞（秋）', '日本ダービー']
+    # Indexes are recreated along with the collection
+    assert {'id_1', 'name_1'} <= set(database['races'].index_information())
+
+
+def test_run_replaces_collection_without_unique_id(database):
+    with serve(json.dumps(GAME_DATA).encode('utf-8')) as server:
+        make_updater(server, database).run()
+    player_ids = [player['_id'] for player in database['players'].find()]
+
+    game_data = json.loads(json.dumps(GAME_DATA))
+    game_data['races'] = [{'id': 'R1', 'name': '日本ダービー'}, {'name': '天皇賞（秋）'}]
+    with serve(json.dumps(game_data).encode('utf-8')) as server:
+        make_updater(server, database).run()
+
+    assert sorted(race['name'] for race in database['races'].find()) == ['天皇賞（秋）', '日本ダービー']
+    assert {'id_1', 'name_1'} <= set(database['races'].index_information())
+    # Other collections are still synced by id
+    assert [player['_id'] for player in database['players'].find()] == player_ids
+
+
+def test_download_game_data_not_modified(database):
+    body = json.dumps(GAME_DATA).encode('utf-8')
+
+    def handle(path, query, headers):
+        if headers.get('If-None-Match') == '"v1"':
+            return 304, {'ETag': '"v1"'}, b''
+        return 200, {'Content-Type': 'application/json', 'ETag': '"v1"'}, body
+
+    with StandInServer(handle) as server:
+        updater = make_updater(server, database)
+        updater.run()
+        assert updater._download_game_data() == (None, None)
+
+    assert server.requests[1][2]['If-None-Match'] == '"v1"'
+
+
+def test_download_game_data_same_content(database):
+    body = json.dumps(GAME_DATA).encode('utf-8')
+
+    # No ETag, so game data is downloaded again and compared by content hash
+    with serve(body) as server:
+        updater = make_updater(server, database)
+        updater.run()
+        assert updater._download_game_data() == (None, None)
+
+    with serve(body.replace(b'"B1"', b'"B2"')) as server:
+        updater = make_updater(server, database)
+        game_data_file, import_state = updater._download_game_data()
+        game_data_file.close()
+
+    assert import_state['sha256'] != database['imports'].find_one()['sha256']
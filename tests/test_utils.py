@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from uma_friends.utils import iter_json_object_items, make_session
+from tests.stand_in_server import StandInServer
+
+
+GAME_DATA = {
+    'players': [{'id': 'BJTPrfuBw_U', 'name': 'スペシャルウィーク', 'gwId': '264389'}],
+    'effects': {'1': {'name': 'スピード'}},
+    'version': 123,
+    'empty': {},
+    'text': '{"not": "nested"}, '
+}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_iter_json_object_items(chunk_size):
+    raw = json.dumps(GAME_DATA, ensure_ascii=False, indent=2).encode('utf-8')
+    chunks = [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+
+    items = list(iter_json_object_items(chunks))
+
+    assert items == list(GAME_DATA.items())
+
+
+def test_iter_json_object_items_not_object():
+    with pytest.raises(ValueError):
+        list(iter_json_object_items([b'[{"id": 1}]']))
+    with pytest.raises(ValueError):
+        list(iter_json_object_items([b'{"players": [']))
+
+
+def test_make_session_retries():
+    def handle(path, query, headers):
+        if len(server.requests) < 3:
+            return 503, {}, b''
+        return 200, {}, b'ok'
+
+    with StandInServer(handle) as server:
+        response = make_session(max_retries=3, backoff_factor=0).get(server.url + '/page')
+
+    assert response.content == b'ok'
+    assert len(server.requests) == 3
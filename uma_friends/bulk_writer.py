@@ -0,0 +1,149 @@
+import json
+import logging
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+logger = logging.getLogger(__name__)
+
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+
+class BulkWriter:
+    '''Writes friend documents idempotently, in chunks.
+
+    Each document is an upsert with $setOnInsert, keyed on friend_code and
+    post_date: documents already in the collection are matched and left
+    untouched, instead of failing an insert with DuplicateKeyError. replace
+    writes over documents already in the collection instead.
+    '''
+    def __init__(self, collection, batch_size=500, key_fields=('friend_code', 'post_date'),
+                 on_insert=None, on_replace=None):
+        '''Initializes BulkWriter.
+
+        Args:
+            collection:
+                A pymongo Collection.
+            batch_size:
+                An integer of how many documents are sent in one bulk_write.
+            key_fields:
+                A tuple of field names identifying a document.
+            on_insert:
+                Optional function, called after every chunk with the list of
+                documents newly written by it, e.g. to keep counters. Never
+                called with a document already in the collection.
+            on_replace:
+                Optional function, called after every chunk of replace with
+                the list of documents replaced, as they were before, and the
+                list of documents replacing them, in the same order.
+        '''
+        self._collection = collection
+        self._BATCH_SIZE = batch_size
+        self._KEY_FIELDS = key_fields
+        self._on_insert = on_insert
+        self._on_replace = on_replace
+
+    def write(self, documents):
+        '''Writes documents that are not in the collection yet.
+
+        Args:
+            documents:
+                List of dicts.
+
+        Returns:
+            A dict of counts:
+            n_inserted: documents newly written.
+            n_matched: documents already in the collection.
+            n_errored: documents failed to be written.
+
+        Raises:
+            BulkWriteError, if some documents failed to be written. All chunks
+            are attempted before raising.
+        '''
+        return self._write(documents, lambda key, document: UpdateOne(
+            key, {'$setOnInsert': document}, upsert=True), on_replace=None)
+
+    def replace(self, documents):
+        '''Writes documents, replacing those already in the collection.
+
+        Args:
+            documents:
+                List of dicts, without _id.
+
+        Returns:
+            A dict of counts, the same as write, n_matched being documents
+            replaced.
+
+        Raises:
+            The same as write.
+        '''
+        return self._write(documents, lambda key, document: ReplaceOne(key, document, upsert=True),
+                           on_replace=self._on_replace)
+
+    def _write(self, documents, make_operation, on_replace):
+        '''Sends an operation per document in chunks, see write.
+
+        Args:
+            documents:
+                List of dicts.
+            make_operation:
+                A function of (key filter, document) returning an upsert.
+            on_replace:
+                Optional function, see __init__. If given, documents about
+                to be replaced are read first, one query per chunk.
+        '''
+        counts = {'n_inserted': 0, 'n_matched': 0, 'n_errored': 0}
+        if not documents:
+            return counts
+        error = None
+        for start in range(0, len(documents), self._BATCH_SIZE):
+            chunk = documents[start:start + self._BATCH_SIZE]
+            keys = [{field: document[field] for field in self._KEY_FIELDS} for document in chunk]
+            operations = [make_operation(key, document) for key, document in zip(keys, chunk)]
+            old_documents = {}
+            if on_replace is not None:
+                old_documents = {self._key_of(document): document
+                                 for document in self._collection.find({'$or': keys})}
+            error_indexes = set()
+            try:
+                result = self._collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                details = e.details
+                write_errors = details['writeErrors']
+                # Concurrent upserts of the same key lose with a duplicate key
+                # error, the document is there all the same
+                n_duplicate = sum(e_['code'] == DUPLICATE_KEY_ERROR_CODE for e_ in write_errors)
+                counts['n_inserted'] += details['nUpserted']
+                counts['n_matched'] += details['nMatched'] + n_duplicate
+                counts['n_errored'] += len(write_errors) - n_duplicate
+                if len(write_errors) != n_duplicate:
+                    error = e
+                inserted_indexes = [upserted['index'] for upserted in details['upserted']]
+                error_indexes = {e_['index'] for e_ in write_errors}
+            else:
+                counts['n_inserted'] += result.upserted_count
+                counts['n_matched'] += result.matched_count
+                inserted_indexes = list(result.upserted_ids)
+            if self._on_insert is not None and inserted_indexes:
+                self._on_insert([chunk[index] for index in inserted_indexes])
+            if on_replace is not None:
+                # Found before writing, unless deleted meanwhile and inserted
+                not_replaced = error_indexes.union(inserted_indexes)
+                replaced = [(old_documents[self._key_of(document)], document)
+                            for index, document in enumerate(chunk)
+                            if index not in not_replaced and self._key_of(document) in old_documents]
+                if replaced:
+                    on_replace([old for old, _ in replaced], [new for _, new in replaced])
+
+        logger.info('Finished writing documents. %s',
+                    json.dumps(dict(counts, collection=self._collection.full_name)))
+        if error is not None:
+            logger.exception('Exception occurred during writing.',
+                             exc_info=error, stack_info=True)
+            raise error
+        return counts
+
+    def _key_of(self, document):
+        return tuple(document[field] for field in self._KEY_FIELDS)
@@ -0,0 +1,137 @@
+from datetime import datetime, timezone
+import json
+import logging
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+
+from .bulk_writer import BulkWriter
+
+
+logger = logging.getLogger(__name__)
+
+
+def stamp_failed_data(failed_data_list, errors, game_data_version):
+    '''Returns copies of newly failed friend data with retry state.
+
+    Args:
+        failed_data_list:
+            List of raw friend data that failed normalizing.
+        errors:
+            List of strings describing why, in the same order.
+        game_data_version:
+            A string of the version of game data they failed with, see
+            GamewithNormalizer.game_data_version.
+    '''
+    now = datetime.now(timezone.utc)
+    return [dict(friend_data, retry=_retry_state(1, error, game_data_version, now))
+            for friend_data, error in zip(failed_data_list, errors)]
+
+
+def _retry_state(attempts, error, game_data_version, now):
+    return {
+        'attempts': attempts,
+        'last_error': error,
+        'game_data_version': game_data_version,
+        'last_attempted_at': now
+    }
+
+
+class FailedDataRetrier:
+    '''Retries normalizing friend data in the failed buffer.
+
+    Every failed document keeps its retry state in the 'retry' field:
+        attempts: how many times normalizing it failed.
+        last_error: why it failed the last time.
+        game_data_version: version of game data it failed with.
+        last_attempted_at: when it failed the last time.
+    A document is retried only if game data has changed since it failed, as
+    normalizing it again with the same game data fails the same way. Those
+    normalized are written into clean collection before being deleted from
+    the failed buffer by _id, so nothing is lost if a run stops halfway.
+    '''
+    def __init__(self, failed_collection, clean_collection, gamewith_normalizer, batch_size=500,
+                 on_clean_insert=None):
+        '''Initializes FailedDataRetrier.
+
+        Args:
+            failed_collection:
+                A pymongo Collection. Stores friend data that cannot be normalized.
+            clean_collection:
+                A pymongo Collection. Stores clean-up data.
+            gamewith_normalizer:
+                A GamewithNormalizer. Parses raw gamewith data.
+            batch_size:
+                An integer of how many failed documents are retried at once.
+            on_clean_insert:
+                Optional function, see BulkWriter on_insert.
+        '''
+        self._failed_collection = failed_collection
+        self._gamewith_normalizer = gamewith_normalizer
+        self._clean_writer = BulkWriter(clean_collection, batch_size=batch_size,
+                                        on_insert=on_clean_insert)
+        self._BATCH_SIZE = batch_size
+        self._game_data_version = None
+
+    def run(self):
+        '''Retries failed documents not yet tried with current game data.
+
+        Returns:
+            A dict of counts.
+        '''
+        self._game_data_version = self._gamewith_normalizer.game_data_version()
+        query = {'$or': [
+            # Failed before retry state was kept
+            {'retry': {'$exists': False}},
+            {'retry.game_data_version': {'$ne': self._game_data_version}}
+        ]}
+        logger.info('Started retrying failed data. %s',
+                    json.dumps({'collection': self._failed_collection.full_name,
+                                'game_data_version': self._game_data_version}))
+        counts = {'n_fixed': 0, 'n_failed': 0}
+        cursor = (self._failed_collection.find(query)
+                                         .sort('_id', ASCENDING)
+                                         .batch_size(self._BATCH_SIZE))
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == self._BATCH_SIZE:
+                self._retry_batch(batch, counts)
+                batch = []
+        if batch:
+            self._retry_batch(batch, counts)
+        logger.info('Finished retrying failed data. %s',
+                    json.dumps(dict(counts, collection=self._failed_collection.full_name)))
+        return counts
+
+    def stamp(self, failed_data_list, errors):
+        '''Returns copies of newly failed friend data with retry state.
+
+        See stamp_failed_data, the game data version being the one of the
+        last run, or the current one if never run.
+        '''
+        if self._game_data_version is None:
+            self._game_data_version = self._gamewith_normalizer.game_data_version()
+        return stamp_failed_data(failed_data_list, errors, self._game_data_version)
+
+    def _retry_batch(self, batch, counts):
+        '''Retries a batch, updating counts in place.'''
+        errors = []
+        cleaned_data_list, failed_data_list = self._gamewith_normalizer.normalize_many(
+            [{k: v for k, v in document.items() if k != 'retry'} for document in batch], errors)
+        failed_ids = [friend_data['_id'] for friend_data in failed_data_list]
+        fixed_ids = {document['_id'] for document in batch} - set(failed_ids)
+
+        # Written before deleted, so a crash in between only leaves
+        # duplicates behind, which are harmless to write again
+        self._clean_writer.write(cleaned_data_list)
+        now = datetime.now(timezone.utc)
+        attempts = {document['_id']: document.get('retry', {}).get('attempts', 0)
+                    for document in batch}
+        operations = [DeleteOne({'_id': _id}) for _id in fixed_ids]
+        operations += [UpdateOne({'_id': _id},
+                                 {'$set': {'retry': _retry_state(attempts[_id] + 1, error, self._game_data_version, now)}})
+                       for _id, error in zip(failed_ids, errors)]
+        if operations:
+            self._failed_collection.bulk_write(operations, ordered=False)
+        counts['n_fixed'] += len(fixed_ids)
+        counts['n_failed'] += len(failed_ids)
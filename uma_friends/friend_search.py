@@ -0,0 +1,159 @@
+import json
+import logging
+
+from pymongo import DESCENDING
+
+
+logger = logging.getLogger(__name__)
+
+
+class FriendSearch:
+    '''A structured search of the clean collection.
+
+    Every condition is optional, and all given are required to match.
+    Factor conditions compile into $elemMatch so that name and level bound
+    the same factor, which is what lets the factor indexes of the clean
+    collection serve them.
+
+    Results come newest first, paginated by keyset on (post_date, _id): a
+    page starts right after the last friend of the previous page, so paging
+    costs the same however deep it goes, and friends posted meanwhile do not
+    shift pages. Friends without post_date sort last, after every dated one.
+
+    Usage:
+        search = FriendSearch(main_uma_id='uma_a', factors=[('スピード', 3)])
+        friends, after = search.find(clean_collection)
+        more_friends, after = search.find(clean_collection, after=after)
+    '''
+    SORT = [('post_date', DESCENDING), ('_id', DESCENDING)]
+
+    def __init__(self, main_uma_id=None, support_id=None, support_limit=None,
+                 factors=None, main_uma_factors=None, parent_ids=None,
+                 post_date_from=None, post_date_to=None):
+        '''Initializes FriendSearch.
+
+        Args:
+            main_uma_id:
+                A string of the id of main uma.
+            support_id:
+                A string of the id of support card.
+            support_limit:
+                An integer of the minimum limit break of support card.
+            factors:
+                List of (factor name, minimum level) pairs, matched against
+                total factors, main uma's and parents' combined.
+            main_uma_factors:
+                List of (factor name, minimum level) pairs, matched against
+                main uma's own factors.
+            parent_ids:
+                List of strings of uma ids that must all be parents.
+            post_date_from:
+                A datetime. Only friends posted at or after it.
+            post_date_to:
+                A datetime. Only friends posted before it.
+        '''
+        self._main_uma_id = main_uma_id
+        self._support_id = support_id
+        self._support_limit = support_limit
+        self._factors = factors or []
+        self._main_uma_factors = main_uma_factors or []
+        self._parent_ids = parent_ids or []
+        self._post_date_from = post_date_from
+        self._post_date_to = post_date_to
+
+    def to_query(self, after=None):
+        '''Returns the filter of this search.
+
+        Args:
+            after:
+                Optional (post_date, _id) of the last friend of the previous page.
+        '''
+        conditions = []
+        if self._main_uma_id is not None:
+            conditions.append({'main_uma.id': self._main_uma_id})
+        if self._support_id is not None:
+            conditions.append({'support.id': self._support_id})
+        if self._support_limit is not None:
+            conditions.append({'support.limit': {'$gte': self._support_limit}})
+        for name, level in self._factors:
+            conditions.append({'factors': {'$elemMatch': {'name': name, 'level': {'$gte': level}}}})
+        for name, level in self._main_uma_factors:
+            conditions.append({'main_uma.factors': {'$elemMatch': {'name': name,
+                                                                   'level': {'$gte': level}}}})
+        if self._parent_ids:
+            conditions.append({'parents.id': {'$all': list(self._parent_ids)}})
+        post_date = {}
+        if self._post_date_from is not None:
+            post_date['$gte'] = self._post_date_from
+        if self._post_date_to is not None:
+            post_date['$lt'] = self._post_date_to
+        if post_date:
+            conditions.append({'post_date': post_date})
+        if after is not None:
+            last_post_date, last_id = after
+            if last_post_date is None:
+                conditions.append({'post_date': None, '_id': {'$lt': last_id}})
+            else:
+                conditions.append({'$or': [
+                    {'post_date': {'$lt': last_post_date}},
+                    {'post_date': last_post_date, '_id': {'$lt': last_id}},
+                    # $lt never matches null, which sorts after every date
+                    {'post_date': None}
+                ]})
+
+        if not conditions:
+            return {}
+        if len(conditions) == 1:
+            return conditions[0]
+        return {'$and': conditions}
+
+    def find(self, collection, page_size=20, after=None):
+        '''Returns a page of friends matching this search.
+
+        Args:
+            collection:
+                A pymongo Collection of clean data.
+            page_size:
+                An integer of how many friends a page has at most.
+            after:
+                Optional (post_date, _id) returned along with the previous page.
+
+        Returns:
+            (friends, after)
+            friends: List of dicts, newest first.
+            after: (post_date, _id) to get the next page with, or None if
+                this is the last page.
+        '''
+        query = self.to_query(after)
+        friends = list(collection.find(query).sort(self.SORT).limit(page_size))
+        logger.info('Searched friends. %s',
+                    json.dumps({'collection': collection.full_name,
+                                'n_found': len(friends)}))
+        if len(friends) < page_size:
+            return friends, None
+        return friends, (friends[-1].get('post_date'), friends[-1]['_id'])
+
+    def rank_by_stars(self, collection, factor_type='blue', limit=20):
+        '''Returns friends matching this search with the most stars of factor_type.
+
+        Ranks on summary.stars of GamewithNormalizer.summarize, so nothing is
+        unwound at query time. Only blue stars are indexed, so other factor
+        types are sorted in memory over every friend matching this search.
+
+        Args:
+            collection:
+                A pymongo Collection of clean data.
+            factor_type:
+                A string of factor type, e.g. 'blue'.
+            limit:
+                An integer of how many friends are returned at most.
+
+        Returns:
+            List of dicts, most stars first, then newest first.
+        '''
+        sort = [(f'summary.stars.{factor_type}', DESCENDING), ('post_date', DESCENDING)]
+        friends = list(collection.find(self.to_query()).sort(sort).limit(limit))
+        logger.info('Ranked friends. %s',
+                    json.dumps({'collection': collection.full_name,
+                                'factor_type': factor_type, 'n_found': len(friends)}))
+        return friends
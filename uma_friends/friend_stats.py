@@ -0,0 +1,128 @@
+from collections import Counter
+import json
+import logging
+
+from pymongo import UpdateOne
+
+from .indexes import INDEXES
+from .post_date_resolver import JST
+from .utils import as_utc
+
+
+logger = logging.getLogger(__name__)
+
+
+class FriendStats:
+    '''Per-day counters of posted friends, kept up to date incrementally.
+
+    Each counter is a document of the stats collection:
+    {
+        '_id': {'day': 'YYYY-MM-DD' (post date in Japan time), 'kind': <kind>, <key>},
+        'count': <number of friends>
+    }
+    where kind and key are one of:
+        'main_uma': {'id': <main uma id>}
+        'support': {'id': <support id>, 'limit': <support limit>}
+        'factor': {'name': <factor name>, 'level': <total level>}
+    Counters are $inc upserts, so dashboards read a few small documents
+    instead of aggregating the clean collection.
+
+    Only friends newly inserted into the clean collection must be added, so
+    that every friend is counted once, and friends replaced in it must be
+    replaced in counters too; see BulkWriter on_insert and on_replace.
+    Counters missed by a crash between the two writes are restored by
+    rebuild.
+    '''
+    def __init__(self, stats_collection, batch_size=1000):
+        '''Initializes FriendStats.
+
+        Args:
+            stats_collection:
+                A pymongo Collection. Stores counters.
+            batch_size:
+                An integer of how many counters are sent in one bulk_write.
+        '''
+        self._stats_collection = stats_collection
+        self._BATCH_SIZE = batch_size
+
+    def add(self, friends):
+        '''Counts friends into the stats collection.
+
+        Args:
+            friends:
+                List of dicts of normalized friend data.
+        '''
+        self._write(self._stats_collection, self._count(friends))
+
+    def replace(self, old_friends, new_friends):
+        '''Moves counts of friends from their old version to their new one.
+
+        Args:
+            old_friends:
+                List of dicts of friend data in the clean collection.
+            new_friends:
+                List of dicts of normalized friend data replacing them.
+        '''
+        counts = self._count(new_friends)
+        counts.subtract(self._count(old_friends))
+        self._write(self._stats_collection, {key: count for key, count in counts.items() if count})
+
+    def rebuild(self, clean_collection):
+        '''Rebuilds every counter from the clean collection.
+
+        Counters are built in a separate collection, which then replaces the
+        stats collection, so readers never see half-built counters.
+
+        Args:
+            clean_collection:
+                A pymongo Collection. Stores clean-up data.
+        '''
+        logger.info('Started rebuilding friend stats. %s',
+                    json.dumps({'collection': self._stats_collection.full_name}))
+        rebuild_collection = self._stats_collection.database[self._stats_collection.name + '_rebuild']
+        rebuild_collection.drop()
+        n_friends = 0
+        batch = []
+        cursor = (clean_collection.find({}, {'post_date': 1, 'main_uma.id': 1, 'support': 1, 'factors': 1})
+                                  .batch_size(self._BATCH_SIZE))
+        for friend in cursor:
+            batch.append(friend)
+            if len(batch) == self._BATCH_SIZE:
+                self._write(rebuild_collection, self._count(batch))
+                n_friends += len(batch)
+                batch = []
+        if batch:
+            self._write(rebuild_collection, self._count(batch))
+            n_friends += len(batch)
+        rebuild_collection.create_indexes(INDEXES['stats'])
+        rebuild_collection.rename(self._stats_collection.name, dropTarget=True)
+        logger.info('Finished rebuilding friend stats. %s',
+                    json.dumps({'collection': self._stats_collection.full_name,
+                                'n_friends': n_friends}))
+
+    @staticmethod
+    def _count(friends):
+        '''Returns a Counter of counter _ids for friends.'''
+        counts = Counter()
+        for friend in friends:
+            if friend.get('post_date') is None:
+                continue
+            day = as_utc(friend['post_date']).astimezone(JST).strftime('%Y-%m-%d')
+            main_uma = friend.get('main_uma')
+            if main_uma is not None and main_uma.get('id') is not None:
+                counts[(day, 'main_uma', (('id', main_uma['id']),))] += 1
+            support = friend.get('support')
+            if support is not None and support.get('id') is not None:
+                counts[(day, 'support', (('id', support['id']), ('limit', support.get('limit'))))] += 1
+            for factor in friend.get('factors') or []:
+                counts[(day, 'factor', (('name', factor['name']), ('level', factor['level'])))] += 1
+        return counts
+
+    def _write(self, collection, counts):
+        '''Adds counts to counters of collection.'''
+        operations = [UpdateOne({'_id': dict([('day', day), ('kind', kind), *key])},
+                                {'$inc': {'count': count}},
+                                upsert=True)
+                      for (day, kind, key), count in counts.items()]
+        for start in range(0, len(operations), self._BATCH_SIZE):
+            collection.bulk_write(operations[start:start + self._BATCH_SIZE], ordered=False)
@@ -0,0 +1,199 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+import multiprocessing
+
+from pymongo import ASCENDING, DeleteOne, MongoClient
+
+from .bulk_writer import BulkWriter
+from .failed_data_retrier import stamp_failed_data
+from .friend_stats import FriendStats
+from .gamewith_normalizer import GamewithNormalizer
+from .indexes import ensure_indexes
+
+
+logger = logging.getLogger(__name__)
+
+
+# Each worker process owns its normalizer (and MongoClient, which must not be
+# shared across processes), and the version of game data in its snapshot.
+# Set by _init_worker.
+_worker_normalizer = None
+_worker_game_data_version = None
+
+
+def _init_worker(db_uri, game_data_db):
+    '''Creates the normalizer of a worker process, with its own snapshot.'''
+    global _worker_normalizer, _worker_game_data_version
+    mongo_client = MongoClient(db_uri, tz_aware=True)
+    _worker_normalizer = GamewithNormalizer(mongo_client[game_data_db])
+    # Read before the snapshot: if game data is imported in between, failures
+    # are stamped with the older version and only retried once more
+    _worker_game_data_version = _worker_normalizer.game_data_version()
+    _worker_normalizer.load_snapshot()
+
+
+def _normalize_batch(batch):
+    '''Normalizes a batch of raw friend data in a worker process.
+
+    Returns:
+        (cleaned_data_list, failed_data_list, errors, game_data_version), see
+        GamewithNormalizer.normalize_many. game_data_version is the version
+        of game data the batch was normalized with.
+    '''
+    errors = []
+    cleaned_data_list, failed_data_list = _worker_normalizer.normalize_many(batch, errors)
+    return cleaned_data_list, failed_data_list, errors, _worker_game_data_version
+
+
+class FriendsBackfiller:
+    '''Re-normalizes the whole raw collection with a pool of processes.
+
+    Raw documents are streamed in _id order, sharded into batches across
+    worker processes, and written back in unordered bulk upserts: normalized
+    friend data replaces its clean counterpart and leaves the failed buffer,
+    the rest is added to the failed buffer with retry state, the same as
+    FailedDataRetrier gives to new failures, stamped with the game data
+    version of the worker's snapshot. After a batch is written its last
+    _id is committed as checkpoint, so an interrupted backfill resumes where
+    it stopped.
+    '''
+    def __init__(self, db_uri, raw_collection, clean_collection, failed_collection,
+                 checkpoint_collection, game_data_db, name='backfill',
+                 batch_size=1000, max_workers=None, stats_collection=None):
+        '''Initializes FriendsBackfiller.
+
+        Args:
+            db_uri:
+                A string of MongoDB uri. Workers connect with it on their own.
+            raw_collection:
+                A pymongo Collection. Stores raw data scraped from gamewith.
+            clean_collection:
+                A pymongo Collection. Stores clean-up data.
+            failed_collection:
+                A pymongo Collection. Stores friend data that cannot be normalized.
+            checkpoint_collection:
+                A pymongo Collection. Stores the last committed _id.
+            game_data_db:
+                A string of the game database name.
+            name:
+                A string identifying the checkpoint of this backfill.
+            batch_size:
+                An integer of how many raw documents a worker normalizes at once.
+            max_workers:
+                An integer of how many worker processes to use.
+                Defaults to the number of CPUs.
+            stats_collection:
+                Optional pymongo Collection. If given, FriendStats counters
+                in it are updated along with every clean write.
+        '''
+        self._db_uri = db_uri
+        self._raw_collection = raw_collection
+        self._clean_collection = clean_collection
+        self._failed_collection = failed_collection
+        self._checkpoint_collection = checkpoint_collection
+        self._game_data_db = game_data_db
+        self._name = name
+        self._BATCH_SIZE = batch_size
+        self._MAX_WORKERS = max_workers or multiprocessing.cpu_count()
+        # Bounds memory: at most this many batches are read but not yet written
+        self._MAX_PENDING = self._MAX_WORKERS * 2
+        # Batches after the checkpoint may have been written before an
+        # interruption; writing them again is harmless
+        hooks = {}
+        if stats_collection is not None:
+            friend_stats = FriendStats(stats_collection)
+            hooks = {'on_insert': friend_stats.add, 'on_replace': friend_stats.replace}
+        self._clean_writer = BulkWriter(clean_collection, batch_size=batch_size, **hooks)
+        self._failed_writer = BulkWriter(failed_collection, batch_size=batch_size)
+        logger.info('Finished initializing FriendsBackfiller.')
+
+    def run(self, restart=False):
+        '''Backfills clean and failed collections.
+
+        Args:
+            restart:
+                Bool. If True, ignores the checkpoint and starts over.
+        '''
+        logger.info('Started running FriendsBackfiller. %s',
+                    json.dumps({'name': self._name, 'restart': restart}))
+        ensure_indexes(self._clean_collection, 'clean')
+        ensure_indexes(self._failed_collection, 'failed')
+        last_id = None if restart else self._load_checkpoint()
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        logger.info('Started backfilling. %s',
+                    json.dumps({'from_id': str(last_id), 'n_remaining': self._raw_collection.count_documents(query)}))
+
+        n_done = 0
+        pending = deque()
+        # Workers must not inherit our MongoClient, so do not fork
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self._MAX_WORKERS,
+                                 mp_context=mp_context,
+                                 initializer=_init_worker,
+                                 initargs=(self._db_uri, self._game_data_db)) as executor:
+            for batch in self._iter_batches(query):
+                if len(pending) == self._MAX_PENDING:
+                    n_done += self._commit(*pending.popleft())
+                pending.append((executor.submit(_normalize_batch, batch), batch[-1]['_id']))
+            while pending:
+                n_done += self._commit(*pending.popleft())
+
+        logger.info('Finished running FriendsBackfiller. %s',
+                    json.dumps({'name': self._name, 'n_done': n_done}))
+
+    def _iter_batches(self, query):
+        '''Yields lists of raw documents in _id order, streamed from cursor.'''
+        cursor = self._raw_collection.find(query).sort('_id', ASCENDING).batch_size(self._BATCH_SIZE)
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == self._BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _commit(self, future, last_id):
+        '''Writes result of a batch and moves checkpoint past it.
+
+        Batches are committed in submission order, so the checkpoint never
+        passes a batch that is not written yet.
+
+        Returns:
+            Number of raw documents done.
+        '''
+        cleaned_data_list, failed_data_list, errors, game_data_version = future.result()
+        failed_data_list = stamp_failed_data(failed_data_list, errors, game_data_version)
+        # Clean documents are written over, so a normalizer change reaches them
+        clean_counts = self._clean_writer.replace(cleaned_data_list)
+        if cleaned_data_list:
+            self._failed_collection.bulk_write(
+                [DeleteOne({'friend_code': friend['friend_code'], 'post_date': friend['post_date']})
+                 for friend in cleaned_data_list],
+                ordered=False
+            )
+        failed_counts = self._failed_writer.write(failed_data_list)
+        self._checkpoint_collection.update_one(
+            {'_id': self._name},
+            {'$set': {'last_id': last_id, 'updated_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        n_done = len(cleaned_data_list) + len(failed_data_list)
+        logger.info('Committed batch. %s',
+                    json.dumps({'last_id': str(last_id),
+                                'n_cleaned': len(cleaned_data_list),
+                                'n_failed': len(failed_data_list),
+                                'n_clean_inserted': clean_counts['n_inserted'],
+                                'n_clean_replaced': clean_counts['n_matched'],
+                                'n_failed_inserted': failed_counts['n_inserted']}))
+        return n_done
+
+    def _load_checkpoint(self):
+        '''Returns the last committed _id, or None if there is none.'''
+        checkpoint = self._checkpoint_collection.find_one({'_id': self._name})
+        if checkpoint is None:
+            return None
+        return checkpoint['last_id']
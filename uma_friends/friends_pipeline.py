@@ -0,0 +1,163 @@
+import json
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineError(Exception):
+    pass
+
+
+# Tells a stage there is no more input
+_END = object()
+
+
+class FriendsPipeline:
+    '''Normalizes and writes friend data in background threads while it is scraped.
+
+    Friend data put into the pipeline flows through two stages, each a
+    thread, connected by bounded queues:
+        1. normalize: collects friend data into batches of batch_size, or
+           whatever arrived within flush_interval, and normalizes them.
+        2. write: writes each batch into raw, clean and failed databases.
+    When a queue is full, putting into it blocks, so a slow stage slows down
+    scraping instead of piling up friend data in memory.
+
+    Usage:
+        with FriendsPipeline(clean, write) as pipeline:
+            pipeline.put(friends_data)
+    Leaving the block waits for everything put to be written, and raises
+    PipelineError if a stage failed.
+    '''
+    def __init__(self, clean, write, batch_size=200, queue_size=8, flush_interval=5):
+        '''Initializes FriendsPipeline.
+
+        Args:
+            clean:
+                A function taking a list of friend data and returning
+                (cleaned_data_list, failed_data_list).
+            write:
+                A function taking (friends_data, cleaned_data_list, failed_data_list)
+                and storing them.
+            batch_size:
+                An integer of how many friend data are normalized and written at once.
+            queue_size:
+                An integer of how many items each queue holds at most.
+            flush_interval:
+                A number of seconds. A batch that is not full is flushed
+                anyway after waiting this long for more friend data.
+        '''
+        self._clean = clean
+        self._write = write
+        self._BATCH_SIZE = batch_size
+        self._FLUSH_INTERVAL = flush_interval
+        self._normalize_queue = queue.Queue(maxsize=queue_size)
+        self._write_queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._n_written = 0
+        self._threads = [
+            threading.Thread(target=self._run_stage, args=(self._normalize_stage,),
+                             name='normalize', daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._write_stage,),
+                             name='write', daemon=True)
+        ]
+
+    def __enter__(self):
+        for thread in self._threads:
+            thread.start()
+        logger.info('Started friends pipeline. %s',
+                    json.dumps({'batch_size': self._BATCH_SIZE}))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Friend data already scraped is still written if scraping failed
+        self.close()
+        return False
+
+    def put(self, friends_data):
+        '''Puts a list of friend data into the pipeline.
+
+        Blocks while the pipeline is full.
+
+        Raises:
+            PipelineError, if a stage has failed.
+        '''
+        if friends_data:
+            self._put(self._normalize_queue, friends_data)
+
+    def close(self):
+        '''Waits until everything put is written.
+
+        Raises:
+            PipelineError, if a stage has failed.
+        '''
+        if self._error is None:
+            self._put(self._normalize_queue, _END)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise PipelineError('Friends pipeline failed.') from self._error
+        logger.info('Finished friends pipeline. %s',
+                    json.dumps({'n_written': self._n_written}))
+
+    def _put(self, q, item):
+        '''Puts item into q, giving up if a stage has failed.'''
+        while True:
+            if self._error is not None:
+                raise PipelineError('Friends pipeline failed.') from self._error
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            if self._error is None:
+                logger.exception('Exception occurred in friends pipeline.',
+                                 exc_info=e, stack_info=True)
+                self._error = e
+
+    def _normalize_stage(self):
+        batch = []
+        while self._error is None:
+            try:
+                friends_data = self._normalize_queue.get(timeout=self._FLUSH_INTERVAL)
+            except queue.Empty:
+                # Do not hold friend data back while scraping is slow
+                friends_data = None
+            if friends_data is _END:
+                break
+            if friends_data is not None:
+                batch.extend(friends_data)
+            while len(batch) >= self._BATCH_SIZE:
+                self._flush(batch[:self._BATCH_SIZE])
+                batch = batch[self._BATCH_SIZE:]
+            if friends_data is None and batch:
+                self._flush(batch)
+                batch = []
+        if self._error is not None:
+            return
+        if batch:
+            self._flush(batch)
+        self._put(self._write_queue, _END)
+
+    def _flush(self, batch):
+        cleaned_data_list, failed_data_list = self._clean(batch)
+        self._put(self._write_queue, (batch, cleaned_data_list, failed_data_list))
+
+    def _write_stage(self):
+        while self._error is None:
+            try:
+                item = self._write_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            self._write(*item)
+            self._n_written += len(item[0])
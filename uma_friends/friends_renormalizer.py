@@ -0,0 +1,135 @@
+import json
+import logging
+import re
+
+from pymongo import ASCENDING, DeleteOne
+
+from .bulk_writer import BulkWriter
+from .friend_stats import FriendStats
+from .indexes import ensure_indexes
+
+
+logger = logging.getLogger(__name__)
+
+
+class FriendsRenormalizer:
+    '''Re-normalizes only the raw friend data touched by game data changes.
+
+    UrarawinGameDataUpdater records what changed in every run. For each
+    recorded change, raw friend data referring to the changed keys is found
+    through indexes on the raw collection, normalized again, and written over
+    its clean counterpart. Those fixed are removed from the failed buffer.
+    '''
+    def __init__(self, raw_collection, clean_collection, failed_collection,
+                 changes_collection, gamewith_normalizer, batch_size=1000,
+                 stats_collection=None):
+        '''Initializes FriendsRenormalizer.
+
+        Args:
+            raw_collection:
+                A pymongo Collection. Stores raw data scraped from gamewith.
+            clean_collection:
+                A pymongo Collection. Stores clean-up data.
+            failed_collection:
+                A pymongo Collection. Stores friend data that cannot be normalized.
+            changes_collection:
+                A pymongo Collection. Stores game data changes recorded by
+                UrarawinGameDataUpdater.
+            gamewith_normalizer:
+                A GamewithNormalizer. Parses raw gamewith data.
+            batch_size:
+                An integer of how many raw documents are normalized at once.
+            stats_collection:
+                Optional pymongo Collection. If given, FriendStats counters
+                in it are updated along with every clean write.
+        '''
+        self._raw_collection = raw_collection
+        self._clean_collection = clean_collection
+        self._failed_collection = failed_collection
+        self._changes_collection = changes_collection
+        self._gamewith_normalizer = gamewith_normalizer
+        self._BATCH_SIZE = batch_size
+        hooks = {}
+        if stats_collection is not None:
+            friend_stats = FriendStats(stats_collection)
+            hooks = {'on_insert': friend_stats.add, 'on_replace': friend_stats.replace}
+        self._clean_writer = BulkWriter(clean_collection, batch_size=batch_size, **hooks)
+        logger.info('Finished initializing FriendsRenormalizer.')
+
+    def run(self):
+        '''Re-normalizes friend data for every pending game data change.'''
+        logger.info('Started running FriendsRenormalizer.')
+        pending_changes = list(self._changes_collection.find({'renormalized': False})
+                                                       .sort('created_at', ASCENDING))
+        if not pending_changes:
+            logger.info('No pending game data changes.')
+            return
+        ensure_indexes(self._raw_collection, 'raw')
+        # Game data has changed, snapshot must be fresh
+        self._gamewith_normalizer.load_snapshot()
+        for changes in pending_changes:
+            counts = self._renormalize(changes)
+            self._changes_collection.update_one(
+                {'_id': changes['_id']},
+                {'$set': {'renormalized': True, 'counts': counts}}
+            )
+        logger.info('Finished running FriendsRenormalizer.')
+
+    def _renormalize(self, changes):
+        '''Re-normalizes friend data affected by one recorded change.
+
+        Returns:
+            A dict of counts.
+        '''
+        query = self._build_query(changes)
+        logger.info('Started re-normalizing friend data. %s',
+                    json.dumps({'changes_id': str(changes['_id']),
+                                'n_matched': self._raw_collection.count_documents(query)}))
+        counts = {'n_cleaned': 0, 'n_failed': 0}
+        batch = []
+        for document in self._raw_collection.find(query, {'_id': 0}):
+            batch.append(document)
+            if len(batch) == self._BATCH_SIZE:
+                self._renormalize_batch(batch, counts)
+                batch = []
+        if batch:
+            self._renormalize_batch(batch, counts)
+        logger.info('Finished re-normalizing friend data. %s',
+                    json.dumps(dict(counts, changes_id=str(changes['_id']))))
+        return counts
+
+    def _renormalize_batch(self, batch, counts):
+        '''Normalizes and writes a batch, updating counts in place.'''
+        cleaned_data_list, failed_data_list = self._gamewith_normalizer.normalize_many(batch)
+        if cleaned_data_list:
+            self._clean_writer.replace(cleaned_data_list)
+            self._failed_collection.bulk_write(
+                [DeleteOne({'friend_code': friend['friend_code'], 'post_date': friend['post_date']})
+                 for friend in cleaned_data_list],
+                ordered=False
+            )
+        counts['n_cleaned'] += len(cleaned_data_list)
+        # Still failing friend data stays where it is
+        counts['n_failed'] += len(failed_data_list)
+
+    def _build_query(self, changes):
+        '''Returns a raw collection filter matching friend data touched by changes.
+
+        Every branch of the $or is served by an index on the raw collection.
+        Raw factors are strings of '<name><level>' or '<name><level>(代表<level>)',
+        matched by anchored regex so that the factors index is still used.
+        '''
+        branches = []
+        if changes['support_gw_ids']:
+            branches.append({'support_id': {'$in': changes['support_gw_ids']}})
+        if changes['image_urls']:
+            branches.append({'character_image_url': {'$in': changes['image_urls']}})
+        if changes['factor_names']:
+            branches.append({'factors': {'$in': [
+                re.compile('^' + re.escape(name) + r'\d(\(代表\d\))?$')
+                for name in changes['factor_names']
+            ]}})
+        if not branches:
+            # Matches nothing
+            return {'_id': {'$in': []}}
+        return {'$or': branches}
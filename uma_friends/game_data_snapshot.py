@@ -0,0 +1,140 @@
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class GameDataSnapshot:
+    '''In-memory lookup index over the game database.
+
+    Holds the few fields GamewithNormalizer looks up, keyed the way it looks
+    them up, so that normalizing does not need any database round trip.
+
+    Note that all ids are the ids already presented in the original urarawin
+    database, rather than the _id (MongoDB ObjectId) assigned when inserted
+    into our database.
+    '''
+    def __init__(self, support_id_by_gw_id, uma_id_by_image_url, skill_by_name,
+                 race_id_by_name, uma_id_by_unique_skill):
+        '''Initializes GameDataSnapshot.
+
+        Args:
+            support_id_by_gw_id:
+                A dict mapping gamewith support id to support id.
+            uma_id_by_image_url:
+                A dict mapping gamewith image url to uma id.
+            skill_by_name:
+                A dict mapping skill name to (skill_id, uniqueness).
+            race_id_by_name:
+                A dict mapping race name to race id.
+            uma_id_by_unique_skill:
+                A dict mapping unique skill id to uma id.
+        '''
+        self.support_id_by_gw_id = support_id_by_gw_id
+        self.uma_id_by_image_url = uma_id_by_image_url
+        self.skill_by_name = skill_by_name
+        self.race_id_by_name = race_id_by_name
+        self.uma_id_by_unique_skill = uma_id_by_unique_skill
+
+    @classmethod
+    def load(cls, game_data_database):
+        '''Loads the whole snapshot from game database.
+
+        Costs one query per collection.
+
+        Args:
+            game_data_database:
+                A pymongo database.
+        '''
+        logger.info('Started loading game data snapshot. %s',
+                    json.dumps({'database': game_data_database.name}))
+        supports = game_data_database['supports'].find({}, {'_id': 0, 'id': 1, 'gwId': 1})
+        players = game_data_database['players'].find(
+            {}, {'_id': 0, 'id': 1, 'gwImgUrl': 1, 'uniqueSkillList': 1})
+        skills = game_data_database['skills'].find({}, {'_id': 0, 'id': 1, 'name': 1, 'rare': 1})
+        races = game_data_database['races'].find({}, {'_id': 0, 'id': 1, 'name': 1})
+        snapshot = cls.from_documents(supports, players, skills, races)
+        logger.info('Finished loading game data snapshot. %s',
+                    json.dumps(snapshot.count()))
+        return snapshot
+
+    @classmethod
+    def load_subset(cls, game_data_database, support_gw_ids, image_urls, names):
+        '''Loads only the part of the snapshot needed for the given keys.
+
+        Costs one $in query per collection, plus one for the owners of the
+        unique skills found, no matter how many keys are given. A key missing
+        from the resulting snapshot is missing from the game database as well.
+
+        Args:
+            game_data_database:
+                A pymongo database.
+            support_gw_ids:
+                An iterable of gamewith support ids.
+            image_urls:
+                An iterable of gamewith uma image urls.
+            names:
+                An iterable of factor names, looked up as skills and races.
+        '''
+        names = list(set(names))
+        supports = game_data_database['supports'].find(
+            {'gwId': {'$in': list(set(support_gw_ids))}},
+            {'_id': 0, 'id': 1, 'gwId': 1})
+        players = list(game_data_database['players'].find(
+            {'gwImgUrl': {'$in': list(set(image_urls))}},
+            {'_id': 0, 'id': 1, 'gwImgUrl': 1, 'uniqueSkillList': 1}))
+        skills = list(game_data_database['skills'].find(
+            {'name': {'$in': names}},
+            {'_id': 0, 'id': 1, 'name': 1, 'rare': 1}))
+        races = game_data_database['races'].find(
+            {'name': {'$in': names}},
+            {'_id': 0, 'id': 1, 'name': 1})
+        unique_skill_ids = [skill['id'] for skill in skills if skill.get('rare') == '固有']
+        if unique_skill_ids:
+            # Parents are not necessarily among the main umas of the batch
+            players += list(game_data_database['players'].find(
+                {'uniqueSkillList': {'$in': unique_skill_ids}},
+                {'_id': 0, 'id': 1, 'uniqueSkillList': 1}))
+        return cls.from_documents(supports, players, skills, races)
+
+    @classmethod
+    def from_documents(cls, supports, players, skills, races):
+        '''Builds snapshot from iterables of game data documents.
+
+        When several documents share a key, the first one wins, the same as
+        find_one would return.
+        '''
+        support_id_by_gw_id = {}
+        for support in supports:
+            if 'gwId' in support:
+                support_id_by_gw_id.setdefault(support['gwId'], support['id'])
+
+        uma_id_by_image_url = {}
+        uma_id_by_unique_skill = {}
+        for uma in players:
+            if 'gwImgUrl' in uma:
+                uma_id_by_image_url.setdefault(uma['gwImgUrl'], uma['id'])
+            for skill_id in uma.get('uniqueSkillList') or []:
+                uma_id_by_unique_skill.setdefault(skill_id, uma['id'])
+
+        skill_by_name = {}
+        for skill in skills:
+            skill_by_name.setdefault(skill['name'], (skill['id'], skill.get('rare') == '固有'))
+
+        race_id_by_name = {}
+        for race in races:
+            race_id_by_name.setdefault(race['name'], race['id'])
+
+        return cls(support_id_by_gw_id, uma_id_by_image_url, skill_by_name,
+                   race_id_by_name, uma_id_by_unique_skill)
+
+    def count(self):
+        '''Returns a dict of how many keys each index holds.'''
+        return {
+            'supports': len(self.support_id_by_gw_id),
+            'players': len(self.uma_id_by_image_url),
+            'skills': len(self.skill_by_name),
+            'races': len(self.race_id_by_name),
+            'unique_skills': len(self.uma_id_by_unique_skill)
+        }
@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+from lxml import etree, html
+from pymongo import ReplaceOne
+from .utils import as_utc, make_session
+
+
+logger = logging.getLogger(__name__)
+
+
+# The uma image inside the "uma_joubu" box links back to the article itself
+_IMAGE_URL_XPATH = etree.XPath(
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' uma_joubu ')]"
+    "//a[@href=$url]//img/@data-original")
+
+
+class ImageUrlError(Exception):
+    pass
+
+
+class RateLimiter:
+    '''Spaces out requests to the same host, shared by all threads.'''
+    def __init__(self, requests_per_second):
+        self._INTERVAL = 1 / requests_per_second
+        self._lock = threading.Lock()
+        self._next_time = {}
+
+    def wait(self, url):
+        '''Blocks until a request to the host of url is allowed.'''
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_time.get(host, now))
+            self._next_time[host] = start_time + self._INTERVAL
+        time.sleep(start_time - now)
+
+
+class GamewithImageUrlFetcher:
+    '''Fetches gamewith uma article pages concurrently to find uma image urls.
+
+    If a cache collection is given, resolved image urls are kept there along
+    with the ETag / Last-Modified of their page:
+    {
+        '_id': <gamewith id>,
+        'gwImgUrl': <image url>,
+        'etag': <ETag header or None>,
+        'last_modified': <Last-Modified header or None>,
+        'checked_at': <datetime of the last request>
+    }
+    Cached image urls checked within ttl are used without any request. Older
+    ones are revalidated with a conditional GET, which is answered with an
+    empty 304 if the page has not changed.
+    '''
+    def __init__(self, uma_article_base_url, session=None, max_workers=8,
+                 max_retries=3, backoff_factor=1, requests_per_second=5, timeout=30,
+                 cache_collection=None, ttl=timedelta(days=7)):
+        '''Initializes GamewithImageUrlFetcher.
+
+        Args:
+            uma_article_base_url:
+                A string of base url link of gamewith articles.
+            session:
+                Optional requests.Session. Defaults to a pooled session that
+                retries failed requests with backoff. Retries are made by
+                urllib3 inside the session, so they bypass the rate limit of
+                requests_per_second; backoff is what spaces them out.
+            max_workers:
+                An integer of how many pages are fetched at the same time.
+            max_retries:
+                An integer of how many times a failed request is retried.
+            backoff_factor:
+                A number. Retries wait backoff_factor * 2 ** (retry - 1) seconds.
+            requests_per_second:
+                A number of how many requests at most are sent to a host per
+                second, not counting retries.
+            timeout:
+                An integer of how many seconds to wait for a response.
+            cache_collection:
+                Optional pymongo Collection to cache image urls in.
+            ttl:
+                A timedelta of how long a cached image url is used before
+                it is revalidated.
+        '''
+        self._uma_article_base_url = uma_article_base_url
+        if self._uma_article_base_url[-1] != '/':
+            self._uma_article_base_url += '/'
+        self._MAX_WORKERS = max_workers
+        self._TIMEOUT = timeout
+        if session is None:
+            # One pooled connection per worker
+            session = make_session(max_retries=max_retries, backoff_factor=backoff_factor,
+                                   pool_maxsize=max_workers)
+        self._session = session
+        self._rate_limiter = RateLimiter(requests_per_second)
+        self._cache_collection = cache_collection
+        self._TTL = ttl
+
+    def fetch_all(self, gamewith_ids):
+        '''Returns image urls of umas.
+
+        Only pages of umas not cached, or cached longer than ttl ago, are
+        requested.
+
+        Args:
+            gamewith_ids:
+                Iterable of strings of gamewith uma ids.
+
+        Returns:
+            A dict mapping gamewith id to image url.
+
+        Raises:
+            ImageUrlError, if image url of some uma cannot be found.
+            Anything else raised fetching a page. Entries of pages fetched
+            successfully are cached first either way.
+        '''
+        gamewith_ids = list(gamewith_ids)
+        cache = self._load_cache(gamewith_ids)
+        now = datetime.now(timezone.utc)
+        image_urls = {gamewith_id: entry['gwImgUrl'] for gamewith_id, entry in cache.items()
+                      if now - as_utc(entry['checked_at']) < self._TTL}
+        to_fetch = [gamewith_id for gamewith_id in gamewith_ids if gamewith_id not in image_urls]
+        logger.info('Started fetching uma image urls. %s',
+                    json.dumps({'count': len(gamewith_ids), 'n_fresh': len(image_urls),
+                                'n_to_fetch': len(to_fetch), 'max_workers': self._MAX_WORKERS}))
+        with ThreadPoolExecutor(max_workers=self._MAX_WORKERS) as executor:
+            futures = [executor.submit(self.fetch_entry, gamewith_id, cache.get(gamewith_id))
+                       for gamewith_id in to_fetch]
+        results = [future.result() for future in futures if future.exception() is None]
+        entries = [entry for entry, _ in results]
+        # Kept even if some page failed, so the next run need not fetch them again
+        self._save_cache(entries)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            logger.error('Failed fetching some uma image urls. %s',
+                         json.dumps({'n_failed': len(errors), 'n_cached': len(entries)}))
+            raise errors[0]
+        image_urls.update((entry['_id'], entry['gwImgUrl']) for entry in entries)
+        logger.info('Finished fetching uma image urls. %s',
+                    json.dumps({'n_not_modified': sum(not_modified for _, not_modified in results)}))
+        return image_urls
+
+    def fetch(self, gamewith_id):
+        '''Returns image url of an uma, ignoring cache.
+
+        Args:
+            gamewith_id:
+                A string of gamewith uma id.
+
+        Raises:
+            ImageUrlError, if image url cannot be found.
+        '''
+        entry, _ = self.fetch_entry(gamewith_id)
+        return entry['gwImgUrl']
+
+    def fetch_entry(self, gamewith_id, cached_entry=None):
+        '''Fetches image url of an uma, revalidating cached_entry if given.
+
+        Args:
+            gamewith_id:
+                A string of gamewith uma id.
+            cached_entry:
+                Optional dict of cache entry of this uma.
+
+        Returns:
+            (entry, not_modified)
+            entry: A dict of the new cache entry.
+            not_modified: Bool whether the page was unchanged since cached_entry.
+
+        Raises:
+            ImageUrlError, if image url cannot be found.
+        '''
+        url = self._uma_article_base_url + gamewith_id
+        headers = {}
+        if cached_entry is not None:
+            if cached_entry.get('etag'):
+                headers['If-None-Match'] = cached_entry['etag']
+            if cached_entry.get('last_modified'):
+                headers['If-Modified-Since'] = cached_entry['last_modified']
+        self._rate_limiter.wait(url)
+        response = self._session.get(url, headers=headers, timeout=self._TIMEOUT)
+        response.raise_for_status()
+        checked_at = datetime.now(timezone.utc)
+
+        if response.status_code == 304 and cached_entry is not None:
+            entry = dict(cached_entry, checked_at=checked_at)
+            return entry, True
+
+        entry = {
+            '_id': gamewith_id,
+            'gwImgUrl': self.extract(response.content, url, gamewith_id),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'checked_at': checked_at
+        }
+        return entry, False
+
+    def _load_cache(self, gamewith_ids):
+        '''Returns a dict mapping gamewith id to its cache entry.'''
+        if self._cache_collection is None:
+            return {}
+        return {entry['_id']: entry
+                for entry in self._cache_collection.find({'_id': {'$in': gamewith_ids}})}
+
+    def _save_cache(self, entries):
+        '''Writes cache entries in one bulk.'''
+        if self._cache_collection is None or not entries:
+            return
+        self._cache_collection.bulk_write(
+            [ReplaceOne({'_id': entry['_id']}, entry, upsert=True) for entry in entries],
+            ordered=False
+        )
+
+    @staticmethod
+    def extract(page, url, gamewith_id):
+        '''Returns image url found in uma article page.
+
+        Args:
+            page:
+                Bytes of the article page html.
+            url:
+                A string of url link of the article page.
+            gamewith_id:
+                A string of gamewith uma id, for logging.
+
+        Raises:
+            ImageUrlError, if image url cannot be found.
+        '''
+        image_urls = _IMAGE_URL_XPATH(html.fromstring(page), url=url)
+        if not image_urls:
+            logger.error('Cannot find image url. %s',
+                         json.dumps({'gamewith_id': gamewith_id, 'url': url}))
+            raise ImageUrlError('Cannot find image url.')
+        return image_urls[0]
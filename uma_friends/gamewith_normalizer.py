@@ -23,7 +23,16 @@ Example friend data from gamewith:
 }
 '''
 import copy
+import functools
+import json
 import logging
+import re
+import time
+
+from cachetools import LRUCache
+from pymongo import DESCENDING
+
+from .game_data_snapshot import GameDataSnapshot
 
 
 logger = logging.getLogger(__name__)
@@ -33,6 +42,59 @@ class OutdatedError(Exception):
     pass
 
 
+class _LookupCache(LRUCache):
+    '''An LRUCache of game database lookups, counting how it is used.
+
+    Lookups count hits and misses themselves; evictions are counted here.
+    '''
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def clear(self):
+        # Entries dropped at once are not evicted to make room
+        evictions = self.evictions
+        super().clear()
+        self.evictions = evictions
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self)}
+
+
+# '<name><total level>' or '<name><total level>(代表<main level>)'.
+# Names may end with digits themselves, levels are always one digit.
+_FACTOR_PATTERN = re.compile(r'(.+)(\d)(?:\(代表(\d)\))?')
+
+
+# Friends share a limited vocabulary of factor strings, so most are parsed once
+@functools.lru_cache(maxsize=1 << 16)
+def _parse_factor_string(factor_string):
+    '''Returns (name, total_level, main_level) of a factor string.
+
+    Raises:
+        ValueError, if factor_string is malformed.
+    '''
+    match = _FACTOR_PATTERN.fullmatch(factor_string)
+    if match is None:
+        raise ValueError(f'Malformed factor: {factor_string!r}')
+    name, total_level, main_level = match.groups()
+    return name, int(total_level), int(main_level) if main_level is not None else None
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _factor_level_key(name, level):
+    '''Returns '<name>:<level>', see GamewithNormalizer.summarize.'''
+    return f'{name}:{level}'
+
+
 class GamewithNormalizer:
     _BLUES = [
         'スピード',
@@ -58,14 +120,106 @@ class GamewithNormalizer:
         '追込'
     ]
 
-    def __init__(self, game_data_database):
+    # Types of factors that are neither skills nor races
+    _BASE_FACTOR_TYPES = {
+        **dict.fromkeys(_BLUES, 'blue'),
+        **dict.fromkeys(_FIELD_TYPES, 'field_type'),
+        **dict.fromkeys(_DISTANCES, 'distance'),
+        **dict.fromkeys(_STRATEGIES, 'strategy'),
+        'URAシナリオ': 'ura'
+    }
+
+    # Star totals of a friend without factors, see summarize
+    _NO_STARS = dict.fromkeys(['blue', 'field_type', 'distance', 'strategy', 'ura',
+                               'unique_skill', 'common_skill', 'race'], 0)
+
+    # How often, in seconds, normalize without snapshot checks whether game
+    # data changed, to drop what it cached from game database
+    _VERSION_CHECK_INTERVAL = 60
+
+    def __init__(self, game_data_database, snapshot=None, cache_size=4096):
+        '''Initializes GamewithNormalizer.
+
+        Args:
+            game_data_database:
+                A pymongo database.
+            snapshot:
+                Optional GameDataSnapshot. If given, all lookups are served
+                from it and the game database is never queried. Without
+                one, normalize_many loads what each batch needs, while
+                lookups of normalize are cached until game data changes.
+            cache_size:
+                An integer of how many lookups each cache keeps at most,
+                least recently used evicted first.
+        '''
         self._game_data_database = game_data_database
+        self._set_snapshot(snapshot)
+        # Factor types of every skill and race in game database, loaded
+        # when first needed without snapshot
+        self._database_factor_types = None
+        # What game data the caches were filled from, and when it was checked
+        self._game_data_version = None
+        self._version_checked_at = None
         self._cache = {
-            'find_skill_by_name': {},
-            'find_race_by_name': {},
-            'find_uma_by_unique_skill': {}
+            'find_skill_by_name': _LookupCache(cache_size),
+            'find_race_by_name': _LookupCache(cache_size),
+            'find_uma_by_unique_skill': _LookupCache(cache_size)
         }
 
+    def load_snapshot(self):
+        '''Loads game database into memory, switching to snapshot mode.
+
+        Call again after game database is updated to pick up the changes.
+        '''
+        self._set_snapshot(GameDataSnapshot.load(self._game_data_database))
+
+    def _set_snapshot(self, snapshot):
+        '''Switches to snapshot, or out of snapshot mode if None.'''
+        self._snapshot = snapshot
+        self._snapshot_factor_types = None
+        if snapshot is not None:
+            self._snapshot_factor_types = self._build_factor_types(
+                snapshot.skill_by_name.items(), snapshot.race_id_by_name)
+
+    def game_data_version(self):
+        '''Returns a string identifying game data, or None if never imported.
+
+        It is the content hash of game data last imported by
+        UrarawinGameDataUpdater, so it changes whenever game data does.
+        '''
+        import_state = self._game_data_database['imports'].find_one(
+            {}, sort=[('imported_at', DESCENDING)])
+        if import_state is None:
+            return None
+        return import_state['sha256']
+
+    def _check_game_data_version(self):
+        '''Drops factor types and lookups cached from game database if game data changed.
+
+        Game database is asked at most once every _VERSION_CHECK_INTERVAL seconds.
+        '''
+        now = time.monotonic()
+        is_first_check = self._version_checked_at is None
+        if not is_first_check and now - self._version_checked_at < self._VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked_at = now
+        version = self.game_data_version()
+        if version == self._game_data_version:
+            return
+        self._game_data_version = version
+        if is_first_check:
+            # Nothing cached yet
+            return
+        logger.info('Game data changed. Dropped cached lookups. %s',
+                    json.dumps({'version': version, 'cache_stats': self.cache_stats()}))
+        self._database_factor_types = None
+        for cache in self._cache.values():
+            cache.clear()
+
+    def cache_stats(self):
+        '''Returns a dict of hits, misses, evictions and size of each lookup cache.'''
+        return {name: cache.stats() for name, cache in self._cache.items()}
+
     def normalize(self, friend_data):
         '''Return normalized friend data.
 
@@ -76,6 +230,45 @@ class GamewithNormalizer:
         Raises:
             OutdatedError, if look up in game database fails.
         '''
+        if self._snapshot is None:
+            self._check_game_data_version()
+        friend = self._normalize_fields(friend_data)
+        friend['summary'] = self.summarize(friend)
+        return friend
+
+    @classmethod
+    def summarize(cls, friend):
+        '''Returns fields derived from normalized friend data, for ranking queries.
+
+        Format of summary:
+        {
+            'stars': {<factor type>: <total level of factors of the type>},
+            'factor_levels': sorted ['<factor name>:<total level>'],
+            'parent_ids': sorted ids of parents
+        }
+
+        Args:
+            friend:
+                A dict of normalized friend data.
+        '''
+        stars = cls._NO_STARS.copy()
+        factor_levels = []
+        for factor in friend['factors'] or []:
+            stars[factor['type']] += factor['level']
+            factor_levels.append(_factor_level_key(factor['name'], factor['level']))
+        factor_levels.sort()
+        return {
+            'stars': stars,
+            'factor_levels': factor_levels,
+            'parent_ids': sorted(parent['id'] for parent in friend['parents'] or []
+                                 if parent['id'] is not None)
+        }
+
+    def _normalize_fields(self, friend_data):
+        '''Returns normalized friend data, without summary.
+
+        See normalize.
+        '''
         friend = {}
 
         friend['friend_code'] = friend_data['friend_code']
@@ -108,8 +301,7 @@ class GamewithNormalizer:
             friend['main_uma'] = main_uma
             return friend
 
-        factors = self._parse_factors(friend_data['factors'])
-        main_uma_factors, total_factors = self._extract_main_and_total_factors(factors, main_uma_id)
+        main_uma_factors, total_factors = self._split_factors(friend_data['factors'])
 
         main_uma['factors'] = main_uma_factors
         friend['main_uma'] = main_uma
@@ -122,6 +314,107 @@ class GamewithNormalizer:
 
         return friend
 
+    def normalize_many(self, friends_data, errors=None):
+        '''Normalizes a batch of friend data.
+
+        Game data needed by the whole batch is resolved up front with a
+        constant number of queries (none in snapshot mode), instead of a few
+        queries per friend.
+
+        Args:
+            friends_data:
+                An iterable of dicts consisting of raw friend data.
+            errors:
+                Optional list. If given, a string describing why each friend
+                data failed is appended to it, in the order of failed_data_list.
+
+        Returns:
+            (cleaned_data_list, failed_data_list)
+            cleaned_data_list: data that are normalized successfully.
+            failed_data_list: raw friend data that failed normalizing.
+        '''
+        friends_data = list(friends_data)
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return self._normalize_each(friends_data, snapshot, errors)
+
+        support_gw_ids = set()
+        image_urls = set()
+        factor_names = set()
+        for friend_data in friends_data:
+            if friend_data.get('support_id') is not None:
+                support_gw_ids.add(friend_data['support_id'])
+            if friend_data.get('character_image_url') is not None:
+                image_urls.add(friend_data['character_image_url'])
+            for factor_string in friend_data.get('factors') or []:
+                try:
+                    factor_names.add(self._get_factor_name(factor_string))
+                except (TypeError, ValueError):
+                    # Malformed, fails only this friend data in _normalize_each
+                    continue
+
+        snapshot = GameDataSnapshot.load_subset(
+            self._game_data_database, support_gw_ids, image_urls, factor_names)
+        return self._normalize_each(friends_data, snapshot, errors)
+
+    def _normalize_each(self, friends_data, snapshot, errors=None):
+        '''Normalizes friend data one by one, splitting cleaned from failed.
+
+        Args:
+            friends_data:
+                List of dicts consisting of raw friend data.
+            snapshot:
+                A GameDataSnapshot serving every lookup.
+            errors:
+                The same as normalize_many.
+
+        Returns:
+            The same as normalize_many.
+        '''
+        normalizer = self
+        if snapshot is not self._snapshot:
+            # Lookups go through a copy, so that others sharing this
+            # normalizer never see the snapshot of this batch
+            normalizer = copy.copy(self)
+            normalizer._set_snapshot(snapshot)
+        # Stores normalized friend data
+        cleaned_data_list = []
+        # Stores friend data (in original form) which failed to be normalize
+        failed_data_list = []
+
+        for friend_data in friends_data:
+            try:
+                cleaned_data = normalizer.normalize(friend_data)
+            except OutdatedError as e:
+                friend_data_identify = {
+                    'friend_code': friend_data['friend_code'],
+                    'post_date': str(friend_data['post_date'])
+                }
+                logger.exception('Game database outdated. Lookup in game database failed. %s',
+                                 json.dumps({'friend_data': friend_data_identify}, ensure_ascii=False),
+                                 exc_info=e,
+                                 stack_info=True)
+                failed_data_list.append(friend_data)
+                if errors is not None:
+                    errors.append(repr(e))
+                continue
+            except Exception as e:
+                friend_data_identify = {
+                    'friend_code': friend_data['friend_code'],
+                    'post_date': str(friend_data['post_date'])
+                }
+                logger.exception('Something went wrong during normalizing friend data. %s',
+                                 json.dumps({'friend_data': friend_data_identify}, ensure_ascii=False),
+                                 exc_info=e,
+                                 stack_info=True)
+                failed_data_list.append(friend_data)
+                if errors is not None:
+                    errors.append(repr(e))
+                continue
+            cleaned_data_list.append(cleaned_data)
+
+        return cleaned_data_list, failed_data_list
+
     def _find_support_id_by_gamewith_id(self, gw_id):
         '''Returns support id corresponding to gamewith id.
 
@@ -131,6 +424,12 @@ class GamewithNormalizer:
         Raises:
             OutdatedError, if not found.
         '''
+        if self._snapshot is not None:
+            support_id = self._snapshot.support_id_by_gw_id.get(gw_id)
+            if support_id is None:
+                raise OutdatedError('Cannot find support in database.')
+            return support_id
+
         support = self._game_data_database['supports'].find_one(
             {'gwId': gw_id},
             {'_id': 0, 'id': 1}
@@ -148,6 +447,12 @@ class GamewithNormalizer:
         Raises:
             OutdatedError, if not found.
         '''
+        if self._snapshot is not None:
+            uma_id = self._snapshot.uma_id_by_image_url.get(image_url)
+            if uma_id is None:
+                raise OutdatedError('Cannot find uma in database.')
+            return uma_id
+
         uma = self._game_data_database['players'].find_one(
             {'gwImgUrl': image_url},
             {'_id': 0, 'id': 1}
@@ -156,78 +461,52 @@ class GamewithNormalizer:
             raise OutdatedError('Cannot find uma in database.')
         return uma['id']
 
-    def _extract_main_and_total_factors(self, factors, main_uma_id):
+    def _split_factors(self, factor_string_list):
         '''Returns a list of main uma factors and a list of total factors.
 
+        Both are built in one pass over factor strings, each factor being a
+        dict of name, type and level, where level is main uma's level for
+        main uma factors and the combined level for total factors.
+
         Args:
-            factors:
-                List of dict (parsed factors).
-            main_uma_id:
-                A string of the id of main uma.
+            factor_string_list: List of string, see _parse_factor_fields.
         '''
         main_uma_factors = []
-        for factor in factors:
-            if 'main_level' in factor:
-                factor_ = copy.deepcopy(factor)
-                # Does not need total_level
-                del factor_['total_level']
-                # main_level as level instead
-                factor_['level'] = factor_.pop('main_level')
-                main_uma_factors.append(factor_)
-
         total_factors = []
-        for factor in factors:
-            factor_ = copy.deepcopy(factor)
-            # Does not need main_level
-            if 'main_level' in factor_:
-                del factor_['main_level']
-            # total_level as level instead
-            factor_['level'] = factor_.pop('total_level')
-            total_factors.append(factor_)
-
+        for factor_string in factor_string_list:
+            name, factor_type, total_level, main_level = self._parse_factor_fields(factor_string)
+            total_factors.append({'name': name, 'type': factor_type, 'level': total_level})
+            if main_level is not None:
+                main_uma_factors.append({'name': name, 'type': factor_type, 'level': main_level})
         return main_uma_factors, total_factors
 
-    def _parse_factors(self, factor_string_list):
-        '''Returns list of parsed factors.
-
-        Args:
-            factor_string_list: List of string.
-        '''
-        return [self._parse_factor(factor_string)
-                for factor_string in factor_string_list]
-
-    def _parse_factor(self, factor_string):
-        '''Returns parsed factor.
+    def _parse_factor_fields(self, factor_string):
+        '''Returns (name, type, total_level, main_level) of a factor string.
 
         Factor comes in two types:
         1. '<factor name><factor total level>'
         2. '<factor name><factor total level>(代表<factor main level>)'
 
-        Format of parsed factor:
-        {
-            'name': <factor name>,
-            'type': <factor type>,
-            'total_level': <total level of this factor, main uma's and parents' combined>,
-            'main_level': <main uma's level of this factor>
-        }
+        total_level is main uma's and parents' combined. main_level is main
+        uma's, None if the factor is not main uma's.
 
         Args:
             factor_string: A string.
+
+        Raises:
+            ValueError, if factor_string is malformed.
         '''
-        factor = {}
+        name, total_level, main_level = _parse_factor_string(factor_string)
+        return name, self._get_factor_type(name), total_level, main_level
 
-        s = factor_string.split('(代表')
-        factor_name = s[0][:-1]
-        factor['name'] = factor_name
-        factor_type = self._get_factor_type(factor_name)
-        factor['type'] = factor_type
-        total_level = int(s[0][-1])
-        factor['total_level'] = total_level
-        if len(s) == 2:
-            main_level = int(s[1][0])
-            factor['main_level'] = main_level
+    @staticmethod
+    def _get_factor_name(factor_string):
+        '''Returns the name part of a factor string.
 
-        return factor
+        Args:
+            factor_string: A string, see _parse_factor_fields.
+        '''
+        return _parse_factor_string(factor_string)[0]
 
     def _get_factor_type(self, factor_name):
         '''Returns type of factor.
@@ -237,24 +516,41 @@ class GamewithNormalizer:
         some skills might wrongly be classified as race
 
         '''
-        if factor_name in self._BLUES:
-            return 'blue'
-        elif factor_name in self._FIELD_TYPES:
-            return 'field_type'
-        elif factor_name in self._DISTANCES:
-            return 'distance'
-        elif factor_name in self._STRATEGIES:
-            return 'strategy'
-        elif factor_name == 'URAシナリオ':
-            return 'ura'
+        if self._snapshot is not None:
+            factor_types = self._snapshot_factor_types
         else:
-            skill_id, skill_is_unique = \
-                self._find_skill_id_and_uniqueness_by_name(factor_name)
-            if skill_id is not None:
-                if skill_is_unique:
-                    return 'unique_skill'
-                return 'common_skill'
-            return 'race'
+            if self._database_factor_types is None:
+                self._database_factor_types = self._load_factor_types()
+            factor_types = self._database_factor_types
+        return factor_types.get(factor_name, 'race')
+
+    def _load_factor_types(self):
+        '''Returns factor types of every skill and race in game database.'''
+        skills = self._game_data_database['skills'].find({}, {'_id': 0, 'name': 1, 'rare': 1})
+        races = self._game_data_database['races'].find({}, {'_id': 0, 'name': 1})
+        return self._build_factor_types(
+            ((skill['name'], (None, skill.get('rare') == '固有')) for skill in skills if 'name' in skill),
+            (race['name'] for race in races if 'name' in race))
+
+    @classmethod
+    def _build_factor_types(cls, skill_items, race_names):
+        '''Returns a dict of factor name to factor type.
+
+        Args:
+            skill_items:
+                An iterable of (skill name, (skill id, uniqueness)).
+            race_names:
+                An iterable of race names.
+        '''
+        skill_types = {}
+        for name, (_, is_unique) in skill_items:
+            # The first skill of a name wins, the same as find_one
+            skill_types.setdefault(name, 'unique_skill' if is_unique else 'common_skill')
+        factor_types = dict.fromkeys(race_names, 'race')
+        # Skills, then base types, win over races of the same name
+        factor_types.update(skill_types)
+        factor_types.update(cls._BASE_FACTOR_TYPES)
+        return factor_types
 
     def _guess_parents_by_unique_skill_factors(self, unique_skill_factors, main_uma_id):
         '''Returns list of dicts of parents.
@@ -288,9 +584,14 @@ class GamewithNormalizer:
             assigned when inserted into our database.
             If skill is not found, returns (None, False).
         '''
+        if self._snapshot is not None:
+            return self._snapshot.skill_by_name.get(skill_name, (None, False))
+
         cache = self._cache['find_skill_by_name']
         if skill_name in cache:
+            cache.hits += 1
             return cache[skill_name]
+        cache.misses += 1
 
         collection = self._game_data_database['skills']
         skill = collection.find_one(
@@ -317,9 +618,14 @@ class GamewithNormalizer:
         Args:
             skill_id: A string representing the id of a unique skill.
         '''
+        if self._snapshot is not None:
+            return self._snapshot.uma_id_by_unique_skill.get(skill_id)
+
         cache = self._cache['find_uma_by_unique_skill']
         if skill_id in cache:
+            cache.hits += 1
             return cache[skill_id]
+        cache.misses += 1
 
         collection = self._game_data_database['players']
         uma = collection.find_one(
@@ -347,9 +653,14 @@ class GamewithNormalizer:
             assigned when inserted into our database.
             Returns None if race is not found.
         '''
+        if self._snapshot is not None:
+            return self._snapshot.race_id_by_name.get(race_name)
+
         cache = self._cache['find_race_by_name']
         if race_name in cache:
+            cache.hits += 1
             return cache[race_name]
+        cache.misses += 1
 
         collection = self._game_data_database['races']
         race = collection.find_one(
@@ -1,21 +1,108 @@
+from datetime import timedelta
+import io
 import json
 import logging
 import re
 import time
 
-from bs4 import BeautifulSoup
+from lxml import etree
 from selenium.common.exceptions import NoSuchElementException
-from pymongo import ASCENDING
-from pymongo.errors import BulkWriteError
+from pymongo import DESCENDING
 
-from .gamewith_normalizer import OutdatedError
-from .utils import get_utc_datetime
+from .bulk_writer import BulkWriter
+from .failed_data_retrier import FailedDataRetrier
+from .friend_stats import FriendStats
+from .friends_pipeline import FriendsPipeline
+from .indexes import ensure_indexes
+from .post_date_resolver import PostDateResolver
+from .utils import as_utc
 
 
 logger = logging.getLogger(__name__)
 
 
-DUPLICATE_KEY_ERROR_CODE = 11000
+FRIEND_CLASS = '-r-uma-musume-friends-list-item'
+
+
+# Calls back with the number of elements matching selector in root as soon as
+# it exceeds min_count, or with null after timeout_ms. A MutationObserver on
+# root is what wakes it up, so there is no polling.
+_WAIT_FOR_ELEMENTS_SCRIPT = '''
+var root = arguments[0], selector = arguments[1], minCount = arguments[2],
+    timeoutMs = arguments[3], done = arguments[arguments.length - 1];
+function count() { return root.querySelectorAll(selector).length; }
+if (count() > minCount) { done(count()); return; }
+var timer;
+var observer = new MutationObserver(function () {
+    var n = count();
+    if (n > minCount) { observer.disconnect(); clearTimeout(timer); done(n); }
+});
+observer.observe(root, {childList: true, subtree: true});
+timer = setTimeout(function () { observer.disconnect(); done(null); }, timeoutMs);
+'''
+
+# Returns outerHTML of friends not harvested yet and marks them harvested.
+# If prune is true, they are removed from page instead, keeping page small.
+# The list items are owned by the page's framework, which may still refer to
+# them when it renders the next friends, so the last one is kept in place as
+# the anchor new friends are inserted after.
+_HARVEST_FRIENDS_SCRIPT = '''
+var root = arguments[0], prune = arguments[1];
+var items = root.querySelectorAll('.-r-uma-musume-friends-list-item:not([data-harvested])');
+var htmls = [];
+for (var i = 0; i < items.length; i++) {
+    htmls.push(items[i].outerHTML);
+    items[i].setAttribute('data-harvested', '');
+}
+if (prune) {
+    var harvested = root.querySelectorAll('.-r-uma-musume-friends-list-item[data-harvested]');
+    for (var j = 0; j < harvested.length - 1; j++) {
+        harvested[j].remove();
+    }
+}
+return htmls;
+'''
+
+# Friends loaded on page but not harvested yet
+_NEW_FRIEND_SELECTOR = '.' + FRIEND_CLASS + ':not([data-harvested])'
+
+
+def _has_class(element, class_name):
+    return class_name in (element.get('class') or '').split()
+
+
+def _class_path(class_name):
+    '''Returns an XPath expression of descendants having class_name.'''
+    return ".//*[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]".format(class_name)
+
+
+def _class_xpath(class_name):
+    '''Returns a precompiled XPath finding descendants having class_name.'''
+    return etree.XPath(_class_path(class_name))
+
+
+# Evaluated once per friend <li>, each scanning only that subtree
+_SUPPORT_HREF_XPATH = etree.XPath(
+    '({}//a)[1]/@href'.format(_class_path('-r-uma-musume-friends-list-item__support-wrap')))
+_SUPPORT_LIMIT_XPATH = _class_xpath('-r-uma-musume-friends-list-item__limitNumber')
+_TRAINER_ID_XPATH = _class_xpath('-r-uma-musume-friends-list-item__trainerId__text')
+_MAIN_UMA_IMG_SRC_XPATH = etree.XPath(
+    '({}//img)[1]/@src'.format(_class_path('-r-uma-musume-friends-list-item__mainUmaMusume-wrap')))
+_FACTOR_XPATH = _class_xpath('-r-uma-musume-friends-list-item__factor-list__item')
+_COMMENT_XPATH = _class_xpath('-r-uma-musume-friends-list-item__comment')
+_POST_DATE_XPATH = _class_xpath('-r-uma-musume-friends-list-item__postDate')
+
+
+def _text(element):
+    return ''.join(element.itertext()).strip()
+
+
+def _first_text(xpath, element):
+    '''Returns stripped text of the first match of xpath, or None.'''
+    matches = xpath(element)
+    if not matches:
+        return None
+    return _text(matches[0])
 
 
 class PageError(Exception):
@@ -24,8 +111,14 @@ class PageError(Exception):
 
 class GamewithScraper:
     '''A web scraper that fetches friend data from gamewith website.'''
+    # Friends posted this long before the newest one in raw database are
+    # preloaded to tell whether the page has reached what is already scraped
+    _KNOWN_FRIENDS_WINDOW = timedelta(hours=1)
+
     def __init__(self, driver, url, timeout, button_limit, raw_collection,
-                 clean_collection, failed_collection, gamewith_normalizer):
+                 clean_collection, failed_collection, gamewith_normalizer,
+                 prune_harvested=False, batch_size=200, queue_size=8,
+                 write_batch_size=500, stats_collection=None):
         '''Initializes GamewithScraper.
 
         Args:
@@ -48,6 +141,25 @@ class GamewithScraper:
                 A pymongo Collection. Stores friend data that cannot be normalized.
             gamewith_normalizer:
                 A GamewithNormalizer. Parses raw gamewith data.
+            prune_harvested:
+                Bool. If True, friends are removed from page once harvested,
+                so page size stays bounded however many times "もっと見る"
+                is clicked. The removed nodes belong to the page's framework,
+                so a page update may stop rendering new friends; the last
+                harvested friend is always kept, and a click that loads
+                nothing is logged along with whether pruning is on.
+            batch_size:
+                An integer of how many friend data are normalized and
+                written at once.
+            queue_size:
+                An integer of how many batches may wait between scraping,
+                normalizing and writing.
+            write_batch_size:
+                An integer of how many documents are sent to database
+                in one bulk write.
+            stats_collection:
+                Optional pymongo Collection. If given, FriendStats counters
+                in it are updated along with every clean insert.
         '''
         self._driver = driver
         self._URL = url
@@ -57,81 +169,134 @@ class GamewithScraper:
         self._clean_collection = clean_collection
         self._failed_collection = failed_collection
         self._gamewith_normalizer = gamewith_normalizer
+        self._PRUNE_HARVESTED = prune_harvested
+        self._BATCH_SIZE = batch_size
+        self._QUEUE_SIZE = queue_size
+        # Writes are upserts keyed on friend_code and post_date, so
+        # re-writing friend data already stored is harmless
+        self._stats_collection = stats_collection
+        on_clean_insert = None
+        if stats_collection is not None:
+            on_clean_insert = FriendStats(stats_collection).add
+        self._raw_writer = BulkWriter(raw_collection, batch_size=write_batch_size)
+        self._clean_writer = BulkWriter(clean_collection, batch_size=write_batch_size,
+                                        on_insert=on_clean_insert)
+        self._failed_writer = BulkWriter(failed_collection, batch_size=write_batch_size)
+        self._failed_data_retrier = FailedDataRetrier(failed_collection, clean_collection,
+                                                      gamewith_normalizer,
+                                                      batch_size=write_batch_size,
+                                                      on_clean_insert=on_clean_insert)
+        self._pipeline = None
+        self._post_date_resolver = PostDateResolver()
+        # Friends harvested by the last _load_more_friends
+        self._n_harvested = 0
         logger.info('Finished initializing GamewithScraper.')
 
     def run(self):
         '''Scrapes and stores data.'''
         logger.info('Started running GamewithScraper.')
+        # Every post date of this run is resolved against the same now
+        self._post_date_resolver = PostDateResolver()
+        ensure_indexes(self._raw_collection, 'raw')
+        ensure_indexes(self._clean_collection, 'clean')
+        ensure_indexes(self._failed_collection, 'failed')
+        if self._stats_collection is not None:
+            ensure_indexes(self._stats_collection, 'stats')
         self._fix_failed_data()
-        raw_friends_html = self._scrape_raw()
-        friend_html_list = self._parse_friend_html_list(raw_friends_html)
-        friends_data = self._get_friends_data(friend_html_list)
+        # Friend data is normalized and stored in background while scraping
+        with FriendsPipeline(clean=self._clean_data,
+                             write=self._write_friends_data,
+                             batch_size=self._BATCH_SIZE,
+                             queue_size=self._QUEUE_SIZE) as pipeline:
+            self._pipeline = pipeline
+            self._scrape()
+        self._pipeline = None
+        logger.info('Finished running GamewithScraper.')
+
+    def _store_friends_data(self, friends_data):
+        '''Hands friend data over to be normalized and stored.
+
+        Requires _pipeline being set.
+
+        Args:
+            friends_data:
+                List of dicts consisting of friends data.
+        '''
+        self._pipeline.put(friends_data)
+
+    def _write_friends_data(self, friends_data, cleaned_data_list, failed_data_list):
+        '''Stores a batch of friend data into raw, clean and failed databases.
+
+        Args:
+            friends_data:
+                List of dicts consisting of friends data.
+            cleaned_data_list, failed_data_list:
+                Returned by _clean_data(friends_data).
+        '''
         self._insert_into_raw_database(friends_data)
-        cleaned_data_list, failed_data_list = self._clean_data(friends_data)
         self._insert_into_clean_database(cleaned_data_list)
         self._insert_into_failed_database(failed_data_list)
-        logger.info('Finished running GamewithScraper.')
 
     def _fix_failed_data(self):
-        '''Attempts to fix friend data previously failed cleaning.'''
+        '''Attempts to fix friend data previously failed cleaning.
+
+        Only those not yet tried with current game data are retried, so
+        this costs a single query if game data has not changed.
+        '''
         logger.info('Started fixing failed data.')
-        failed_friends_data = list(self._failed_collection.find())
-        try:
-            self._failed_collection.drop()
-            logger.info('Dropped failed database. %s',
-                        json.dumps({'collection': self._failed_collection.full_name}))
-            cleaned_data_list, failed_data_list = self._clean_data(failed_friends_data)
-            self._insert_into_clean_database(cleaned_data_list)
-            self._insert_into_failed_database(failed_data_list)
-        except:
-            # Stopped cleaning failed data prematurely.
-            # Insert failed data back into failed database (we just dropped it)
-            # before raising the same exception again.
-            self._insert_into_failed_database(failed_friends_data)
-            logger.exception('Failed fixing failed data. Inserted failed data back into failed database. %s',
-                             json.dumps({'collection': self._failed_collection.full_name}))
-            raise
+        self._failed_data_retrier.run()
         logger.info('Finished fixing failed data.')
 
     def _parse_friend_html_list(self, raw_friends_html):
-        '''Parse friends section html and find list of friend html.
+        '''Parse friends section html and yield friend html one by one.
+
+        The html is parsed incrementally. Each friend <li> is yielded as soon
+        as it is complete, and freed once the next one is reached, so memory
+        does not grow with the size of the page.
 
         Args:
             raw_friends_html:
                 A string of the friends section html.
 
-        Returns:
-            List of <li> elements.
+        Yields:
+            <li> elements.
         '''
         logger.info('Started parsing friend html list.')
-        soup = BeautifulSoup(raw_friends_html, 'lxml')
-        friend_html_list = soup.find_all(class_='-r-uma-musume-friends-list-item')
-
-        if not friend_html_list:
-            logger.error('Failed to parse friend html list.')
-            logger.debug(json.dumps({'soup': soup}, ensure_ascii=False))
+        count = 0
+        source = io.BytesIO(raw_friends_html.encode('utf-8'))
+        for _, element in etree.iterparse(source, events=('end',), tag='li',
+                                          html=True, encoding='utf-8'):
+            # Factor list items are <li> too
+            if not _has_class(element, FRIEND_CLASS):
+                continue
+            count += 1
+            yield element
+            # Free friends already extracted
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        if not count:
+            logger.error('Failed to parse friend html list. %s',
+                         json.dumps({'html_length': len(raw_friends_html)}))
             # TODO: raise exception
         logger.info('Finished parsing friend html list. %s',
-                    json.dumps({'count': len(friend_html_list)}))
-        return friend_html_list
+                    json.dumps({'count': count}))
 
     def _get_friends_data(self, friend_html_list):
         '''Extract friends data from parsed friend html list.
 
         Args:
             friend_html_list:
-                List of <li> elements.
+                Iterable of <li> elements.
 
-        Returns:
-            List of dicts consisting of friends data.
+        Yields:
+            Dicts consisting of friends data.
         '''
         logger.info('Started extracting friends data.')
-        friends_data = []
         for friend_html in friend_html_list:
-            friend_data = self._get_friend_data(friend_html)
-            friends_data.append(friend_data)
+            yield self._get_friend_data(friend_html)
         logger.info('Finished extracting friends data.')
-        return friends_data
 
     def _get_friend_data(self, friend_html):
         '''Extract friend data from parsed friend html.
@@ -166,44 +331,32 @@ class GamewithScraper:
              Values may be None if corresponding data isn't found.
         '''
         support_id = None
-        support_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__support-wrap')
-        if support_wrap:
+        support_href = _SUPPORT_HREF_XPATH(friend_html)
+        if support_href:
             # Example href: 'https://gamewith.jp/uma-musume/article/show/262813'
-            support_id = support_wrap[0].find_all('a')[0].get('href')
-            support_id = support_id.split('/')[-1]
+            support_id = support_href[0].split('/')[-1]
 
-        support_limit = None
-        support_limit_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__limitNumber')
-        if support_limit_wrap:
-            support_limit = support_limit_wrap[0].text.strip()
+        support_limit = _first_text(_SUPPORT_LIMIT_XPATH, friend_html)
 
-        trainer_id = None
-        trainer_id_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__trainerId__text')
-        if trainer_id_wrap:
-            trainer_id = trainer_id_wrap[0].text.strip()
+        trainer_id = _first_text(_TRAINER_ID_XPATH, friend_html)
 
         main_uma_img = None
-        main_uma_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__mainUmaMusume-wrap')
-        if main_uma_wrap:
-            main_uma_img = main_uma_wrap[0].img.get('src').strip()
+        main_uma_img_src = _MAIN_UMA_IMG_SRC_XPATH(friend_html)
+        if main_uma_img_src:
+            main_uma_img = main_uma_img_src[0].strip()
             if main_uma_img == 'https://img.gamewith.jp/article_tools/uma-musume/gacha/i_undefined.png':
                 main_uma_img = None
 
         factors = None
-        factors_item = friend_html.find_all(class_='-r-uma-musume-friends-list-item__factor-list__item')
+        factors_item = _FACTOR_XPATH(friend_html)
         if factors_item:
-            factors = [factor.text.strip() for factor in factors_item]
+            factors = [_text(factor) for factor in factors_item]
 
-        comment = None
-        comment_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__comment')
-        if comment_wrap:
-            comment = comment_wrap[0].text.strip()
+        comment = _first_text(_COMMENT_XPATH, friend_html)
 
-        post_date = None
-        post_date_wrap = friend_html.find_all(class_='-r-uma-musume-friends-list-item__postDate')
-        if post_date_wrap:
-            post_date = post_date_wrap[0].text.strip()
-            post_date = get_utc_datetime(post_date, '%m/%d %H:%M')
+        post_date = _first_text(_POST_DATE_XPATH, friend_html)
+        if post_date is not None:
+            post_date = self._post_date_resolver.resolve(post_date)
 
         friend_data = {
             'friend_code': trainer_id,
@@ -220,43 +373,22 @@ class GamewithScraper:
     def _insert_into_raw_database(self, friends_data):
         '''Insert friends data into raw database.
 
+        Friend data already in raw database is left as it is.
+
         Args:
             friends_data:
                 List of dicts consisting of friends data.
 
+        Returns:
+            A dict of counts, see BulkWriter.write.
+
         Raises:
             All exceptions raised by MongoClient,
             except for DuplicateKeyError.
         '''
         logger.info('Started inserting friends data into raw database. %s',
                     json.dumps({'collection': self._raw_collection.full_name}))
-        try:
-            insert_result = self._raw_collection.insert_many(friends_data, ordered=False)
-        except BulkWriteError as e:
-            # Ignore DuplicateKeyError
-            n_error = len(e.details['writeErrors'])
-            panic_list = [e_ for e_ in e.details['writeErrors']
-                          if e_['code'] != DUPLICATE_KEY_ERROR_CODE]
-            e.details['writeErrors'] = panic_list
-            logger.info('Ignored duplications. %s',
-                        json.dumps({'n_duplicate': n_error - len(panic_list)}))
-            logger.info('Finished inserting friends data into raw database. %s',
-                        json.dumps({'collection': self._raw_collection.full_name,
-                                    'n_inserted': e.details['nInserted']}))
-            if panic_list:
-                logger.exception('Exception occurred during insertion.',
-                                 exc_info=e, stack_info=True)
-                raise e
-        else:
-            logger.info('Finished inserting friends data into raw database. %s',
-                        json.dumps({'collection': self._raw_collection.full_name,
-                                    'n_inserted': len(insert_result.inserted_ids)}))
-
-        self._raw_collection.create_index(
-            [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-            unique=True
-        )
-        logger.info('Finsihed creating index in raw database.')
+        return self._raw_writer.write(friends_data)
 
     def _clean_data(self, friends_data):
         '''Parse raw friends data.
@@ -268,43 +400,16 @@ class GamewithScraper:
         Returns:
             (cleaned_data_list, failed_data_list)
             cleaned_data_list: data that are parsed successfully.
-            failed_data_list: otherwise.
+            failed_data_list: otherwise, with retry state.
         '''
         logger.info('Started cleaning friends data.')
-
-        # Stores normalized friend data
-        cleaned_data_list = []
-        # Stores friend data (in original form) which failed to be normalize
-        failed_data_list = []
-
-        for friend_data in friends_data:
-            try:
-                cleaned_data = self._gamewith_normalizer.normalize(friend_data)
-            except OutdatedError as e:
-                friend_data_identify = {
-                    'friend_code': friend_data['friend_code'],
-                    'post_date': str(friend_data['post_date'])
-                }
-                logger.exception('Game database outdated. Lookup in game database failed. %s',
-                                 json.dumps({'friend_data': friend_data_identify}, ensure_ascii=False),
-                                 exc_info=e,
-                                 stack_info=True)
-                failed_data_list.append(friend_data)
-                continue
-            except Exception as e:
-                friend_data_identify = {
-                    'friend_code': friend_data['friend_code'],
-                    'post_date': str(friend_data['post_date'])
-                }
-                logger.exception('Something went wrong during normalizing friend data. %s',
-                                 json.dumps({'friend_data': friend_data_identify}, ensure_ascii=False),
-                                 exc_info=e,
-                                 stack_info=True)
-                failed_data_list.append(friend_data)
-                continue
-            cleaned_data_list.append(cleaned_data)
-
-        logger.info('Finished cleaning friends data.')
+        errors = []
+        cleaned_data_list, failed_data_list = self._gamewith_normalizer.normalize_many(friends_data,
+                                                                                       errors)
+        failed_data_list = self._failed_data_retrier.stamp(failed_data_list, errors)
+        logger.info('Finished cleaning friends data. %s',
+                    json.dumps({'n_cleaned': len(cleaned_data_list),
+                                'n_failed': len(failed_data_list)}))
         return cleaned_data_list, failed_data_list
 
     def _insert_into_clean_database(self, cleaned_data_list):
@@ -313,53 +418,16 @@ class GamewithScraper:
         Args:
             cleaned_data_list: List of parsed friends data.
 
+        Returns:
+            A dict of counts, see BulkWriter.write.
+
         Raises:
             All exceptions raised by MongoClient,
             except for DuplicateKeyError.
         '''
-        if cleaned_data_list:
-            logger.info('Started inserting cleaned data into clean database. %s',
-                        json.dumps({'collection': self._clean_collection.full_name}))
-            try:
-                insert_result = self._clean_collection.insert_many(cleaned_data_list, ordered=False)
-            except BulkWriteError as e:
-                # Ignore DuplicateKeyError
-                n_error = len(e.details['writeErrors'])
-                panic_list = [e_ for e_ in e.details['writeErrors']
-                              if e_['code'] != DUPLICATE_KEY_ERROR_CODE]
-                e.details['writeErrors'] = panic_list
-                logger.info('Ignored duplications. %s',
-                            json.dumps({'n_duplicate': n_error - len(panic_list)}))
-                logger.info('Finished inserting cleaned data into clean database. %s',
-                            json.dumps({'collection': self._clean_collection.full_name,
-                                        'n_inserted': e.details['nInserted']}))
-                if panic_list:
-                    logger.exception('Exception occurred during insertion.',
-                                     exc_info=e, stack_info=True)
-                    raise e
-            else:
-                logger.info('Finished inserting cleaned data into clean database. %s',
-                            json.dumps({'collection': self._clean_collection.full_name,
-                                        'n_inserted': len(insert_result.inserted_ids)}))
-            self._clean_collection.create_index(
-                [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-                unique=True
-            )
-            self._clean_collection.create_index([('main_uma.id', ASCENDING), ('support.id', ASCENDING)])
-            self._clean_collection.create_index([
-                ('main_uma.factors.name', ASCENDING),
-                ('main_uma.factors.type', ASCENDING),
-                ('main_uma.factors.level', ASCENDING),
-                ('main_uma.id', ASCENDING),
-                ('support.id', ASCENDING)
-            ])
-            self._clean_collection.create_index([
-                ('factors.name', ASCENDING),
-                ('factors.type', ASCENDING),
-                ('factors.level', ASCENDING),
-                ('main_uma.id', ASCENDING),
-                ('support.id', ASCENDING)
-            ])
+        logger.info('Started inserting cleaned data into clean database. %s',
+                    json.dumps({'collection': self._clean_collection.full_name}))
+        return self._clean_writer.write(cleaned_data_list)
 
     def _insert_into_failed_database(self, failed_data_list):
         '''Insert cleaned data into failed database.
@@ -367,41 +435,21 @@ class GamewithScraper:
         Args:
             failed_data_list: List of friends data that can't be parsed.
 
+        Returns:
+            A dict of counts, see BulkWriter.write.
+
         Raises:
             All exceptions raised by MongoClient,
             except for DuplicateKeyError.
         '''
-        if failed_data_list:
-            logger.info('Started inserting failed data into failed database. %s',
-                        json.dumps({'collection': self._failed_collection.full_name}))
-            try:
-                insert_result = self._failed_collection.insert_many(failed_data_list)
-            except BulkWriteError as e:
-                # Ignore DuplicateKeyError
-                n_error = len(e.details['writeErrors'])
-                panic_list = [e_ for e_ in e.details['writeErrors']
-                              if e_['code'] != DUPLICATE_KEY_ERROR_CODE]
-                e.details['writeErrors'] = panic_list
-                logger.info('Ignored duplications. %s',
-                            json.dumps({'n_duplicate': n_error - len(panic_list)}))
-                logger.info('Finished inserting failed data into failed database. %s',
-                            json.dumps({'collection': self._failed_collection.full_name,
-                                        'n_inserted': e.details['nInserted']}))
-                if panic_list:
-                    logger.exception('Exception occurred during insertion.',
-                                     exc_info=e, stack_info=True)
-                    raise e
-            else:
-                logger.info('Finished inserting failed data into failed database. %s',
-                            json.dumps({'collection': self._failed_collection.full_name,
-                                        'n_inserted': len(insert_result.inserted_ids)}))
-            self._failed_collection.create_index(
-                [('friend_code', ASCENDING), ('post_date', ASCENDING)],
-                unique=True
-            )
+        logger.info('Started inserting failed data into failed database. %s',
+                    json.dumps({'collection': self._failed_collection.full_name}))
+        return self._failed_writer.write(failed_data_list)
 
     def _connect_to_page(self):
         '''Webdriver connects to page.'''
+        # Waits time out in page script first, see _wait_for_elements
+        self._driver.set_script_timeout(self._TIMEOUT + 5)
         self._driver.get(self._URL)
         logger.info('Connected to url. %s',
                     json.dumps({'url': self._URL}, ensure_ascii=False))
@@ -418,66 +466,77 @@ class GamewithScraper:
         friends_section = self._driver.find_element_by_tag_name('gds-uma-musume-friends')
         friends_section = self._driver.execute_script('return arguments[0].shadowRoot', friends_section)
         # Ensure shadowRoot executed by finding elements inside it
-        timeout_counter = 0
-        while timeout_counter < self._TIMEOUT:
-            if not friends_section.find_elements_by_class_name('-r-uma-musume-friends__search-wrap'):
-                timeout_counter += 1
-                time.sleep(1)
-            else:
-                break
-        if timeout_counter == self._TIMEOUT:
+        if self._wait_for_elements('.-r-uma-musume-friends__search-wrap', root=friends_section) is None:
             raise PageError('Cannot execute page shadowroot.')
         self._friends_section = friends_section
         logger.info('Finished finding friends section on page.')
 
-    def _get_friend_element_list(self):
-        '''Returns list of friend web element.
-
-        Requires _friends_section being set.
-
-        Difference this method and _parse_friend_html_list:
-        This methods uses selenium, and returns web element list,
-        while the other takes text as input, parses with BeautifulSoup,
-        and returns html list.
+    def _load_known_friends(self):
+        '''Loads what _reaches_known_friends needs from raw database, once.
 
         Returns:
-            List of web elements.
+            (known_keys, window_start)
+            known_keys: set of (friend_code, post_date) of friends posted
+                within _KNOWN_FRIENDS_WINDOW of the newest one.
+            window_start: the earliest post_date of the window.
+            Both None if raw database is empty.
         '''
-        logger.info('Started getting friend html list.')
-        friend_element_list = []
-        for _ in range(self._TIMEOUT):
-            if friend_element_list:
-                break
-            friend_element_list = self._friends_section.find_elements_by_class_name('-r-uma-musume-friends-list-item')
-            time.sleep(1)
+        newest = self._raw_collection.find_one({'post_date': {'$ne': None}},
+                                               {'_id': 0, 'post_date': 1},
+                                               sort=[('post_date', DESCENDING)])
+        if newest is None:
+            return None, None
+        # A post date later than now (e.g. stored before post dates were read
+        # in Japan time, see shift_post_dates.py) would make every friend on
+        # page look already scraped
+        newest_post_date = min(as_utc(newest['post_date']), self._post_date_resolver.now)
+        window_start = newest_post_date - self._KNOWN_FRIENDS_WINDOW
+        known_keys = {
+            (document['friend_code'], as_utc(document['post_date']))
+            for document in self._raw_collection.find({'post_date': {'$gte': window_start}},
+                                                      {'_id': 0, 'friend_code': 1, 'post_date': 1})
+        }
+        logger.info('Loaded known friends. %s',
+                    json.dumps({'count': len(known_keys), 'window_start': str(window_start)}))
+        return known_keys, window_start
 
-        if not friend_element_list:
-            logger.error('Failed to get friend html list.')
-            # TODO: raise exception
-        logger.info('Finished getting friend html list. %s',
-                    json.dumps({'count': len(friend_element_list)}))
-        return friend_element_list
+    def _reaches_known_friends(self, friend_keys, known_keys, window_start):
+        '''Returns whether any of friend_keys is already in the database.
 
-    def _is_friend_in_db(self, friend_element):
-        '''Returns whether this friend is already in the database.
+        Friends posted before window_start are not in known_keys, but being
+        older than friends already scraped, they are considered scraped too.
 
         Args:
-            friend_element: A web element of a friend.
+            friend_keys: Iterable of (friend_code, post_date).
+            known_keys, window_start: Returned by _load_known_friends.
         '''
-        raw_friend_html = friend_element.get_attribute('innerHTML')
-        friend_html = BeautifulSoup(raw_friend_html, 'lxml')
-        friend_data = self._get_friend_data(friend_html)
+        if known_keys is None:
+            return False
+        for friend_code, post_date in friend_keys:
+            if post_date is None:
+                continue
+            if (friend_code, post_date) in known_keys or post_date < window_start:
+                logger.info('Found duplicate friend data. %s',
+                            json.dumps({'friend_code': friend_code, 'post_date': str(post_date)}))
+                return True
+        return False
 
-        friend_code = friend_data['friend_code']
-        post_date = friend_data['post_date']
-        query = {'friend_code': friend_code, 'post_date': post_date}
-        matched_document = self._raw_collection.find_one(query)
+    def _harvest_friends_data(self):
+        '''Returns friend data of friends loaded on page since last harvest.
 
-        if matched_document is None:
-            return False
-        logger.info('Found duplicate friend data. %s',
-                    json.dumps({'friend_code': friend_code, 'post_date': str(post_date)}))
-        return True
+        Only the new friends are read from page, in a single script.
+
+        Requires _friends_section being set.
+
+        Returns:
+            List of dicts consisting of friends data.
+        '''
+        friend_htmls = self._driver.execute_script(
+            _HARVEST_FRIENDS_SCRIPT, self._friends_section, self._PRUNE_HARVESTED)
+        if not friend_htmls:
+            return []
+        friend_html_list = self._parse_friend_html_list('<ul>' + ''.join(friend_htmls) + '</ul>')
+        return list(self._get_friends_data(friend_html_list))
 
     def _click_more_friends_button(self):
         '''Attempts to click the "もっと見る" button once.
@@ -485,35 +544,67 @@ class GamewithScraper:
         Returns:
             Bool indicating whether clicking is successful.
         '''
-        timeout_counter = 0
-        while timeout_counter < self._TIMEOUT:
-            try:
-                more_friends_button = self._friends_section.find_element_by_class_name('-r-uma-musume-friends__next')
-            except NoSuchElementException:
-                timeout_counter += 1
-                time.sleep(1)
-            else:
-                self._driver.execute_script("arguments[0].click();", more_friends_button)
-                return True
-        return False
+        if self._wait_for_elements('.-r-uma-musume-friends__next') is None:
+            return False
+        try:
+            more_friends_button = self._friends_section.find_element_by_class_name('-r-uma-musume-friends__next')
+        except NoSuchElementException:
+            # Removed right after it showed up
+            return False
+        self._driver.execute_script("arguments[0].click();", more_friends_button)
+        return True
+
+    def _wait_for_elements(self, selector, min_count=0, root=None):
+        '''Waits until more than min_count elements match selector.
+
+        Returns as soon as the page changes so, rather than polling.
+
+        Args:
+            selector:
+                A string of CSS selector.
+            min_count:
+                An integer. Waits for the count to exceed it.
+            root:
+                A web element to search in. Defaults to _friends_section.
+
+        Returns:
+            Number of matching elements, or None if timed out.
+        '''
+        if root is None:
+            root = self._friends_section
+        return self._driver.execute_async_script(
+            _WAIT_FOR_ELEMENTS_SCRIPT, root, selector, min_count, self._TIMEOUT * 1000)
 
     def _load_more_friends(self):
         '''Repeatedly clicks the "もっと見る" button on page to load more friends.
 
+        Friends loaded by each click are harvested and stored right away.
+
         Stops clicking if one of the following conditions met:
-            (1) Button click limit reached. Page crashes if it's too huge.
-            (2) The database isn't empty and the oldest record on the
-                current page is already in the database.
+            (1) Button click limit reached. Page crashes if it's too huge,
+                unless harvested friends are pruned.
+            (2) Some friend newly loaded on page is already in the database.
             (3) There's no button to be clicked.
 
         Requires _friends_section being set.
         '''
         logger.info('Started loading more friends on page.')
         button_click_count = 0
+        # Seconds from each click until new friends show up
+        click_latencies = []
+        known_keys, window_start = self._load_known_friends()
+        n_harvested = 0
+        if self._wait_for_elements('.' + FRIEND_CLASS) is None:
+            logger.error('Failed to find friends on page.')
         logger.info('Started clicking button. %s',
                     json.dumps({'button': 'もっと見る', 'limit': self._BUTTON_LIMIT},
                                ensure_ascii=False))
         while True:
+            # Only friends loaded by the last click are harvested
+            friends_data = self._harvest_friends_data()
+            n_harvested += len(friends_data)
+            self._store_friends_data(friends_data)
+
             # Condition (1)
             if button_click_count == self._BUTTON_LIMIT:
                 logger.info('Reached button click limit. %s',
@@ -521,28 +612,44 @@ class GamewithScraper:
                 break
 
             # Condition (2)
-            if self._raw_collection.count_documents({}) != 0:
-                friend_element_list = self._get_friend_element_list()
-                last_friend_element = friend_element_list[-1]
-                if self._is_friend_in_db(last_friend_element):
-                    break
+            friend_keys = [(friend_data['friend_code'], friend_data['post_date'])
+                           for friend_data in friends_data]
+            if self._reaches_known_friends(friend_keys, known_keys, window_start):
+                break
 
             # Condition (3)
             is_button_clicked = self._click_more_friends_button()
             if is_button_clicked:
+                click_time = time.monotonic()
                 button_click_count += 1
+                # Wait for the list to grow before clicking again
+                n_new_friends = self._wait_for_elements(_NEW_FRIEND_SELECTOR)
+                latency = time.monotonic() - click_time
+                click_latencies.append(latency)
                 logger.info('Clicked button. %s',
-                            json.dumps({'button': 'もっとみる', 'count': button_click_count},
+                            json.dumps({'button': 'もっとみる', 'count': button_click_count,
+                                        'latency': round(latency, 3),
+                                        'n_new_friends': n_new_friends},
                                        ensure_ascii=False))
-                # Avoid rapid clicking
-                time.sleep(2)
+                if n_new_friends is None:
+                    logger.warning('Friends did not load after click. %s',
+                                   json.dumps({'button': 'もっと見る', 'timeout': self._TIMEOUT,
+                                               'prune_harvested': self._PRUNE_HARVESTED},
+                                              ensure_ascii=False))
+                    break
             else:
                 logger.info('Button not found %s',
                             json.dumps({'button': 'もっと見る'}, ensure_ascii=False))
                 break
 
+        if click_latencies:
+            logger.info('Click latency. %s',
+                        json.dumps({'mean': round(sum(click_latencies) / len(click_latencies), 3),
+                                    'max': round(max(click_latencies), 3)}))
+        self._n_harvested = n_harvested
         logger.info('Finished clicking button. %s',
-                    json.dumps({'button': 'もっと見る', 'count': button_click_count},
+                    json.dumps({'button': 'もっと見る', 'count': button_click_count,
+                                'n_harvested': n_harvested},
                                ensure_ascii=False))
         logger.info('Finished loading more friends on page.')
 
@@ -554,69 +661,56 @@ class GamewithScraper:
         rather than querying under some conditions.
         If they don't match, it might be that the "もっと見る" button was clicked too
         frequently, new records were being searched but weren't loaded to the page.
+        If harvested friends are pruned, those left on page are not what was
+        loaded, so the records searched are compared with the friends
+        harvested instead.
 
-        Requires _friends_section being set.
+        Requires _friends_section being set, and _load_more_friends run.
         '''
         logger.info('')
-        timeout_counter = 0
-        while timeout_counter < self._TIMEOUT:
-            result = self._friends_section.find_elements_by_class_name('-r-uma-musume-friends__results')
-            if not result:
-                timeout_counter += 1
-                time.sleep(1)
-            else:
-                break
-        if timeout_counter == self._TIMEOUT:
+        if self._wait_for_elements('.-r-uma-musume-friends__results') is None:
             raise PageError('Cannot load friends section.')
+        result = self._friends_section.find_elements_by_class_name('-r-uma-musume-friends__results')
 
         result = result[0].text
-        log_data = {'result': result}
+        log_data = {'result': result, 'prune_harvested': self._PRUNE_HARVESTED,
+                    'n_harvested': self._n_harvested}
         try:
             # Example result: "直近800件について検索した結果は800件でした"
             # Match the numbers
-            n_searched, n_loaded = re.findall(r'\d+', result)
+            n_searched, n_loaded = map(int, re.findall(r'\d+', result))
         except ValueError as e:
             # Not enough / too many values to unpack
             logger.exception('Cannot fetch page loading result numbers.',
                              exc_info=e, stack_info=True)
+            n_searched = n_loaded = None
         else:
             log_data['n_searched'] = n_searched
             log_data['n_loaded'] = n_loaded
 
         logger.info('Finished loading friends section. %s',
                     json.dumps(log_data, ensure_ascii=False))
-        if n_searched != n_loaded:
+        if self._PRUNE_HARVESTED:
+            n_loaded = self._n_harvested
+        if n_searched is not None and n_searched != n_loaded:
             logger.warning('Number of searched results does not match number of loaded results. %s',
                            json.dumps(log_data, ensure_ascii=False))
 
-    def _scrape_raw(self):
-        '''Connects to url, scrapes the page, and finds friends section.
-
-        Returns:
-            HTML of the friends section web element.
-        '''
+    def _scrape(self):
+        '''Connects to url, scrapes the page, and stores friends on it.'''
         logger.info('Started scraping friends section.')
-        raw_friends_html = None
         try:
             self._connect_to_page()
             self._find_page_friends_section()
             self._load_more_friends()
             self._wait_load_friends_section()
-            raw_friends_html = self._friends_section.get_attribute('innerHTML')
         except Exception as e:
             logger.exception('An exception occurred during scraping.',
                              exc_info=e, stack_info=True)
-            # Avoid premature exit leaving zombie process behind
-            self._driver.quit()
-            logger.info('Quitted webdriver.')
             # TODO: actually deal with all sorts of exceptions
             raise e
-        else:
+        finally:
+            # Avoid premature exit leaving zombie process behind
             self._driver.quit()
             logger.info('Quitted webdriver.')
-
-        if raw_friends_html is None:
-            logger.error('Failed to scrape friends section.')
-            # TODO: raise exception
         logger.info('Finished scraping friends section.')
-        return raw_friends_html
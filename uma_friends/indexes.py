@@ -0,0 +1,157 @@
+'''Indexes of every collection, declared in one place.
+
+Collections play one of the roles in INDEXES. Indexes of a collection are
+ensured once per process, and only if the schema version recorded in the
+database is older than INDEX_SCHEMA_VERSION. Bump INDEX_SCHEMA_VERSION
+whenever INDEXES changes.
+'''
+import json
+import logging
+import threading
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_SCHEMA_VERSION = 9
+
+
+_FRIEND_KEY = IndexModel([('friend_code', ASCENDING), ('post_date', ASCENDING)],
+                         name='friend_code_1_post_date_1', unique=True)
+
+INDEXES = {
+    'raw': [
+        _FRIEND_KEY,
+        # Used by FriendsRenormalizer to find friends touched by game data changes
+        IndexModel([('support_id', ASCENDING)], name='support_id_1'),
+        IndexModel([('character_image_url', ASCENDING)], name='character_image_url_1'),
+        IndexModel([('factors', ASCENDING)], name='factors_1'),
+        # Used by RawArchiver to find raw friend data past retention
+        IndexModel([('post_date', ASCENDING)], name='post_date_1')
+    ],
+    'clean': [
+        _FRIEND_KEY,
+        IndexModel([('main_uma.id', ASCENDING), ('support.id', ASCENDING)],
+                   name='main_uma.id_1_support.id_1'),
+        IndexModel([
+            ('main_uma.factors.name', ASCENDING),
+            ('main_uma.factors.type', ASCENDING),
+            ('main_uma.factors.level', ASCENDING),
+            ('main_uma.id', ASCENDING),
+            ('support.id', ASCENDING)
+        ], name='main_uma.factors.name_1_main_uma.factors.type_1_main_uma.factors.level_1_main_uma.id_1_support.id_1'),
+        IndexModel([
+            ('factors.name', ASCENDING),
+            ('factors.type', ASCENDING),
+            ('factors.level', ASCENDING),
+            ('main_uma.id', ASCENDING),
+            ('support.id', ASCENDING)
+        ], name='factors.name_1_factors.type_1_factors.level_1_main_uma.id_1_support.id_1'),
+        # Used by FriendSearch: sort and keyset pagination, then conditions
+        # not served by the indexes above
+        IndexModel([('post_date', DESCENDING), ('_id', DESCENDING)], name='post_date_-1__id_-1'),
+        IndexModel([('support.id', ASCENDING), ('support.limit', ASCENDING)],
+                   name='support.id_1_support.limit_1'),
+        IndexModel([('parents.id', ASCENDING)], name='parents.id_1'),
+        # Used by FriendSearch.rank_by_stars, the only ranking served by index
+        IndexModel([('summary.stars.blue', DESCENDING), ('post_date', DESCENDING)],
+                   name='summary.stars.blue_-1_post_date_-1')
+    ],
+    'failed': [
+        _FRIEND_KEY,
+        # Used by FailedDataRetrier to skip those tried with current game data
+        IndexModel([('retry.game_data_version', ASCENDING)], name='retry.game_data_version_1')
+    ],
+    # Counters of FriendStats, read by kind over a range of days
+    'stats': [
+        IndexModel([('_id.kind', ASCENDING), ('_id.day', ASCENDING)], name='_id.kind_1__id.day_1')
+    ],
+    # Game data collections are matched by id when synced
+    'supports': [
+        IndexModel([('id', ASCENDING)], name='id_1'),
+        IndexModel([('gwId', ASCENDING)], name='gwId_1')
+    ],
+    'players': [
+        IndexModel([('id', ASCENDING)], name='id_1'),
+        IndexModel([('gwImgUrl', ASCENDING)], name='gwImgUrl_1'),
+        IndexModel([('uniqueSkillList', ASCENDING)], name='uniqueSkillList_1')
+    ],
+    'skills': [
+        IndexModel([('id', ASCENDING)], name='id_1'),
+        IndexModel([('name', ASCENDING)], name='name_1')
+    ],
+    'races': [
+        IndexModel([('id', ASCENDING)], name='id_1'),
+        IndexModel([('name', ASCENDING)], name='name_1')
+    ],
+    'buffs': [IndexModel([('id', ASCENDING)], name='id_1')],
+    'effects': [IndexModel([('id', ASCENDING)], name='id_1')],
+    'events': [IndexModel([('id', ASCENDING)], name='id_1')]
+}
+
+
+# Full names of collections whose indexes are ensured in this process
+_ensured = set()
+_ensured_lock = threading.Lock()
+
+
+def ensure_indexes(collection, role):
+    '''Creates indexes of collection declared for role, if not done yet.
+
+    Costs nothing after the first call in a process, and one query after
+    that if indexes are already up to date in the database.
+
+    Args:
+        collection:
+            A pymongo Collection.
+        role:
+            A key of INDEXES.
+    '''
+    with _ensured_lock:
+        if collection.full_name in _ensured:
+            return
+        versions = collection.database['index_versions']
+        version = versions.find_one({'_id': collection.name})
+        if version is None or version['version'] < INDEX_SCHEMA_VERSION:
+            collection.create_indexes(INDEXES[role])
+            versions.replace_one({'_id': collection.name},
+                                 {'_id': collection.name, 'role': role,
+                                  'version': INDEX_SCHEMA_VERSION},
+                                 upsert=True)
+            logger.info('Created indexes. %s',
+                        json.dumps({'collection': collection.full_name,
+                                    'version': INDEX_SCHEMA_VERSION}))
+        _ensured.add(collection.full_name)
+
+
+def report_indexes(collection, role):
+    '''Compares indexes in database with those declared for role.
+
+    Usage comes from $indexStats, counted since the server last started.
+
+    Args:
+        collection:
+            A pymongo Collection.
+        role:
+            A key of INDEXES.
+
+    Returns:
+        A dict of lists of index names:
+        missing: declared but not in database.
+        unused: in database but never used.
+        undeclared: in database but not declared.
+    '''
+    declared = {index.document['name'] for index in INDEXES[role]}
+    usage = {stats['name']: stats['accesses']['ops']
+             for stats in collection.aggregate([{'$indexStats': {}}])}
+    usage.pop('_id_', None)
+    report = {
+        'missing': sorted(declared - usage.keys()),
+        'unused': sorted(name for name, ops in usage.items() if ops == 0),
+        'undeclared': sorted(usage.keys() - declared)
+    }
+    logger.info('Reported indexes. %s',
+                json.dumps(dict(report, collection=collection.full_name)))
+    return report
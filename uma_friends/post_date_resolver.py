@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+
+
+# Gamewith shows post dates in Japan time, which has no daylight saving
+JST = timezone(timedelta(hours=9), 'JST')
+
+
+class PostDateResolver:
+    '''Converts gamewith post dates of '%m/%d %H:%M' into datetimes in utc.
+
+    Post dates have no year. The year assigned is the one making the latest
+    datetime that is not later than now, where now is captured once when the
+    resolver is created, so every friend of a run is resolved against the
+    same now. Create one resolver per run.
+
+    Friends are posted at minute resolution, so a run sees only a few
+    distinct post dates; each is parsed once and memoized.
+    '''
+    def __init__(self, now=None, tz=JST):
+        '''Initializes PostDateResolver.
+
+        Args:
+            now:
+                Optional aware datetime to resolve against. Defaults to now.
+            tz:
+                A tzinfo post dates are shown in.
+        '''
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self._now = now.astimezone(tz)
+        self._tz = tz
+        self._resolved = {}
+
+    @property
+    def now(self):
+        '''The aware datetime in utc post dates are resolved against.'''
+        return self._now.astimezone(timezone.utc)
+
+    def resolve(self, date_string):
+        '''Returns post date as aware datetime in utc.
+
+        Args:
+            date_string:
+                A string like '07/16 13:22'.
+
+        Raises:
+            ValueError, if date_string is malformed.
+        '''
+        post_date = self._resolved.get(date_string)
+        if post_date is None:
+            post_date = self._resolved[date_string] = self._parse(date_string)
+        return post_date
+
+    def _parse(self, date_string):
+        try:
+            month_day, hour_minute = date_string.split(' ')
+            month, day = month_day.split('/')
+            hour, minute = hour_minute.split(':')
+            fields = int(month), int(day), int(hour), int(minute)
+        except (AttributeError, ValueError) as e:
+            raise ValueError(f'Malformed post date: {date_string!r}') from e
+
+        year = self._now.year
+        post_date = self._make_datetime(year, *fields)
+        if post_date is None or post_date > self._now:
+            # Year has changed since post date
+            post_date = self._make_datetime(year - 1, *fields)
+            if post_date is None:
+                raise ValueError(f'Malformed post date: {date_string!r}')
+        return post_date.astimezone(timezone.utc)
+
+    def _make_datetime(self, year, month, day, hour, minute):
+        '''Returns datetime in tz, or None if it does not exist in year (e.g. 02/29).'''
+        try:
+            return datetime(year, month, day, hour, minute, tzinfo=self._tz)
+        except ValueError:
+            return None
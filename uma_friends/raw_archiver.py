@@ -0,0 +1,150 @@
+from datetime import datetime, timezone
+import gzip
+import json
+import logging
+import os
+
+from bson import json_util
+from pymongo import ASCENDING
+
+from .bulk_writer import BulkWriter
+
+
+logger = logging.getLogger(__name__)
+
+
+class RawArchiver:
+    '''Moves old raw friend data out of database into compressed archives.
+
+    Raw documents posted before the retention period are deleted in batches,
+    but only those with a clean counterpart: raw friend data still failing
+    normalization stays for the failed buffer to be retried. Every batch is
+    written into an archive file before it is deleted, so a crash in between
+    only leaves documents that will be archived again by the next run.
+
+    Archives are gzip compressed JSON lines in MongoDB extended JSON, one
+    gzip member per batch, and can be restored into the raw collection to be
+    normalized again:
+        1. restore the archive files, with archiving paused;
+        2. run backfill_friends.py --restart, which normalizes every raw
+           document again, restored ones included, and writes over their
+           clean counterparts;
+        3. resume archiving. Restored friend data is still past retention
+           and has a clean counterpart, so it is archived again.
+    '''
+    def __init__(self, raw_collection, clean_collection, archive_dir, retention, batch_size=1000):
+        '''Initializes RawArchiver.
+
+        Args:
+            raw_collection:
+                A pymongo Collection. Stores raw data scraped from gamewith.
+            clean_collection:
+                A pymongo Collection. Stores clean-up data.
+            archive_dir:
+                A string of the directory archive files are written into.
+            retention:
+                A timedelta. Raw friend data posted within it is kept.
+            batch_size:
+                An integer of how many raw documents are archived at once.
+        '''
+        self._raw_collection = raw_collection
+        self._clean_collection = clean_collection
+        self._ARCHIVE_DIR = archive_dir
+        self._RETENTION = retention
+        self._BATCH_SIZE = batch_size
+        logger.info('Finished initializing RawArchiver.')
+
+    def run(self):
+        '''Archives and deletes raw friend data older than retention.
+
+        Returns:
+            A string of the path of the archive file, or None if nothing
+            was archived.
+        '''
+        now = datetime.now(timezone.utc)
+        cutoff = now - self._RETENTION
+        archive_path = os.path.join(self._ARCHIVE_DIR,
+                                    f"raw-{now.strftime('%Y%m%dT%H%M%S')}.jsonl.gz")
+        logger.info('Started archiving raw friend data. %s',
+                    json.dumps({'collection': self._raw_collection.full_name,
+                                'cutoff': cutoff.isoformat(), 'path': archive_path}))
+        os.makedirs(self._ARCHIVE_DIR, exist_ok=True)
+
+        counts = {'n_archived': 0, 'n_kept': 0}
+        cursor = (self._raw_collection.find({'post_date': {'$lt': cutoff}})
+                                      .sort('post_date', ASCENDING)
+                                      .batch_size(self._BATCH_SIZE))
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) == self._BATCH_SIZE:
+                self._archive_batch(batch, archive_path, counts)
+                batch = []
+        if batch:
+            self._archive_batch(batch, archive_path, counts)
+
+        logger.info('Finished archiving raw friend data. %s',
+                    json.dumps(dict(counts, path=archive_path)))
+        if counts['n_archived'] == 0:
+            return None
+        return archive_path
+
+    def restore(self, archive_path):
+        '''Inserts raw friend data of an archive file back into raw collection.
+
+        Documents already in raw collection are left as they are. The next
+        run archives restored documents again, see the class docstring.
+
+        Returns:
+            A dict of counts, see BulkWriter.write.
+        '''
+        logger.info('Started restoring raw friend data. %s', json.dumps({'path': archive_path}))
+        writer = BulkWriter(self._raw_collection, batch_size=self._BATCH_SIZE)
+        counts = {'n_inserted': 0, 'n_matched': 0, 'n_errored': 0}
+        batch = []
+        # Reads every gzip member in turn
+        with gzip.open(archive_path, 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                batch.append(json_util.loads(line, json_options=json_util.CANONICAL_JSON_OPTIONS))
+                if len(batch) == self._BATCH_SIZE:
+                    for key, count in writer.write(batch).items():
+                        counts[key] += count
+                    batch = []
+        if batch:
+            for key, count in writer.write(batch).items():
+                counts[key] += count
+        logger.info('Finished restoring raw friend data. %s',
+                    json.dumps(dict(counts, path=archive_path)))
+        return counts
+
+    def _archive_batch(self, batch, archive_path, counts):
+        '''Archives and deletes documents of batch that have a clean counterpart.'''
+        # Exact keys, each served by the friend_code and post_date index.
+        # Without friend_code there is no clean counterpart.
+        keys = [{'friend_code': document['friend_code'], 'post_date': document['post_date']}
+                for document in batch if document.get('friend_code') is not None]
+        cleaned_keys = set()
+        if keys:
+            cleaned_keys = {
+                (friend['friend_code'], friend['post_date'])
+                for friend in self._clean_collection.find({'$or': keys},
+                                                          {'_id': 0, 'friend_code': 1, 'post_date': 1})
+            }
+        archived = [document for document in batch
+                    if (document.get('friend_code'), document['post_date']) in cleaned_keys]
+        counts['n_kept'] += len(batch) - len(archived)
+        if not archived:
+            return
+
+        # A gzip member per batch, closed and synced before deleting
+        with open(archive_path, 'ab') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb') as archive_file:
+                for document in archived:
+                    archive_file.write(json_util.dumps(document, ensure_ascii=False,
+                                                       json_options=json_util.CANONICAL_JSON_OPTIONS)
+                                       .encode('utf-8'))
+                    archive_file.write(b'\n')
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        self._raw_collection.delete_many({'_id': {'$in': [document['_id'] for document in archived]}})
+        counts['n_archived'] += len(archived)
@@ -1,9 +1,16 @@
+from datetime import datetime, timezone
+import hashlib
 import json
 import logging
+import tempfile
 
-from bs4 import BeautifulSoup
+from pymongo import DeleteMany, InsertOne, ReplaceOne
 import requests
 
+from .gamewith_image_url_fetcher import GamewithImageUrlFetcher
+from .indexes import INDEXES, ensure_indexes
+from .utils import iter_json_object_items
+
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +21,10 @@ class DataError(Exception):
 
 class UrarawinGameDataUpdater:
     '''Updates game database using data collected by urarawin website.'''
-    def __init__(self, urarawin_db_url, uma_article_base_url, game_data_database):
+    _CHUNK_SIZE = 1 << 16
+
+    def __init__(self, urarawin_db_url, uma_article_base_url, game_data_database,
+                 image_url_fetcher=None):
         '''Initializes UrarawinGameDataUpdater.
 
         Attributes:
@@ -24,12 +34,21 @@ class UrarawinGameDataUpdater:
                 A string of base url link of gamewith articles.
             game_data_database:
                 A pymongo database.
+            image_url_fetcher:
+                Optional GamewithImageUrlFetcher. Defaults to one fetching
+                from uma_article_base_url with default settings, caching
+                image urls in the gw_image_urls collection.
         '''
         self._urarawin_db_url = urarawin_db_url
         self._uma_article_base_url = uma_article_base_url
         if self._uma_article_base_url[-1] != '/':
             self._uma_article_base_url += '/'
         self._game_data_database = game_data_database
+        if image_url_fetcher is None:
+            image_url_fetcher = GamewithImageUrlFetcher(
+                self._uma_article_base_url,
+                cache_collection=game_data_database['gw_image_urls'])
+        self._image_url_fetcher = image_url_fetcher
         self._COLLECTION_NAMES = [
             'players',
             'supports',
@@ -42,103 +61,325 @@ class UrarawinGameDataUpdater:
         logger.info('Finished initializing UrarawinGameDataUpdater.')
 
     def run(self):
+        '''Updates game database, collection by collection.
+
+        Skips everything if game data is unchanged since the last import.
+        '''
         logger.info('Started running UrarawinGameDataUpdater.')
-        game_data = self._download_game_data()
-        self._preprocess_game_data(game_data)
-        self._write_to_database(game_data)
+        game_data_file, import_state = self._download_game_data()
+        if game_data_file is None:
+            logger.info('Game data unchanged since last import. Skipped updating. %s',
+                        json.dumps({'url': self._urarawin_db_url}, ensure_ascii=False))
+            return
+        for collection_name in self._COLLECTION_NAMES:
+            ensure_indexes(self._game_data_database[collection_name], collection_name)
+        with game_data_file:
+            # Nothing is written unless all of game data is good
+            self._check_game_data(game_data_file)
+            # Only one collection is held in memory at a time
+            for collection_name, documents in self._iter_game_data(game_data_file):
+                documents = self._preprocess_game_data(collection_name, documents)
+                # Recorded before the collection is written, so that a later
+                # collection failing cannot lose changes of this one: the next
+                # run diffs against what is written
+                self._record_changes(self._diff_game_data(collection_name, documents))
+                self._write_to_database(collection_name, documents)
+                # Let it go before the next one is parsed
+                del documents
+        self._save_import_state(import_state)
         logger.info('Finished running UrarawinGameDataUpdater.')
 
     def _download_game_data(self):
-        '''Downloads game data.
+        '''Downloads game data into a temporary file, unless it is unchanged.
+
+        The request is conditional on the ETag of the last import, and the
+        content is hashed while being written, so unchanged game data is
+        detected whether or not the server supports ETag.
 
         Returns:
-            Json (dict) of game data.
+            (game_data_file, import_state)
+            game_data_file: A file object positioned at start, or None if
+                game data is unchanged since the last import.
+            import_state: A dict to save once game data is imported.
+        '''
+        logger.info('Started downloading game data. %s',
+                    json.dumps({'url': self._urarawin_db_url}, ensure_ascii=False))
+        last_import_state = self._game_data_database['imports'].find_one(
+            {'_id': self._urarawin_db_url}) or {}
+        headers = {}
+        if last_import_state.get('etag'):
+            headers['If-None-Match'] = last_import_state['etag']
+
+        with requests.get(self._urarawin_db_url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                return None, None
+            content_hash = hashlib.sha256()
+            game_data_file = tempfile.TemporaryFile()
+            for chunk in response.iter_content(chunk_size=self._CHUNK_SIZE):
+                content_hash.update(chunk)
+                game_data_file.write(chunk)
+            etag = response.headers.get('ETag')
+
+        import_state = {
+            '_id': self._urarawin_db_url,
+            'etag': etag,
+            'sha256': content_hash.hexdigest()
+        }
+        if import_state['sha256'] == last_import_state.get('sha256'):
+            game_data_file.close()
+            return None, None
+        game_data_file.seek(0)
+        logger.info('Finished downloading game data. %s',
+                    json.dumps({'url': self._urarawin_db_url, 'sha256': import_state['sha256']},
+                               ensure_ascii=False))
+        return game_data_file, import_state
+
+    def _check_game_data(self, game_data_file):
+        '''Parses all of game data once, keeping nothing, and rewinds the file.
+
+        Args:
+            game_data_file:
+                A file object of game data json, positioned at start.
 
         Raises:
             DataError:
-                If game data lacks some keys.
+                If game data lacks some collections or fails parsing.
         '''
-        logger.info('Started downloading game data. %s',
-                    json.dumps({'url': self._urarawin_db_url}, ensure_ascii=False))
-        game_data = requests.get(self._urarawin_db_url).json()
-        if not self._validate(game_data):
+        chunks = iter(lambda: game_data_file.read(self._CHUNK_SIZE), b'')
+        try:
+            found_names = {collection_name for collection_name, _ in iter_json_object_items(chunks)}
+        except ValueError as e:
+            raise DataError('Failed parsing game data.') from e
+        if not self._validate(found_names):
             raise DataError('Failed validating game data.')
-        logger.info('Finished downloading game data. %s',
-                    json.dumps({'url': self._urarawin_db_url}, ensure_ascii=False))
-        return game_data
+        game_data_file.seek(0)
+
+    def _iter_game_data(self, game_data_file):
+        '''Stream-parses game data, yielding one collection at a time.
+
+        Game data is expected to have passed _check_game_data.
 
-    def _validate(self, game_data):
+        Args:
+            game_data_file:
+                A file object of game data json.
+
+        Yields:
+            (collection_name, documents) of expected collections. The caller
+            should let documents go before asking for the next collection.
+
+        Raises:
+            DataError:
+                If game data fails parsing.
+        '''
+        chunks = iter(lambda: game_data_file.read(self._CHUNK_SIZE), b'')
+        try:
+            for collection_name, documents in iter_json_object_items(chunks):
+                if collection_name not in self._COLLECTION_NAMES:
+                    continue
+                logger.info('Parsed game data collection. %s',
+                            json.dumps({'collection': collection_name, 'count': len(documents)}))
+                yield collection_name, documents
+                # Dropped here too, so that nothing holds it while the next one is parsed
+                del documents
+        except ValueError as e:
+            raise DataError('Failed parsing game data.') from e
+
+    def _validate(self, collection_names):
         '''Very basic validation. Not meant to be comprehensive.
 
         Args:
-            game_data:
-                A dict.
+            collection_names:
+                A set of collection names found in game data.
 
         Returns:
             Bool whether the game_data has expected fields.
         '''
-        return all(name in game_data for name in self._COLLECTION_NAMES)
+        return all(name in collection_names for name in self._COLLECTION_NAMES)
 
-    def _preprocess_game_data(self, game_data):
-        '''Preprocess game data.
+    def _preprocess_game_data(self, collection_name, documents):
+        '''Preprocess game data of a collection.
 
-        1. Changes game_data['effects] to a list of dict.
+        1. Changes effects to a list of dict.
         2. Adds gwImgUrl field to players (uma) documents, mapping each uma
         to the image url of gamewith site.
 
         Args:
-            game_data:
-                A dict. It will be modified.
+            collection_name:
+                A string.
+            documents:
+                A list of dicts, or a dict for effects. It may be modified.
+
+        Returns:
+            List of dicts, documents to write.
         '''
-        logger.info('Started preprocessing game data.')
-
-        effects = game_data['effects']
-        new_effects = []
-        for k, v in effects.items():
-            v['id'] = k
-            new_effects.append(v)
-        game_data['effects'] = new_effects
-
-        logger.info('Started mapping uma gamewith image url.')
-        for uma in game_data['players']:
-            gamewith_id = uma['gwId']
-            url = self._uma_article_base_url + gamewith_id
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, 'lxml')
-            uma_joubu = soup.find(class_='uma_joubu')
-            a = uma_joubu.find('a', href=url)
-            try:
-                gwImgUrl = a.img['data-original']
-            except TypeError as e:
-                logger.exception('Cannot find image url. %s',
-                                 json.dumps({'gamewith_id': gamewith_id, 'url': url}),
-                                 exc_info=e,
-                                 stack_info=True)
-                raise e
-            uma['gwImgUrl'] = gwImgUrl
-
-        logger.info('Finished preprocessing game data.')
-
-    def _write_to_database(self, game_data):
-        '''Writes game data to database.
+        if collection_name == 'effects':
+            new_effects = []
+            for k, v in documents.items():
+                v['id'] = k
+                new_effects.append(v)
+            documents = new_effects
+
+        if collection_name == 'players':
+            logger.info('Started mapping uma gamewith image url.')
+            image_urls = self._image_url_fetcher.fetch_all(uma['gwId'] for uma in documents)
+            for uma in documents:
+                uma['gwImgUrl'] = image_urls[uma['gwId']]
+
+        return documents
+
+    def _diff_game_data(self, collection_name, documents):
+        '''Finds what game data of a collection changed compared to game database.
+
+        Only the keys GamewithNormalizer looks up are compared: these are the
+        ones that can turn a failed or wrongly normalized friend into a good one.
 
         Args:
-            game_data:
-                A dict.
+            collection_name:
+                A string.
+            documents:
+                A list of dicts, already preprocessed.
+
+        Returns:
+            A dict of at most one of the following lists:
+            support_gw_ids: gamewith ids of new supports.
+            image_urls: gamewith image urls of new players (uma).
+            skill_names: names of new skills.
+            race_names: new names of races.
         '''
-        for collection_name in self._COLLECTION_NAMES:
-            collection = self._game_data_database[collection_name]
-            logger.info('Started inserting data into collection. %s',
-                        json.dumps({'collection': collection.full_name}))
-            documents = game_data[collection_name]
-            collection.drop()
-            logger.info('Collection dropped. %s',
-                        json.dumps({'collection': collection.full_name}))
-            collection.insert_many(documents)
-            logger.info('Finished inserting data into collection. %s',
-                        json.dumps({'collection': collection.full_name}))
-
-        self._game_data_database['skills'].create_index('name')
-        self._game_data_database['players'].create_index('uniqueSkillList')
-        self._game_data_database['supports'].create_index('gwId')
-        logger.info('Finsihed creating index in game database.')
+        collection = self._game_data_database[collection_name]
+        if collection_name == 'supports':
+            old_support_gw_ids = set(collection.distinct('gwId'))
+            changes = {'support_gw_ids': sorted({support['gwId'] for support in documents
+                                                 if support.get('gwId') is not None}
+                                                - old_support_gw_ids)}
+        elif collection_name == 'players':
+            old_image_urls = set(collection.distinct('gwImgUrl'))
+            changes = {'image_urls': sorted({uma['gwImgUrl'] for uma in documents
+                                             if uma.get('gwImgUrl') is not None}
+                                            - old_image_urls)}
+        elif collection_name == 'skills':
+            old_skill_names = set(collection.distinct('name'))
+            changes = {'skill_names': sorted({skill['name'] for skill in documents
+                                              if skill.get('name') is not None}
+                                             - old_skill_names)}
+        elif collection_name == 'races':
+            old_races = list(collection.find({}, {'_id': 0, 'id': 1, 'name': 1}))
+            old_race_names = {race['id']: race.get('name') for race in old_races
+                              if race.get('id') is not None}
+            old_names = {race.get('name') for race in old_races}
+            # Races without id cannot be matched, so only their names are compared
+            changes = {'race_names': sorted({
+                race['name'] for race in documents
+                if race.get('name') is not None
+                and (old_race_names.get(race['id']) != race['name'] if race.get('id') is not None
+                     else race['name'] not in old_names)
+            })}
+        else:
+            return {}
+        logger.info('Diffed game data. %s',
+                    json.dumps({'collection': collection.full_name,
+                                **{k: len(v) for k, v in changes.items()}}))
+        return changes
+
+    def _record_changes(self, changes):
+        '''Records changes of game data for FriendsRenormalizer to pick up.
+
+        Args:
+            changes:
+                A dict returned by _diff_game_data.
+        '''
+        document = {
+            'support_gw_ids': changes.get('support_gw_ids', []),
+            'image_urls': changes.get('image_urls', []),
+            'factor_names': sorted(set(changes.get('skill_names', []))
+                                   | set(changes.get('race_names', [])))
+        }
+        if not any(document.values()):
+            logger.info('No game data changes to record.')
+            return
+        document['created_at'] = datetime.now(timezone.utc)
+        document['renormalized'] = False
+        self._game_data_database['changes'].insert_one(document)
+        logger.info('Recorded game data changes. %s',
+                    json.dumps({'collection': self._game_data_database['changes'].full_name}))
+
+    def _write_to_database(self, collection_name, documents):
+        '''Syncs game data of a collection to database.
+
+        Documents are matched by id and compared by content hash, and only
+        inserts, updates and deletes are written, in one bulk. The collection
+        is never emptied, so lookups running meanwhile always see data.
+
+        Falls back to dropping and reinserting the collection if documents
+        cannot be matched by id.
+
+        Args:
+            collection_name:
+                A string.
+            documents:
+                A list of dicts.
+
+        Returns:
+            A dict of counts of documents inserted, updated and deleted:
+            n_inserted, n_updated, n_deleted. None if the collection is
+            replaced instead.
+        '''
+        collection = self._game_data_database[collection_name]
+        ids = [document.get('id') for document in documents]
+        if None in ids or len(set(ids)) != len(ids):
+            logger.warning('Documents lack unique id. Replacing whole collection. %s',
+                           json.dumps({'collection': collection.full_name}))
+            self._replace_collection(collection, documents)
+            return None
+
+        logger.info('Started syncing data into collection. %s',
+                    json.dumps({'collection': collection.full_name}))
+        old_hashes = {document['id']: document.get('contentHash')
+                      for document in collection.find({}, {'_id': 0, 'id': 1, 'contentHash': 1})}
+        operations = []
+        n_inserted = 0
+        n_updated = 0
+        for document in documents:
+            document['contentHash'] = self._hash_document(document)
+            if document['id'] not in old_hashes:
+                n_inserted += 1
+                operations.append(InsertOne(document))
+            elif old_hashes[document['id']] != document['contentHash']:
+                n_updated += 1
+                operations.append(ReplaceOne({'id': document['id']}, document))
+        deleted_ids = list(old_hashes.keys() - set(ids))
+        if deleted_ids:
+            operations.append(DeleteMany({'id': {'$in': deleted_ids}}))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        counts = {'n_inserted': n_inserted, 'n_updated': n_updated, 'n_deleted': len(deleted_ids)}
+        logger.info('Finished syncing data into collection. %s',
+                    json.dumps({'collection': collection.full_name, **counts}))
+        return counts
+
+    def _replace_collection(self, collection, documents):
+        '''Drops collection and inserts documents.'''
+        logger.info('Started inserting data into collection. %s',
+                    json.dumps({'collection': collection.full_name}))
+        collection.drop()
+        logger.info('Collection dropped. %s',
+                    json.dumps({'collection': collection.full_name}))
+        collection.insert_many(documents)
+        # Indexes were dropped along with the collection
+        collection.create_indexes(INDEXES[collection.name])
+        logger.info('Finished inserting data into collection. %s',
+                    json.dumps({'collection': collection.full_name}))
+
+    @staticmethod
+    def _hash_document(document):
+        '''Returns a hash of document content, independent of key order.'''
+        content = {k: v for k, v in document.items() if k not in ('_id', 'contentHash')}
+        serialized = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def _save_import_state(self, import_state):
+        '''Saves ETag and content hash of imported game data.'''
+        import_state = dict(import_state, imported_at=datetime.now(timezone.utc))
+        self._game_data_database['imports'].replace_one(
+            {'_id': import_state['_id']}, import_state, upsert=True)
@@ -1,30 +1,130 @@
-from datetime import datetime, timezone
+import codecs
+from datetime import timezone
+import json
 import logging
+import re
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_utc_datetime(date_string, format):
-    '''Returns datetime (in utc timezone) based on date_string and format.
 
-    This function assumes that the given date_string does not
-    contain year info. It assigns a year so that the resulting datetime
-    is the latest datetime that's earlier than NOW.
+def make_session(max_retries=3, backoff_factor=1, pool_maxsize=10):
+    '''Returns a requests.Session of pooled connections that retries failed requests.
 
     Args:
-        The same as datetime.strptime() function. Example usage:
-        get_utc_datetime('07/16 13:22', '%m/%d %H:%M')
+        max_retries:
+            An integer of how many times a failed request is retried.
+        backoff_factor:
+            A number. Retries wait backoff_factor * 2 ** (retry - 1) seconds.
+        pool_maxsize:
+            An integer of how many connections are kept per host, e.g. one
+            per worker thread.
     '''
-    now_date_local = datetime.now()
-    now_year_local = now_date_local.year
-
-    post_date_local = datetime.strptime(date_string, format)
-    # Add year info
-    post_date_local = post_date_local.replace(year=now_year_local)
-    if post_date_local > now_date_local:
-        # Year has changed since post date
-        post_date_local = post_date_local.replace(year=now_year_local - 1)
-
-    post_date_utc = post_date_local.astimezone(tz=timezone.utc)
-    return post_date_utc
+    session = requests.Session()
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def as_utc(date):
+    '''Returns date as aware datetime in utc.
+
+    Dates read by a MongoClient that is not tz_aware are naive, but in utc.
+    '''
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
+
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_object_items(chunks):
+    '''Yields (key, value) of a top-level JSON object, one item at a time.
+
+    Only the text of the item being decoded is held in memory, so a huge
+    object of a few big values can be parsed with memory of one value.
+
+    Args:
+        chunks:
+            An iterable of bytes, e.g. a file read in chunks.
+
+    Raises:
+        ValueError, if the text is not a JSON object.
+    '''
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    is_eof = False
+
+    def read_more():
+        # Reads at least as much as already buffered, so that re-decoding an
+        # incomplete value costs linear time overall
+        nonlocal buffer, position, is_eof
+        buffer = buffer[position:]
+        position = 0
+        target = max(len(buffer), 1 << 16)
+        pieces = [buffer]
+        n_read = 0
+        while n_read < target:
+            chunk = next(chunks, None)
+            if chunk is None:
+                pieces.append(utf8_decoder.decode(b'', final=True))
+                is_eof = True
+                break
+            piece = utf8_decoder.decode(chunk)
+            pieces.append(piece)
+            n_read += len(piece)
+        buffer = ''.join(pieces)
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position < len(buffer) or is_eof:
+                return
+            read_more()
+
+    def expect(characters):
+        nonlocal position
+        skip_whitespace()
+        if position == len(buffer) or buffer[position] not in characters:
+            raise ValueError(f'Expecting one of {characters!r} at {position}.')
+        position += 1
+        return buffer[position - 1]
+
+    def decode():
+        nonlocal position
+        skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+            else:
+                # A number at the end of buffer may continue in the next chunk
+                if end < len(buffer) or is_eof:
+                    position = end
+                    return value
+            read_more()
+
+    expect('{')
+    skip_whitespace()
+    if buffer[position:position + 1] == '}':
+        return
+    while True:
+        key = decode()
+        expect(':')
+        yield key, decode()
+        if expect(',}') == '}':
+            return
 
 
 def get_logger():
@@ -1,6 +1,8 @@
+from datetime import timedelta
 import os
 from pymongo import MongoClient
 
+from uma_friends.gamewith_image_url_fetcher import GamewithImageUrlFetcher
 from uma_friends.urarawin_game_data_updater import UrarawinGameDataUpdater
 from uma_friends.utils import get_logger
 
@@ -13,16 +15,25 @@ GAME_DATA_DB = os.environ['GAME_DATA_DB']
 
 URARAWIN_DB_URL = os.environ['URARAWIN_DB_URL']
 UMA_ARTICLE_BASE_URL = os.environ['UMA_ARTICLE_BASE_URL']
+# How long a cached gamewith image url is used before its page is revalidated
+GW_IMAGE_URL_TTL_DAYS = float(os.environ.get('GW_IMAGE_URL_TTL_DAYS', 7))
 
 
 def run_updater():
     mongo_client = MongoClient(UMAFRIENDS_DB_URI)
     game_data_db = mongo_client[GAME_DATA_DB]
 
+    image_url_fetcher = GamewithImageUrlFetcher(
+        uma_article_base_url=UMA_ARTICLE_BASE_URL,
+        cache_collection=game_data_db['gw_image_urls'],
+        ttl=timedelta(days=GW_IMAGE_URL_TTL_DAYS)
+    )
+
     urarawin_game_data_updater = UrarawinGameDataUpdater(
         urarawin_db_url=URARAWIN_DB_URL,
         uma_article_base_url=UMA_ARTICLE_BASE_URL,
-        game_data_database=game_data_db
+        game_data_database=game_data_db,
+        image_url_fetcher=image_url_fetcher
     )
     urarawin_game_data_updater.run()
 